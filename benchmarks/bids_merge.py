@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Time concurrent conversion_workflow runs merging into one BIDS dataset.
+
+Sessions are pulled and archived as in run_benchmarks.py, and their
+conversions are then run with up to --jobs processes at once. The merged
+dataset is checked to hold every session, and participants.tsv to list every
+subject exactly once.
+
+With --datalad each, every conversion saves its session with datalad (the
+stand-in from benchmarks/stubs, backed by git). With --datalad batch, saves
+are batched by --batch_size sessions, and the remaining sessions are saved
+afterwards, as the dependent job submitted by pull_dicoms_workflow would.
+The number of commits made is reported.
+
+Usage::
+
+    python benchmarks/bids_merge.py --sessions 16 --jobs 1 4 8
+    python benchmarks/bids_merge.py --jobs 8 --datalad batch --batch_size 8
+"""
+import os
+import os.path as op
+import sys
+import time
+import json
+import shutil
+import argparse
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, op.dirname(op.abspath(__file__)))
+from run_benchmarks import setup_environment, make_project  # noqa: E402
+
+
+def _convert(args):
+    import conversion_workflow
+    tarball, bids_dir, config, sub, ses, work_dir, datalad = args
+    conversion_workflow.main(tarball, bids_dir, config, sub, ses=ses,
+                             work_dir=work_dir, stage='bidsify',
+                             datalad=datalad)
+
+
+def run_benchmark(root, n_sessions, n_jobs, datalad='none',
+                  batch_size=None):
+    """Convert every session with n_jobs processes at once.
+
+    Returns
+    -------
+    elapsed : float
+        Wall time of the conversions (and final datalad save), in seconds.
+    n_commits : int
+        Number of datalad commits made.
+    """
+    from utils import CIS_DIR
+    from slurm import read_manifest_row
+    from bids_merge import read_tsv, read_pending, save_pending
+    import pull_dicoms_workflow
+
+    project = 'merge{0}-{1}'.format(n_jobs, datalad)
+    proj_dir, config = make_project(root, project, 3, 5)
+    if datalad == 'batch':
+        with open(config, 'r') as fo:
+            config_options = json.load(fo)
+        config_options['datalad_batch'] = {'max_sessions': batch_size}
+        with open(config, 'w') as fo:
+            json.dump(config_options, fo, indent=4)
+    bids_dir = op.join(proj_dir, 'bids')
+    os.environ.update({'CIS_BENCH_SESSIONS': str(n_sessions),
+                       'CIS_BENCH_SERIES': '3', 'CIS_BENCH_DICOMS': '5',
+                       'CIS_BENCH_DICOM_BYTES': '1024'})
+    pull_dicoms_workflow.main(bids_dir, config, work_dir=CIS_DIR,
+                              autocheck=True)
+
+    manifest_dir = op.join(proj_dir, 'code', 'manifests')
+    tasks = []
+    for manifest in sorted(os.listdir(manifest_dir)):
+        manifest = op.join(manifest_dir, manifest)
+        with open(manifest, 'r') as fo:
+            n_rows = len(fo.read().splitlines()) - 1
+        for task_id in range(n_rows):
+            row = read_manifest_row(manifest, task_id)
+            tasks.append((row['tarball'], bids_dir, config, row['sub'],
+                          row['ses'], op.join(CIS_DIR, project),
+                          datalad != 'none'))
+
+    start = time.time()
+    with ProcessPoolExecutor(n_jobs) as executor:
+        list(executor.map(_convert, tasks))
+    if datalad == 'batch':
+        save_pending(bids_dir)
+    elapsed = time.time() - start
+
+    n_commits = 0
+    if datalad != 'none':
+        if read_pending(bids_dir):
+            raise ValueError('{0} jobs: sessions were left unsaved.'.format(
+                n_jobs))
+        log = subprocess.check_output(
+            ['git', '-C', bids_dir, 'log', '--format=%s']).decode()
+        n_commits = len(log.splitlines()) - 1
+        status = subprocess.check_output(
+            ['git', '-C', bids_dir, 'status', '--porcelain']).decode()
+        if status.strip():
+            raise ValueError('{0} jobs: unsaved changes:\n{1}'.format(
+                n_jobs, status))
+
+    _, participants = read_tsv(op.join(bids_dir, 'participants.tsv'))
+    with open(op.join(bids_dir, 'participants.tsv'), 'r') as fo:
+        n_rows = len(fo.read().splitlines()) - 1
+    subs = sorted('sub-' + task[3] for task in tasks)
+    if sorted(participants) != subs or n_rows != len(subs):
+        raise ValueError('{0} jobs: participants.tsv lists {1} rows for {2} '
+                         'subjects.'.format(n_jobs, n_rows, len(subs)))
+    for task in tasks:
+        if not op.isdir(op.join(bids_dir, 'sub-' + task[3], 'ses-' + task[4],
+                                'anat')):
+            raise ValueError('{0} jobs: sub-{1} ses-{2} was not '
+                             'merged.'.format(n_jobs, task[3], task[4]))
+    return elapsed, n_commits
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Time concurrent conversions merging into one BIDS '
+                    'dataset.')
+    parser.add_argument('--sessions', type=int, default=16,
+                        help='Number of sessions to convert.')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 4, 8],
+                        help='Numbers of conversions to run at once.')
+    parser.add_argument('--datalad', choices=['none', 'each', 'batch'],
+                        default='none',
+                        help='Whether and how to save sessions with '
+                             'datalad.')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='Sessions per datalad save with --datalad '
+                             'batch.')
+    return parser
+
+
+def _main(argv=None):
+    options = _get_parser().parse_args(argv)
+    root = tempfile.mkdtemp(prefix='cis-bench-merge-')
+    setup_environment(root)
+    results = []
+    try:
+        for n_jobs in options.jobs:
+            results.append((n_jobs,) + run_benchmark(
+                root, options.sessions, n_jobs, options.datalad,
+                options.batch_size))
+    finally:
+        shutil.rmtree(root)
+
+    print('{0:>5} {1:>16} {2:>8}'.format('jobs', 'conversions (s)',
+                                         'commits'))
+    for n_jobs, elapsed, n_commits in results:
+        print('{0:>5} {1:>16.2f} {2:>8}'.format(n_jobs, elapsed, n_commits))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""Check and time the rule-table heuristics against the original ones.
+
+Each heuristic in heuristics/ is replayed, alongside its original if/elif
+version in benchmarks/legacy_heuristics, over a corpus of sessions. The
+corpus is either recorded (heudiconv dicominfo*.tsv files, one session per
+file) or generated at random from the protocol names and dimensions each
+heuristic looks for, plus distractors. Every session must give the same
+info dictionary (or the same error) from both versions.
+
+Usage::
+
+    python benchmarks/heuristic_equivalence.py --sessions 20000
+    python benchmarks/heuristic_equivalence.py \\
+        --corpus /path/to/.heudiconv/*/info/dicominfo*.tsv
+"""
+import os.path as op
+import gc
+import csv
+import sys
+import time
+import random
+import argparse
+import importlib.util
+
+BENCH_DIR = op.dirname(op.abspath(__file__))
+HEURISTICS_DIR = op.join(op.dirname(BENCH_DIR), 'heuristics')
+LEGACY_DIR = op.join(BENCH_DIR, 'legacy_heuristics')
+HEURISTICS = ('ABCD_NDAR', 'Dick_AHEAD', 'Mattfeld_RTV')
+
+# heudiconv's SeqInfo fields, in order
+SEQINFO_FIELDS = ['total_files_till_now', 'example_dcm_file', 'series_id',
+                  'dcm_dir_name', 'unspecified2', 'unspecified3', 'dim1',
+                  'dim2', 'dim3', 'dim4', 'TR', 'TE', 'protocol_name',
+                  'is_motion_corrected', 'is_derived', 'patient_id',
+                  'study_description', 'referring_physician_name',
+                  'series_description', 'image_type']
+INT_FIELDS = ('total_files_till_now', 'dim1', 'dim2', 'dim3', 'dim4')
+DISTRACTORS = ['localizer', 'AAHead_Scout_32ch-head-coil', 'PhoenixZIPReport',
+               'T1w_MPR_vNav_setter', 'fMRI_Rest_SBRef', 'dMRI_SBRef',
+               'DistortionMap_XY']
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_seqinfo(series_num, protocol_name, dim3, dim4):
+    values = {'total_files_till_now': series_num * 100,
+              'example_dcm_file': '{0:05d}.dcm'.format(series_num),
+              'series_id': '{0}-{1}'.format(series_num, protocol_name),
+              'dcm_dir_name': protocol_name, 'dim1': 64, 'dim2': 64,
+              'dim3': dim3, 'dim4': dim4, 'TR': 2.0, 'TE': 30.0,
+              'protocol_name': protocol_name, 'is_motion_corrected': False,
+              'is_derived': False, 'series_description': protocol_name}
+    return tuple(values.get(field, '') for field in SEQINFO_FIELDS)
+
+
+def generate_corpus(rules, n_sessions, seed=0):
+    """Generate random sessions from a rule table's names and dimensions.
+
+    Rare unsupported field map directions are included, so error handling
+    is compared too.
+    """
+    rng = random.Random(seed)
+    names = list(DISTRACTORS)
+    dims3, dims4 = {1, 2, 60}, {1, 100}
+    for rule_ in rules.rules:
+        if rule_['fieldmap']:
+            names += list(rule_['fieldmap']['suffixes'])
+        else:
+            text = rule_['endswith'] or rule_['contains']
+            names += [text, 'ABCD_' + text, text + '_run1']
+        for field, test in rule_['dims']:
+            if not callable(test):
+                (dims3 if field == 8 else dims4).add(test)
+    dims3, dims4 = sorted(dims3), sorted(dims4)
+
+    corpus = []
+    for _ in range(n_sessions):
+        session = []
+        for series_num in range(1, rng.randint(2, 30)):
+            name = rng.choice(names)
+            if name == 'DistortionMap_XY' and rng.random() > 0.02:
+                name = 'localizer'
+            session.append(make_seqinfo(series_num, name, rng.choice(dims3),
+                                        rng.choice(dims4)))
+        corpus.append(session)
+    return corpus
+
+
+def read_dicominfo(tsv_file):
+    """Read a session's seqinfo from a heudiconv dicominfo TSV file."""
+    session = []
+    with open(tsv_file, 'r', newline='') as fo:
+        for row in csv.DictReader(fo, delimiter='\t'):
+            session.append(tuple(
+                int(row[field]) if field in INT_FIELDS else row.get(field, '')
+                for field in SEQINFO_FIELDS))
+    return session
+
+
+def _replay(infotodict, corpus, repeats=3):
+    """Replay a corpus, returning the results and the best time."""
+    best = None
+    for _ in range(repeats):
+        results = []
+        gc.collect()
+        start = time.perf_counter()
+        for session in corpus:
+            try:
+                results.append(infotodict(session))
+            except ValueError as exc:
+                results.append(('ValueError', str(exc)))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return results, best
+
+
+def compare(name, corpus):
+    """Replay a corpus through both versions of a heuristic.
+
+    Returns
+    -------
+    n_mismatches : int
+        Number of sessions with different results.
+    old_time, new_time : float
+        Time taken by each version, in seconds.
+    """
+    old = load_module(name + '_legacy', op.join(LEGACY_DIR, name + '.py'))
+    new = load_module(name, op.join(HEURISTICS_DIR, name + '.py'))
+    old_results, old_time = _replay(old.infotodict, corpus)
+    new_results, new_time = _replay(new.infotodict, corpus)
+    n_mismatches = 0
+    for i, (old_result, new_result) in enumerate(zip(old_results,
+                                                     new_results)):
+        if old_result != new_result:
+            n_mismatches += 1
+            if n_mismatches <= 3:
+                print('{0}: session {1} differs:\n  old: {2}\n  new: '
+                      '{3}'.format(name, i, old_result, new_result))
+    return n_mismatches, old_time, new_time
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Check that the rule-table heuristics match the '
+                    'original ones, and time both.')
+    parser.add_argument('--corpus', nargs='+', default=None,
+                        help='heudiconv dicominfo TSV files to replay. '
+                             'Default is a generated corpus.')
+    parser.add_argument('--sessions', type=int, default=10000,
+                        help='Number of sessions to generate.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for the generated corpus.')
+    parser.add_argument('--heuristics', nargs='+', default=list(HEURISTICS),
+                        choices=HEURISTICS, help='Heuristics to check.')
+    return parser
+
+
+def _main(argv=None):
+    options = _get_parser().parse_args(argv)
+    recorded = None
+    if options.corpus:
+        recorded = [read_dicominfo(f) for f in options.corpus]
+
+    row = '{0:<14} {1:>9} {2:>9} {3:>12} {4:>12} {5:>8}'
+    print(row.format('heuristic', 'sessions', 'mismatch', 'old (s)',
+                     'new (s)', 'speedup'))
+    failed = False
+    for name in options.heuristics:
+        corpus = recorded
+        if corpus is None:
+            rules = load_module(name, op.join(HEURISTICS_DIR,
+                                              name + '.py')).RULES
+            corpus = generate_corpus(rules, options.sessions, options.seed)
+        n_mismatches, old_time, new_time = compare(name, corpus)
+        failed = failed or n_mismatches > 0
+        print(row.format(name, len(corpus), n_mismatches,
+                         '{0:.3f}'.format(old_time),
+                         '{0:.3f}'.format(new_time),
+                         '{0:.2f}x'.format(old_time / new_time)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    _main()
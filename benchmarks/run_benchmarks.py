@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""Offline end-to-end benchmarks for the cis-processing workflows.
+
+The workflows are run against synthetic XNAT-style session trees, with the
+cluster replaced by local stand-ins from benchmarks/stubs: the XNAT
+downloader, BIDSifier and MRIQC images, and the sbatch, mail and
+singularity executables. Scratch, the Singularity image directory and
+templateflow are redirected to a temporary directory through the
+CIS_SCRATCH_DIR, CIS_SINGULARITY_DIR and CIS_TEMPLATEFLOW_DIR environment
+variables.
+
+For each number of sessions, this times:
+
+- pull_dicoms_workflow (download, protocol check, archiving, submission)
+- protocol_check.check_sessions on the downloaded sessions
+- conversion_workflow for each archived session
+- mriqc_group on the resulting derivatives
+
+Usage::
+
+    python benchmarks/run_benchmarks.py --sessions 10 100 1000 \\
+        --output results.json
+"""
+import os
+import os.path as op
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from collections import OrderedDict
+
+BENCH_DIR = op.dirname(op.abspath(__file__))
+STUB_DIR = op.join(BENCH_DIR, 'stubs')
+IMAGES = {'xnatdownload': 'xnat_download.sif',
+          'bidsifier': 'cis_bidsify.sif',
+          'mriqc': 'mriqc_0.15.1.sif'}
+
+
+def make_session(raw_dir, sub, ses, n_series=10, n_dicoms=50,
+                 dicom_bytes=1024):
+    """Write a synthetic XNAT-style session tree.
+
+    Series directories are named "<n>-series<nn>" and hold n_dicoms files
+    of dicom_bytes random bytes under resources/DICOM/files. A physio
+    ("PMU") series is added to exercise the protocol check's ignore list.
+    """
+    ses_dir = op.join(raw_dir, sub, ses)
+    series = ['{0}-series{0:02d}'.format(i) for i in range(1, n_series + 1)]
+    series.append('{0}-series01_PMU'.format(n_series + 1))
+    for series_dir in series:
+        dicom_dir = op.join(ses_dir, series_dir, 'resources/DICOM/files')
+        os.makedirs(dicom_dir)
+        for i in range(n_dicoms):
+            with open(op.join(dicom_dir, '{0:05d}.dcm'.format(i)),
+                      'wb') as fo:
+                fo.write(os.urandom(dicom_bytes))
+    return ses_dir
+
+
+def make_protocol(n_series, n_dicoms):
+    """Protocol matching the sessions written by make_session."""
+    protocol = OrderedDict([('project', None)])
+    for i in range(1, n_series + 1):
+        protocol['series{0:02d}'.format(i)] = {'n_runs': 1,
+                                               'n_dicoms': n_dicoms}
+    protocol['email'] = 'nobody@example.com'
+    return protocol
+
+
+def setup_environment(root):
+    """Point the workflows at local stand-ins under root.
+
+    Must be called before the workflow modules are imported.
+    """
+    image_dir = op.join(root, 'singularity-images')
+    os.makedirs(image_dir)
+    for image in IMAGES.values():
+        shutil.copy2(op.join(STUB_DIR, image), image_dir)
+
+    templateflow_dir = op.join(root, 'templateflow')
+    os.makedirs(op.join(templateflow_dir, 'tpl-MNI152NLin2009cAsym'))
+    for i in range(20):
+        with open(op.join(templateflow_dir, 'tpl-MNI152NLin2009cAsym',
+                          'file{0:02d}.nii.gz'.format(i)), 'wb') as fo:
+            fo.write(os.urandom(4096))
+
+    log_dir = op.join(root, 'logs')
+    os.makedirs(log_dir)
+    os.environ.update({
+        'CIS_SCRATCH_DIR': op.join(root, 'scratch'),
+        'CIS_SINGULARITY_DIR': image_dir,
+        'CIS_TEMPLATEFLOW_DIR': templateflow_dir,
+        'CIS_BENCH_DIR': BENCH_DIR,
+        'CIS_BENCH_LOG_DIR': log_dir,
+        'PATH': STUB_DIR + os.pathsep + os.environ['PATH'],
+    })
+    sys.path.insert(0, op.dirname(BENCH_DIR))
+
+
+def make_project(root, project, n_series, n_dicoms):
+    """Create a project directory with a config and protocol file."""
+    proj_dir = op.join(root, 'projects', project)
+    os.makedirs(op.join(proj_dir, 'code'))
+    os.makedirs(op.join(proj_dir, 'raw'))
+    config_options = OrderedDict([
+        ('project', project),
+        ('hpc_queue', 'bench'),
+        ('hpc_account', 'bench'),
+        ('xnatdownload', IMAGES['xnatdownload']),
+        ('protocol', 'code/protocol.json'),
+        ('bidsifier', IMAGES['bidsifier']),
+        ('heuristic', 'reproin'),
+        ('mriqc', IMAGES['mriqc']),
+        ('mriqc_settings', {'anat': {'T1w': {}},
+                            'func': {'rest': {'fd_thres': 0.2}},
+                            'n_procs': 2}),
+        ('n_procs', 2),
+        ('email', 'nobody@example.com'),
+    ])
+    config = op.join(proj_dir, 'code', 'config.json')
+    with open(config, 'w') as fo:
+        json.dump(config_options, fo, indent=4)
+
+    protocol = make_protocol(n_series, n_dicoms)
+    protocol['project'] = project
+    with open(op.join(proj_dir, 'code', 'protocol.json'), 'w') as fo:
+        json.dump(protocol, fo, indent=4)
+    return proj_dir, config
+
+
+def _time(func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
+def run_benchmark(root, n_sessions, n_series, n_dicoms, dicom_bytes,
+                  max_conversions=None):
+    """Time each workflow for one number of sessions.
+
+    Returns
+    -------
+    timings : dict
+        Wall time, in seconds, for each workflow.
+    """
+    from utils import CIS_DIR
+    from slurm import read_manifest_row
+    from protocol_check import check_sessions
+    import pull_dicoms_workflow
+    import conversion_workflow
+    import mriqc
+
+    project = 'bench{0}'.format(n_sessions)
+    proj_dir, config = make_project(root, project, n_series, n_dicoms)
+    bids_dir = op.join(proj_dir, 'bids')
+    os.environ.update({
+        'CIS_BENCH_SESSIONS': str(n_sessions),
+        'CIS_BENCH_SERIES': str(n_series),
+        'CIS_BENCH_DICOMS': str(n_dicoms),
+        'CIS_BENCH_DICOM_BYTES': str(dicom_bytes),
+    })
+    timings = OrderedDict([('sessions', n_sessions)])
+
+    timings['pull_dicoms_workflow'] = _time(
+        pull_dicoms_workflow.main, bids_dir, config, work_dir=CIS_DIR,
+        protocol_check=True, autocheck=True)
+
+    # The pull workflow removes the downloaded trees, so check a fresh set
+    raw_dir = op.join(root, 'raw-{0}'.format(n_sessions))
+    sessions = []
+    for i in range(n_sessions):
+        sub, ses = 'sub-{0:04d}'.format(i), 'ses-1'
+        make_session(raw_dir, sub, ses, n_series, n_dicoms, dicom_bytes)
+        sessions.append((sub, ses))
+    with open(op.join(proj_dir, 'code', 'protocol.json'), 'r') as fo:
+        protocol_options = json.load(fo)
+    timings['protocol_check'] = _time(check_sessions, raw_dir, sessions,
+                                      protocol_options)
+    shutil.rmtree(raw_dir)
+
+    # Sessions are submitted in batches, one manifest each
+    manifest_dir = op.join(proj_dir, 'code', 'manifests')
+    tasks = []
+    for manifest in sorted(os.listdir(manifest_dir)):
+        with open(op.join(manifest_dir, manifest), 'r') as fo:
+            n_rows = len(fo.read().splitlines()) - 1
+        tasks += [(op.join(manifest_dir, manifest), task_id)
+                  for task_id in range(n_rows)]
+    if max_conversions is not None:
+        tasks = tasks[:max_conversions]
+    start = time.time()
+    for manifest, task_id in tasks:
+        row = read_manifest_row(manifest, task_id)
+        conversion_workflow.main(
+            row['tarball'], bids_dir, config, row['sub'], ses=row['ses'],
+            work_dir=op.join(CIS_DIR, project))
+    timings['conversion_workflow'] = time.time() - start
+    timings['conversions'] = len(tasks)
+
+    timings['mriqc_group'] = _time(
+        mriqc.mriqc_group, bids_dir, config,
+        work_dir=op.join(CIS_DIR, project), group=True)
+    return timings
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Time the cis-processing workflows offline against '
+                    'synthetic sessions and stub containers.')
+    parser.add_argument('--sessions', type=int, nargs='+',
+                        default=[10, 100, 1000],
+                        help='Numbers of sessions to benchmark.')
+    parser.add_argument('--series', type=int, default=10,
+                        help='Series per session.')
+    parser.add_argument('--dicoms', type=int, default=50,
+                        help='DICOM files per series.')
+    parser.add_argument('--dicom_bytes', type=int, default=1024,
+                        help='Size of each synthetic DICOM file.')
+    parser.add_argument('--max_conversions', type=int, default=None,
+                        help='Only run conversion_workflow for this many '
+                             'sessions per benchmark.')
+    parser.add_argument('--root', default=None,
+                        help='Directory for benchmark data. Defaults to a '
+                             'temporary directory that is removed '
+                             'afterwards.')
+    parser.add_argument('--output', default=None,
+                        help='JSON file to write timings to.')
+    return parser
+
+
+def _main(argv=None):
+    options = _get_parser().parse_args(argv)
+    root = options.root or tempfile.mkdtemp(prefix='cis-bench-')
+    setup_environment(root)
+
+    results = []
+    try:
+        for n_sessions in options.sessions:
+            results.append(run_benchmark(
+                root, n_sessions, options.series, options.dicoms,
+                options.dicom_bytes, options.max_conversions))
+    finally:
+        if options.root is None:
+            shutil.rmtree(root)
+
+    row = '{0:>9} {1:>22} {2:>16} {3:>21} {4:>13}'
+    print(row.format('sessions', 'pull_dicoms_workflow', 'protocol_check',
+                     'conversion_workflow', 'mriqc_group'))
+    for timings in results:
+        print(row.format(
+            timings['sessions'],
+            '{0:.2f}'.format(timings['pull_dicoms_workflow']),
+            '{0:.2f}'.format(timings['protocol_check']),
+            '{0:.2f} ({1})'.format(timings['conversion_workflow'],
+                                   timings['conversions']),
+            '{0:.2f}'.format(timings['mriqc_group'])))
+
+    if options.output:
+        with open(options.output, 'w') as fo:
+            json.dump(results, fo, indent=4)
+
+
+if __name__ == '__main__':
+    _main()
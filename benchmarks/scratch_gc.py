@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Check conversion_workflow's scratch admission under a tight quota.
+
+A project's scratch is filled with abandoned work dirs (claims left behind
+by a dead process, with heartbeats of decreasing age), and one work dir is
+claimed by a live process. A conversion is then run
+with a scratch quota that only fits once some of the abandoned data is
+evicted. The least recently used items must go first, and the live work
+dir, and any directory holding it, must survive.
+
+Usage::
+
+    python benchmarks/scratch_gc.py --abandoned 8 --abandoned_mb 4
+"""
+import os
+import os.path as op
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, op.dirname(op.abspath(__file__)))
+from run_benchmarks import setup_environment, make_project  # noqa: E402
+
+
+def _fill(work_dir, n_bytes):
+    os.makedirs(work_dir)
+    with open(op.join(work_dir, 'data'), 'wb') as fo:
+        fo.write(os.urandom(n_bytes))
+
+
+def run_benchmark(root, n_abandoned, abandoned_mb):
+    """Run one conversion under a quota, after abandoning work dirs.
+
+    Returns
+    -------
+    elapsed : float
+        Wall time of the conversion, in seconds.
+    evicted : list of str
+        Abandoned work dirs that were evicted.
+    """
+    from utils import CIS_DIR
+    from slurm import read_manifest_row
+    import scratch
+    import pull_dicoms_workflow
+    import conversion_workflow
+
+    project = 'gc'
+    proj_dir, config = make_project(root, project, 3, 5)
+    bids_dir = op.join(proj_dir, 'bids')
+    os.environ.update({'CIS_BENCH_SESSIONS': '1', 'CIS_BENCH_SERIES': '3',
+                       'CIS_BENCH_DICOMS': '5', 'CIS_BENCH_DICOM_BYTES': '1024'})
+    pull_dicoms_workflow.main(bids_dir, config, work_dir=CIS_DIR,
+                              autocheck=True)
+    manifest_dir = op.join(proj_dir, 'code', 'manifests')
+    row = read_manifest_row(op.join(manifest_dir,
+                                    sorted(os.listdir(manifest_dir))[0]), 0)
+
+    # Abandoned work dirs, oldest first, claimed by a process that exits
+    abandoned = [op.join(CIS_DIR, 'abandoned', 'job{0:02d}'.format(i))
+                 for i in range(n_abandoned)]
+    live = op.join(CIS_DIR, 'abandoned', 'job00', 'live')
+    for work_dir in abandoned:
+        _fill(work_dir, int(abandoned_mb * 1024 ** 2))
+    subprocess.check_call([sys.executable, '-c', (
+        'import sys; sys.path.insert(0, {0!r}); import scratch\n'
+        'for work_dir in {1!r}: scratch.claim_work_dir(work_dir)').format(
+            op.dirname(op.dirname(op.abspath(__file__))), abandoned)])
+    now = time.time()
+    for info in scratch.list_work_dirs():
+        i = abandoned.index(info['work_dir'])
+        age = 3600 * (n_abandoned - i + 1)
+        os.utime(info['heartbeat_file'], (now - age, now - age))
+    # A live job nested in the oldest abandoned dir
+    _fill(live, 1024)
+    scratch.claim_work_dir(live)
+
+    # The conversion needs about abandoned_mb, so half the abandoned work
+    # dirs have to go
+    with open(config, 'r') as fo:
+        config_options = json.load(fo)
+    used = scratch.tree_size(CIS_DIR)
+    config_options.update({
+        'mriqc_scratch_gb': abandoned_mb / 1024.,
+        'scratch_quota_gb': (used + abandoned_mb * 1024 ** 2
+                             * (1 - n_abandoned // 2)) / 1024 ** 3})
+    with open(config, 'w') as fo:
+        json.dump(config_options, fo, indent=4)
+
+    start = time.time()
+    conversion_workflow.main(row['tarball'], bids_dir, config, row['sub'],
+                             ses=row['ses'], work_dir=op.join(CIS_DIR, project))
+    elapsed = time.time() - start
+
+    evicted = [work_dir for work_dir in abandoned if not op.isdir(work_dir)]
+    if not op.isdir(live):
+        raise ValueError('The live work dir was evicted.')
+    if abandoned[0] in evicted:
+        raise ValueError('A directory holding a live work dir was evicted.')
+    if evicted != abandoned[1:len(evicted) + 1]:
+        raise ValueError('Work dirs were not evicted in LRU order: '
+                         '{0}'.format(evicted))
+    scratch.release_work_dir(live, remove=True)
+    return elapsed, evicted
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Check scratch admission and eviction under a quota.')
+    parser.add_argument('--abandoned', type=int, default=8,
+                        help='Number of abandoned work dirs.')
+    parser.add_argument('--abandoned_mb', type=float, default=4,
+                        help='Size of each abandoned work dir, in MB.')
+    return parser
+
+
+def _main(argv=None):
+    options = _get_parser().parse_args(argv)
+    root = tempfile.mkdtemp(prefix='cis-bench-gc-')
+    setup_environment(root)
+    try:
+        elapsed, evicted = run_benchmark(root, options.abandoned,
+                                         options.abandoned_mb)
+    finally:
+        shutil.rmtree(root)
+    print('Conversion took {0:.2f} s; evicted {1} of {2} abandoned work dirs '
+          '(least recently used first): {3}'.format(
+              elapsed, len(evicted), options.abandoned,
+              ', '.join(op.basename(work_dir) for work_dir in evicted)))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""A local stand-in for the XNAT REST API.
+
+Serves a project's experiment list and each experiment's synthetic session
+(from run_benchmarks.make_session) as a tar stream, throttled per download
+and, optionally, over all downloads together to mimic a shared link:
+
+- GET /data/projects/<project>/experiments?format=json
+- GET /data/experiments/<ID>/files?format=tar
+- GET /data/experiments/<ID>/scans/ALL/files?format=json
+- GET /data/experiments/<ID>/scans/<IDs>/files?format=zip
+
+The stub XNAT downloader (benchmarks/stubs/xnat_download.sif) fetches
+sessions from it when CIS_BENCH_XNAT_URL is set.
+
+Usage::
+
+    python benchmarks/xnat_server.py --sessions 20 --stream_kbps 2000
+"""
+import io
+import os
+import os.path as op
+import re
+import sys
+import json
+import time
+import zipfile
+import tarfile
+import argparse
+import datetime
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, op.dirname(op.abspath(__file__)))
+from run_benchmarks import make_session  # noqa: E402
+
+CHUNK_SIZE = 16384
+
+
+class _Throttle(object):
+    """Pace writes to a rate in bytes per second (None for no limit)."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_time = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self, nbytes):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self.next_time = max(self.next_time, now) + nbytes / self.rate
+            delay = self.next_time - nbytes / self.rate - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def experiment_list(n_sessions):
+    """Experiments of the stand-in project, in XNAT's JSON layout."""
+    return [{'ID': 'XNAT_E{0:05d}'.format(i),
+             'subject_label': 'sub-{0:04d}'.format(i),
+             'label': 'sub-{0:04d}_ses-1'.format(i),
+             'date': '2020-01-01',
+             'last_modified': '2020-01-01 00:00:00.0'}
+            for i in range(n_sessions)]
+
+
+def make_handler(n_sessions, n_series, n_dicoms, dicom_bytes,
+                 stream_kbps=None, link_kbps=None, stats=None):
+    experiments = {e['ID']: e for e in experiment_list(n_sessions)}
+    # Series added to experiments after they were first served
+    extra_series = {}
+    link = _Throttle(link_kbps * 1000 / 8 if link_kbps else None)
+
+    def _session_tree(raw_dir, experiment):
+        sub, ses = experiment['label'].split('_')
+        ses_dir = make_session(raw_dir, sub, ses, n_series, n_dicoms,
+                               dicom_bytes)
+        for scan_dir in extra_series.get(experiment['ID'], []):
+            dicom_dir = op.join(ses_dir, scan_dir, 'resources/DICOM/files')
+            os.makedirs(dicom_dir)
+            for i in range(n_dicoms):
+                with open(op.join(dicom_dir, '{0:05d}.dcm'.format(i)),
+                          'wb') as fo:
+                    fo.write(os.urandom(dicom_bytes))
+        return sub, ses, ses_dir
+
+    def amend(experiment_id, n_new=1):
+        """Add series to an experiment and bump its modification time."""
+        series = extra_series.setdefault(experiment_id, [])
+        for _ in range(n_new):
+            scan_id = n_series + 2 + len(series)
+            series.append('{0}-extra{1:02d}'.format(scan_id, len(series) + 1))
+        experiments[experiment_id]['last_modified'] = \
+            datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, body, content_type):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            stream = _Throttle(stream_kbps * 1000 / 8 if stream_kbps
+                               else None)
+            for start in range(0, len(body), CHUNK_SIZE):
+                chunk = body[start:start + CHUNK_SIZE]
+                stream.wait(len(chunk))
+                link.wait(len(chunk))
+                self.wfile.write(chunk)
+            if stats is not None and 'json' not in content_type:
+                stats['bytes'] += len(body)
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if re.match(r'^/data/projects/[^/]+/experiments$', path):
+                body = json.dumps({'ResultSet': {
+                    'Result': list(experiments.values()),
+                    'totalRecords': str(len(experiments))}}).encode()
+                self._send(body, 'application/json')
+                return
+
+            match = re.match(r'^/data/experiments/([^/]+)/(?:scans/([^/]+)/)?'
+                             r'files$', path)
+            if not match or match.group(1) not in experiments:
+                self.send_error(404)
+                return
+            experiment = experiments[match.group(1)]
+            scans = match.group(2)
+            with tempfile.TemporaryDirectory() as raw_dir:
+                sub, ses, ses_dir = _session_tree(raw_dir, experiment)
+                scan_dirs = sorted(os.listdir(ses_dir))
+                if scans not in (None, 'ALL'):
+                    wanted = scans.split(',')
+                    scan_dirs = [d for d in scan_dirs
+                                 if d.split('-', 1)[0] in wanted]
+
+                if 'format=json' in self.path:
+                    rows = []
+                    for scan_dir in scan_dirs:
+                        for root, _, files in os.walk(op.join(ses_dir,
+                                                              scan_dir)):
+                            for fname in sorted(files):
+                                rows.append({
+                                    'Name': fname,
+                                    'Size': str(op.getsize(op.join(root,
+                                                                   fname))),
+                                    'URI': '/data/experiments/{0}/scans/{1}/'
+                                           'resources/DICOM/files/{2}'.format(
+                                               experiment['ID'],
+                                               scan_dir.split('-', 1)[0],
+                                               fname)})
+                    body = json.dumps({'ResultSet': {'Result': rows}})
+                    self._send(body.encode(), 'application/json')
+                elif 'format=zip' in self.path:
+                    buffer = io.BytesIO()
+                    with zipfile.ZipFile(buffer, 'w') as zip_file:
+                        for scan_dir in scan_dirs:
+                            for root, _, files in os.walk(
+                                    op.join(ses_dir, scan_dir)):
+                                for fname in files:
+                                    in_file = op.join(root, fname)
+                                    zip_file.write(in_file, '{0}/scans/{1}'.format(
+                                        experiment['label'],
+                                        op.relpath(in_file, ses_dir)))
+                    self._send(buffer.getvalue(), 'application/zip')
+                else:
+                    buffer = io.BytesIO()
+                    with tarfile.open(fileobj=buffer, mode='w') as tar:
+                        tar.add(op.join(raw_dir, sub), arcname=sub)
+                    self._send(buffer.getvalue(), 'application/x-tar')
+
+    Handler.amend = staticmethod(amend)
+    return Handler
+
+
+def serve(n_sessions, n_series=10, n_dicoms=50, dicom_bytes=1024,
+          stream_kbps=None, link_kbps=None, port=0):
+    """Start the stand-in server in a background thread.
+
+    Returns
+    -------
+    server : http.server.ThreadingHTTPServer
+        The running server. Its URL is
+        "http://127.0.0.1:<server.server_port>". server.stats["bytes"]
+        counts the session bytes served, and server.amend(experiment_id)
+        adds a series to an experiment. Call server.shutdown() to stop it.
+    """
+    stats = {'bytes': 0}
+    handler = make_handler(n_sessions, n_series, n_dicoms, dicom_bytes,
+                           stream_kbps, link_kbps, stats)
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.stats = stats
+    server.amend = handler.amend
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Serve synthetic sessions through a stand-in XNAT API.')
+    parser.add_argument('--sessions', type=int, default=20,
+                        help='Number of experiments in the project.')
+    parser.add_argument('--series', type=int, default=10,
+                        help='Series per session.')
+    parser.add_argument('--dicoms', type=int, default=50,
+                        help='DICOM files per series.')
+    parser.add_argument('--dicom_bytes', type=int, default=1024,
+                        help='Size of each synthetic DICOM file.')
+    parser.add_argument('--stream_kbps', type=float, default=None,
+                        help='Throughput limit of each download, in kbit/s.')
+    parser.add_argument('--link_kbps', type=float, default=None,
+                        help='Throughput limit of all downloads together, '
+                             'in kbit/s.')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port to listen on.')
+    return parser
+
+
+def _main(argv=None):
+    options = _get_parser().parse_args(argv)
+    server = serve(options.sessions, options.series, options.dicoms,
+                   options.dicom_bytes, options.stream_kbps,
+                   options.link_kbps, options.port)
+    print('Serving {0} experiments on http://127.0.0.1:{1}'.format(
+        options.sessions, server.server_port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    _main()
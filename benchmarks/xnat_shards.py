@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""Time pull_dicoms_workflow's sharded XNAT downloads.
+
+Sessions are served by the stand-in XNAT server (xnat_server.py), with each
+download throttled to --stream_kbps and, optionally, all downloads together
+to --link_kbps. For each number of shards, a fresh project pulls every
+session, and the ledger is checked to hold each one exactly once. The time
+until the first conversion job is submitted is reported too. A second
+pull then checks that nothing is downloaded again, and a third one, after
+two experiments gain a series, that only the new series are downloaded.
+
+The number of downloads running at once is read back from the pull's trace.
+With --link_kbps below --shards streams of --stream_kbps, it must drop
+below --shards once the link fills up. --seed_kbps sets the workflow's
+initial guess of the per-download throughput; a low guess starts all
+shards at once.
+
+Usage::
+
+    python benchmarks/xnat_shards.py --sessions 16 --shards 1 2 4 8 \\
+        --stream_kbps 4000
+"""
+import os
+import os.path as op
+import sys
+import glob
+import json
+import math
+import time
+import shutil
+import tarfile
+import argparse
+import tempfile
+
+sys.path.insert(0, op.dirname(op.abspath(__file__)))
+from run_benchmarks import setup_environment, make_project  # noqa: E402
+from xnat_server import serve  # noqa: E402
+
+
+def run_benchmark(root, server, n_sessions, n_shards, n_series, n_dicoms,
+                  stream_kbps, link_kbps=None, seed_kbps=None):
+    """Pull every session with n_shards downloads at once.
+
+    Returns
+    -------
+    elapsed : float
+        Wall time of the pull, in seconds.
+    first_submit : float
+        Time until the first conversion job was submitted, in seconds.
+    streams : tuple of int
+        Most downloads running at once over the first and the second half
+        of the downloads.
+    """
+    from utils import CIS_DIR
+    from ledger import read_scans
+    from session_index import SessionIndex, INDEX_FILE
+    import pull_dicoms_workflow
+
+    project = 'shards{0}'.format(n_shards)
+    proj_dir, config = make_project(root, project, n_series, n_dicoms)
+    with open(config, 'r') as fo:
+        config_options = json.load(fo)
+    config_options['xnat'] = {
+        'url': 'http://127.0.0.1:{0}'.format(server.server_port),
+        'shards': n_shards}
+    if link_kbps:
+        config_options['xnat']['bandwidth_mbps'] = link_kbps / 1000.
+    if seed_kbps:
+        config_options['xnat']['stream_mbps'] = seed_kbps / 1000.
+    with open(config, 'w') as fo:
+        json.dump(config_options, fo, indent=4)
+    bids_dir = op.join(proj_dir, 'bids')
+
+    start = time.time()
+    pull_dicoms_workflow.main(bids_dir, config, work_dir=CIS_DIR,
+                              protocol_check=True, autocheck=True)
+    elapsed = time.time() - start
+    manifest_dir = op.join(proj_dir, 'code', 'manifests')
+    first_submit = min(op.getmtime(op.join(manifest_dir, f))
+                       for f in os.listdir(manifest_dir)) - start
+    streams = download_concurrency(proj_dir)
+    if link_kbps and n_shards > math.ceil(link_kbps / stream_kbps):
+        if streams[1] >= n_shards:
+            raise ValueError('{0} shards: {1} downloads still ran at once on '
+                             'a full link.'.format(n_shards, streams[1]))
+
+    scans_file = op.join(proj_dir, 'raw', 'scans.tsv')
+    with open(scans_file, 'r') as fo:
+        n_rows = len(fo.read().splitlines()) - 1
+    if n_rows != n_sessions or len(read_scans(scans_file)) != n_sessions:
+        raise ValueError('{0} shards: expected {1} archived sessions, found '
+                         '{2} ledger rows.'.format(n_shards, n_sessions,
+                                                   n_rows))
+
+    # nothing is pending on the next run
+    pull_dicoms_workflow.main(bids_dir, config, work_dir=CIS_DIR,
+                              autocheck=True)
+    with open(scans_file, 'r') as fo:
+        if len(fo.read().splitlines()) - 1 != n_rows:
+            raise ValueError('{0} shards: sessions were downloaded '
+                             'again.'.format(n_shards))
+
+    # amended sessions are re-fetched, downloading only their new series
+    if n_shards > 1:
+        amended = ['XNAT_E{0:05d}'.format(i) for i in range(min(2, n_sessions))]
+        for experiment in amended:
+            server.amend(experiment)
+        n_bytes = server.stats['bytes']
+        pull_dicoms_workflow.main(bids_dir, config, work_dir=CIS_DIR,
+                                  autocheck=True)
+        with open(scans_file, 'r') as fo:
+            if len(fo.read().splitlines()) - 1 != n_rows + len(amended):
+                raise ValueError('{0} shards: amended sessions were not '
+                                 're-archived.'.format(n_shards))
+        index = SessionIndex(op.join(proj_dir, 'raw', INDEX_FILE))
+        for experiment in amended:
+            entry = index.get(experiment)
+            with tarfile.open(op.join(proj_dir, 'raw', entry['sub'],
+                                      entry['ses'], entry['file'])) as tar:
+                names = tar.getnames()
+            if not any('extra' in name for name in names):
+                raise ValueError('{0} shards: {1} is missing its new '
+                                 'series.'.format(n_shards, experiment))
+        print('Re-fetched {0} amended sessions: {1} bytes downloaded.'.format(
+            len(amended), server.stats['bytes'] - n_bytes))
+    return elapsed, first_submit, streams
+
+
+def download_concurrency(proj_dir):
+    """Most downloads running at once, from a project's pull traces.
+
+    Returns
+    -------
+    streams : tuple of int
+        Maximum over the first and over the second half of the downloads,
+        by start time.
+    """
+    spans = []
+    for jsonl_file in glob.glob(op.join(proj_dir, 'code', 'trace',
+                                        'pull-*.jsonl')):
+        with open(jsonl_file, 'r') as fo:
+            spans += [json.loads(line) for line in fo]
+    spans = sorted((span['start'], span['start'] + span['duration'])
+                   for span in spans if span['stage'] == 'download')
+    running = [sum(1 for other in spans if other[0] <= span[0] < other[1])
+               for span in spans]
+    half = len(running) // 2
+    return max(running[:half] or [0]), max(running[half:] or [0])
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Time sharded XNAT downloads against a stand-in XNAT '
+                    'server.')
+    parser.add_argument('--sessions', type=int, default=16,
+                        help='Number of experiments to download.')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='Numbers of concurrent downloads to time.')
+    parser.add_argument('--series', type=int, default=5,
+                        help='Series per session.')
+    parser.add_argument('--dicoms', type=int, default=20,
+                        help='DICOM files per series.')
+    parser.add_argument('--dicom_bytes', type=int, default=4096,
+                        help='Size of each synthetic DICOM file.')
+    parser.add_argument('--stream_kbps', type=float, default=4000,
+                        help='Throughput limit of each download, in kbit/s.')
+    parser.add_argument('--link_kbps', type=float, default=None,
+                        help='Throughput limit of all downloads together, '
+                             'in kbit/s. Also set as the bandwidth '
+                             'available to the workflow.')
+    parser.add_argument('--seed_kbps', type=float, default=None,
+                        help='Per-download throughput the workflow expects '
+                             'initially (its "stream_mbps"), in kbit/s.')
+    return parser
+
+
+def _main(argv=None):
+    options = _get_parser().parse_args(argv)
+    root = tempfile.mkdtemp(prefix='cis-bench-xnat-')
+    setup_environment(root)
+    server = serve(options.sessions, options.series, options.dicoms,
+                   options.dicom_bytes, options.stream_kbps,
+                   options.link_kbps)
+    server_url = 'http://127.0.0.1:{0}'.format(server.server_port)
+    os.environ['CIS_BENCH_XNAT_URL'] = server_url
+
+    results = []
+    try:
+        for n_shards in options.shards:
+            results.append((n_shards,) + run_benchmark(
+                root, server, options.sessions, n_shards,
+                options.series, options.dicoms, options.stream_kbps,
+                options.link_kbps, options.seed_kbps))
+    finally:
+        server.shutdown()
+        shutil.rmtree(root)
+
+    print('{0:>7} {1:>10} {2:>8} {3:>18} {4:>18}'.format(
+        'shards', 'pull (s)', 'speedup', 'first submit (s)',
+        'streams (1st/2nd)'))
+    for n_shards, elapsed, first_submit, streams in results:
+        print('{0:>7} {1:>10.2f} {2:>7.2f}x {3:>18.2f} {4:>18}'.format(
+            n_shards, elapsed, results[0][1] / elapsed, first_submit,
+            '{0}/{1}'.format(*streams)))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,403 @@
+"""Merge per-session BIDS datasets from scratch into the main dataset.
+
+The BIDSifier writes each session to its own staging dataset in scratch, so
+concurrent conversions never write to the main dataset directly. A session
+is then merged in two steps:
+
+1. Without a lock, the session's directories (sub-<sub>/ses-<ses> and
+   heudiconv's .heudiconv/<sub>/ses-<ses>) are moved or copied next to
+   their place in the main dataset, under temporary names.
+2. Under an exclusive lock on <bids_dir>.merge.lock, they are renamed into
+   place, replacing any earlier conversion of the session, and the
+   dataset's shared files are merged: TSV files (e.g., participants.tsv)
+   by their first column, with the staged values taking precedence, and
+   JSON files (e.g., dataset_description.json) by adding missing keys.
+   Other new files are copied. Shared files are replaced atomically.
+
+The lock is only held for renames and small file merges, so many
+conversions can run at once.
+
+Datalad saves may also be batched: merged sessions are then recorded in
+<bids_dir>.datalad-pending.jsonl, and saved together in one commit, whose
+message lists each session and the job that converted it. A batch is saved
+by whichever conversion reaches a count or age threshold, or by running
+this module (e.g., as a job depending on a conversion job array)::
+
+    python bids_merge.py save /path/to/project/bids
+    python bids_merge.py pending /path/to/project/bids
+"""
+import os
+import os.path as op
+import csv
+import json
+import time
+import fcntl
+import errno
+import shutil
+import argparse
+from collections import OrderedDict
+
+from utils import run
+
+
+def session_units(sub, ses=None):
+    """Directories that belong to a single session, relative to the dataset.
+
+    Returns
+    -------
+    units : list of str
+        The session's BIDS directory and heudiconv metadata directory.
+    """
+    if ses:
+        return [op.join('sub-{0}'.format(sub), 'ses-{0}'.format(ses)),
+                op.join('.heudiconv', sub, 'ses-{0}'.format(ses))]
+    return ['sub-{0}'.format(sub), op.join('.heudiconv', sub)]
+
+
+def lock_file(bids_dir):
+    """The lock serializing merges into a dataset, next to the dataset."""
+    return op.abspath(bids_dir).rstrip('/') + '.merge.lock'
+
+
+def _move_tree(src, dst):
+    """Move a directory, copying it across filesystems."""
+    try:
+        os.rename(src, dst)
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        shutil.copytree(src, dst, symlinks=True)
+        shutil.rmtree(src)
+
+
+def read_tsv(tsv_file):
+    """Read a TSV file into its header and rows keyed by the first column."""
+    with open(tsv_file, 'r') as fo:
+        reader = csv.reader(fo, delimiter='\t')
+        header = next(reader, [])
+        rows = OrderedDict()
+        for row in reader:
+            if row:
+                rows[row[0]] = OrderedDict(zip(header, row))
+    return header, rows
+
+
+def merge_tsv(in_file, out_file):
+    """Merge a TSV file's rows into another one, keyed by the first column.
+
+    Columns missing from out_file are added, and values from in_file replace
+    existing ones unless they are "n/a".
+    """
+    in_header, in_rows = read_tsv(in_file)
+    header, rows = read_tsv(out_file) if op.isfile(out_file) else (
+        in_header, OrderedDict())
+    header = header + [col for col in in_header if col not in header]
+    for key, row in in_rows.items():
+        merged = rows.setdefault(key, OrderedDict())
+        merged.update((col, value) for col, value in row.items()
+                      if value != 'n/a' or col not in merged)
+
+    tmp_file = '{0}.tmp-{1}'.format(out_file, os.getpid())
+    with open(tmp_file, 'w') as fo:
+        writer = csv.writer(fo, delimiter='\t', lineterminator='\n')
+        writer.writerow(header)
+        for row in rows.values():
+            writer.writerow([row.get(col, 'n/a') for col in header])
+    os.replace(tmp_file, out_file)
+
+
+def _add_missing(in_dict, out_dict):
+    changed = False
+    for key, value in in_dict.items():
+        if key not in out_dict:
+            out_dict[key] = value
+            changed = True
+        elif isinstance(value, dict) and isinstance(out_dict[key], dict):
+            changed = _add_missing(value, out_dict[key]) or changed
+    return changed
+
+
+def merge_json(in_file, out_file):
+    """Add a JSON file's missing keys to another one."""
+    with open(in_file, 'r') as fo:
+        in_dict = json.load(fo, object_pairs_hook=OrderedDict)
+    if op.isfile(out_file):
+        with open(out_file, 'r') as fo:
+            out_dict = json.load(fo, object_pairs_hook=OrderedDict)
+        if not isinstance(in_dict, dict) or not isinstance(out_dict, dict):
+            return
+        if not _add_missing(in_dict, out_dict):
+            return
+    else:
+        out_dict = in_dict
+
+    tmp_file = '{0}.tmp-{1}'.format(out_file, os.getpid())
+    with open(tmp_file, 'w') as fo:
+        json.dump(out_dict, fo, indent=4)
+    os.replace(tmp_file, out_file)
+
+
+def pending_file(bids_dir):
+    """Sessions merged but not yet saved with datalad, next to the dataset."""
+    return op.abspath(bids_dir).rstrip('/') + '.datalad-pending.jsonl'
+
+
+def read_pending(bids_dir):
+    """Read the sessions waiting for a batched datalad save.
+
+    Returns
+    -------
+    entries : list of dict
+        "sub", "ses", "paths" (relative to bids_dir), "message", "job_id"
+        and "merged" (time) for each session, oldest first.
+    """
+    entries = []
+    if not op.isfile(pending_file(bids_dir)):
+        return entries
+    with open(pending_file(bids_dir), 'r') as fo:
+        for line in fo:
+            if line.strip():
+                entries.append(json.loads(line))
+    return entries
+
+
+def _job_id():
+    if 'SLURM_ARRAY_JOB_ID' in os.environ:
+        return '{0}_{1}'.format(os.environ['SLURM_ARRAY_JOB_ID'],
+                                os.environ.get('SLURM_ARRAY_TASK_ID'))
+    return os.environ.get('SLURM_JOB_ID')
+
+
+def _due(entries, max_sessions=None, max_wait=None):
+    if not entries:
+        return False
+    if max_sessions and len(entries) >= max_sessions:
+        return True
+    return (max_wait is not None
+            and time.time() - entries[0]['merged'] >= max_wait)
+
+
+def _save(bids_dir, entries):
+    """Save sessions' merged files in one datalad commit (lock held).
+
+    The commit message lists each session, with the job that converted it.
+    The pending file is cleared afterwards, so entries must include every
+    pending session.
+    """
+    if not op.isdir(op.join(bids_dir, '.datalad')):
+        run('datalad create --force {0}'.format(bids_dir))
+    if len(entries) == 1:
+        lines = [entries[0]['message']]
+    else:
+        lines = ['Add {0} sessions'.format(len(entries)), '']
+        lines += ['- {0}'.format(entry['message']) for entry in entries]
+    lines += ['', 'Sessions:']
+    lines += ['- sub-{0} ses-{1} (job {2}, merged {3})'.format(
+        entry['sub'], entry['ses'], entry['job_id'],
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['merged'])))
+        for entry in entries]
+    paths = []
+    for entry in entries:
+        paths += [path for path in entry['paths'] if path not in paths
+                  and op.exists(op.join(bids_dir, path))]
+
+    message_file = '{0}.message-{1}'.format(pending_file(bids_dir),
+                                            os.getpid())
+    with open(message_file, 'w') as fo:
+        fo.write('\n'.join(lines) + '\n')
+    try:
+        run('datalad save -d {0} -F {1} {2}'.format(
+            bids_dir, message_file,
+            ' '.join(op.join(bids_dir, path) for path in paths)))
+    finally:
+        os.remove(message_file)
+    if op.isfile(pending_file(bids_dir)):
+        os.remove(pending_file(bids_dir))
+
+
+def save_pending(bids_dir, max_sessions=None, max_wait=None):
+    """Save the sessions waiting for a batched datalad save.
+
+    Parameters
+    ----------
+    bids_dir : str
+        Main BIDS dataset.
+    max_sessions, max_wait : int, float or None, optional
+        Only save if at least max_sessions sessions are pending, or if the
+        oldest was merged at least max_wait seconds ago. Default is None for
+        both (save any pending sessions).
+
+    Returns
+    -------
+    n_saved : int
+        Number of sessions saved.
+    """
+    with open(lock_file(bids_dir), 'a') as lock_fo:
+        fcntl.flock(lock_fo, fcntl.LOCK_EX)
+        entries = read_pending(bids_dir)
+        if max_sessions is None and max_wait is None:
+            max_sessions = 1
+        if not _due(entries, max_sessions, max_wait):
+            return 0
+        _save(bids_dir, entries)
+    return len(entries)
+
+
+def merge_session(staging_dir, bids_dir, sub, ses=None, datalad=False,
+                  message=None, batch=None):
+    """Merge a session's staging dataset into the main BIDS dataset.
+
+    The staging dataset is removed afterwards.
+
+    Parameters
+    ----------
+    staging_dir : str
+        BIDS dataset written by the BIDSifier for this session only.
+    bids_dir : str
+        Main BIDS dataset.
+    sub : str
+        Subject label, without "sub-".
+    ses : str or None, optional
+        Session label, without "ses-". Default is None.
+    datalad : bool, optional
+        Whether to save the merged files with datalad, while holding the
+        lock. Default is False.
+    message : str or None, optional
+        Datalad commit message, or the session's line in a batch's commit
+        message.
+    batch : dict or None, optional
+        Batch datalad saves: the session is recorded as pending, and all
+        pending sessions are saved at once when there are "max_sessions"
+        of them or the oldest was merged "max_wait" seconds ago (see
+        save_pending). Default is None (save right away).
+
+    Returns
+    -------
+    merged : list of str
+        Paths in bids_dir the session was merged into, relative to bids_dir.
+    """
+    if not op.isdir(bids_dir):
+        os.makedirs(bids_dir)
+
+    # Bring the session's directories next to their destinations
+    units = []
+    for unit in session_units(sub, ses):
+        src = op.join(staging_dir, unit)
+        if not op.isdir(src):
+            continue
+        dst = op.join(bids_dir, unit)
+        os.makedirs(op.dirname(dst), exist_ok=True)
+        tmp = op.join(op.dirname(dst), '.{0}.tmp-{1}'.format(
+            op.basename(dst), os.getpid()))
+        if op.isdir(tmp):
+            shutil.rmtree(tmp)
+        _move_tree(src, tmp)
+        units.append((unit, tmp, dst))
+
+    merged = []
+    old_dirs = []
+    # The directories set aside are removed once merged, or put back if
+    # the merge failed before replacing them, even if the save fails
+    try:
+        with open(lock_file(bids_dir), 'a') as lock_fo:
+            fcntl.flock(lock_fo, fcntl.LOCK_EX)
+            for unit, tmp, dst in units:
+                if op.isdir(dst):
+                    old = op.join(op.dirname(dst), '.{0}.old-{1}'.format(
+                        op.basename(dst), os.getpid()))
+                    os.rename(dst, old)
+                    old_dirs.append((old, dst))
+                os.rename(tmp, dst)
+                merged.append(unit)
+
+            # Whatever is left in the staging dataset is shared with other
+            # sessions
+            for root, _, files in os.walk(staging_dir):
+                for fname in sorted(files):
+                    in_file = op.join(root, fname)
+                    rel_path = op.relpath(in_file, staging_dir)
+                    out_file = op.join(bids_dir, rel_path)
+                    os.makedirs(op.dirname(out_file), exist_ok=True)
+                    if fname.endswith('.tsv'):
+                        merge_tsv(in_file, out_file)
+                    elif fname.endswith('.json'):
+                        merge_json(in_file, out_file)
+                    elif op.exists(out_file):
+                        continue
+                    else:
+                        shutil.copy2(in_file, out_file)
+                    merged.append(rel_path)
+
+            if datalad:
+                entry = {'sub': sub, 'ses': ses, 'paths': merged,
+                         'message': message or 'Add sub-{0} ses-{1}'.format(
+                             sub, ses),
+                         'job_id': _job_id(), 'merged': time.time()}
+                if batch is None:
+                    # Sessions left pending by batched saves go in this commit
+                    _save(bids_dir, read_pending(bids_dir) + [entry])
+                else:
+                    with open(pending_file(bids_dir), 'a') as fo:
+                        fo.write(json.dumps(entry) + '\n')
+                    entries = read_pending(bids_dir)
+                    if _due(entries, batch.get('max_sessions'),
+                            batch.get('max_wait')):
+                        # The session is merged either way; a failed save is
+                        # retried with the next batch
+                        try:
+                            _save(bids_dir, entries)
+                        except Exception as exc:
+                            print('Failed to save {0} pending sessions with '
+                                  'datalad: {1}'.format(len(entries), exc))
+    finally:
+        for old, dst in old_dirs:
+            if op.isdir(dst):
+                shutil.rmtree(old)
+            else:
+                os.rename(old, dst)
+    shutil.rmtree(staging_dir)
+    return merged
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Manage batched datalad saves of merged BIDS sessions.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    save_parser = subparsers.add_parser(
+        'save', help='Save pending sessions in one datalad commit.')
+    save_parser.add_argument('bids_dir', help='BIDS dataset.')
+    save_parser.add_argument('--max-sessions', dest='max_sessions', type=int,
+                             default=None,
+                             help='Only save if this many sessions are '
+                                  'pending.')
+    save_parser.add_argument('--max-wait', dest='max_wait', type=float,
+                             default=None,
+                             help='Only save if the oldest pending session '
+                                  'was merged this many seconds ago.')
+
+    pending_parser = subparsers.add_parser(
+        'pending', help='List sessions waiting to be saved.')
+    pending_parser.add_argument('bids_dir', help='BIDS dataset.')
+    return parser
+
+
+def _main(argv=None):
+    options = _get_parser().parse_args(argv)
+    if options.command == 'pending':
+        for entry in read_pending(options.bids_dir):
+            print('sub-{0} ses-{1}\tjob {2}\tmerged {3}\t{4}'.format(
+                entry['sub'], entry['ses'], entry['job_id'],
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(entry['merged'])),
+                entry['message']))
+        return
+
+    n_saved = save_pending(options.bids_dir, options.max_sessions,
+                           options.max_wait)
+    print('Saved {0} sessions.'.format(n_saved))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,110 @@
+"""Stage completion markers for resumable workflows.
+
+A stage that finishes writes a marker to the working directory holding a
+fingerprint of its inputs. When a workflow is rerun with resume enabled,
+stages whose marker matches their current fingerprint are skipped. Markers
+also record when the stage completed, so downstream stages can include
+that in their own fingerprints and are rerun whenever an upstream stage is.
+"""
+import os
+import os.path as op
+import json
+import time
+import hashlib
+
+CHECKPOINT_DIR = '.checkpoints'
+
+
+def file_fingerprint(path):
+    """Identify a file by its path, size and modification time.
+
+    Returns
+    -------
+    fingerprint : list
+        [path, size, mtime]. Size and mtime are None if the file does not
+        exist (e.g., for heudiconv's builtin heuristics).
+    """
+    if not op.exists(path):
+        return [path, None, None]
+    stat = os.stat(path)
+    return [op.abspath(path), stat.st_size, int(stat.st_mtime)]
+
+
+def fingerprint(*inputs):
+    """Hash JSON-serializable stage inputs into a fingerprint string."""
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class Checkpoints(object):
+    """Completion markers for the stages of one workflow run.
+
+    Parameters
+    ----------
+    work_dir : str
+        Working directory. Markers are written to its CHECKPOINT_DIR folder.
+    resume : bool, optional
+        Whether completed stages may be skipped. If False, every stage runs,
+        but markers are still written so a later run can resume. Default is
+        False.
+    force : list of str or None, optional
+        Stages to rerun even when resuming. A name also forces every stage
+        named "<name>-<anything>" (e.g., "mriqc" forces "mriqc-T1w").
+        Default is None.
+    """
+
+    def __init__(self, work_dir, resume=False, force=None):
+        self.checkpoint_dir = op.join(work_dir, CHECKPOINT_DIR)
+        self.resume = resume
+        self.force = set(force or [])
+
+    def _marker(self, stage):
+        return op.join(self.checkpoint_dir, '{0}.json'.format(stage))
+
+    def forced(self, stage):
+        """Whether a stage was forced to rerun."""
+        return stage in self.force or stage.split('-')[0] in self.force
+
+    def read(self, stage):
+        """Read a stage's marker, or None if it has not completed."""
+        marker = self._marker(stage)
+        if not op.isfile(marker):
+            return None
+        with open(marker, 'r') as fo:
+            return json.load(fo)
+
+    def completed(self, stage, stage_fingerprint):
+        """Check whether a stage can be skipped.
+
+        Returns
+        -------
+        outputs : dict or None
+            The outputs recorded when the stage completed, or None if the
+            stage must run (not resuming, forced, never completed, or
+            completed with different inputs).
+        """
+        if not self.resume or self.forced(stage):
+            return None
+        marker = self.read(stage)
+        if marker is None or marker['fingerprint'] != stage_fingerprint:
+            return None
+        print('Skipping stage "{0}", completed at {1}.'.format(
+            stage, time.strftime('%Y-%m-%d %H:%M:%S',
+                                 time.localtime(marker['completed']))))
+        return marker['outputs']
+
+    def token(self, stage):
+        """Completion time of a stage, for use in downstream fingerprints."""
+        marker = self.read(stage)
+        return None if marker is None else marker['completed']
+
+    def mark(self, stage, stage_fingerprint, **outputs):
+        """Record that a stage completed, along with any outputs to reuse."""
+        if not op.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+        marker = self._marker(stage)
+        tmp_file = '{0}.tmp-{1}'.format(marker, os.getpid())
+        with open(tmp_file, 'w') as fo:
+            json.dump({'fingerprint': stage_fingerprint,
+                       'completed': time.time(),
+                       'outputs': outputs}, fo)
+        os.replace(tmp_file, marker)
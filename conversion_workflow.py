@@ -2,8 +2,8 @@
 """The full cis-processing workflow.
 
 This workflow does the following:
-1. Copy raw data tarball to scratch.
-2. Copy necessary Singularity images to scratch.
+1. Stage raw data tarball in scratch (linking, copying or decompressing it).
+2. Get necessary Singularity images from the scratch image cache.
 3. Run BIDSifier Singularity image on tarball.
 4. Merge mini BIDS dataset in /scratch into main BIDS dataset in /data.
 5. Run MRIQC Singularity image on new mini-BIDS dataset.
@@ -15,12 +15,25 @@ import os.path as op
 import re
 import json
 import shutil
-import getpass
 
 import argparse
 
-from utils import run
+from utils import (run, CIS_DIR, SCRATCH_DIR, SINGULARITY_DIR, TEMPLATEFLOW_DIR,
+                   ARCHIVE_EXTENSIONS, get_archive_options, stage_archive)
 from mriqc import run_mriqc
+from image_cache import get_image
+from bids_merge import session_units, merge_session
+from scratch import (claim_work_dir, release_work_dir, estimate_footprint,
+                     ensure_space, MRIQC_SCRATCH_GB)
+from slurm import read_manifest_row
+from tree_sync import sync_tree
+from tracing import Tracer
+from checkpoint import Checkpoints, file_fingerprint, fingerprint
+
+STAGES = ('all', 'bidsify', 'mriqc')
+CHECKPOINT_STAGES = ('staging', 'bidsify', 'mriqc')
+RULE_TABLE = op.join(op.dirname(op.abspath(__file__)), 'heuristics',
+                     'rule_table.py')
 
 
 def _get_parser():
@@ -29,9 +42,11 @@ def _get_parser():
                     'it with a set of Singularity images.')
     parser.add_argument(
         '-t', '--tarball',
-        required=True,
+        required=False,
         dest='tarball',
-        help='Tarred file containing raw (dicom) data.')
+        default=None,
+        help='Tarred file containing raw (dicom) data. Required unless '
+             '--manifest is used.')
     parser.add_argument(
         '-b', '--bidsdir',
         required=True,
@@ -52,9 +67,11 @@ def _get_parser():
         help='Path to the config json file.')
     parser.add_argument(
         '--sub',
-        required=True,
+        required=False,
         dest='sub',
-        help='The label of the subject to analyze.')
+        default=None,
+        help='The label of the subject to analyze. Required unless '
+             '--manifest is used.')
     parser.add_argument(
         '--ses',
         required=False,
@@ -68,20 +85,60 @@ def _get_parser():
         dest='datalad',
         help='Whether to use datalad to track changes or not.',
         default=False)
+    parser.add_argument(
+        '--manifest',
+        required=False,
+        dest='manifest',
+        default=None,
+        help='Job array manifest. The tarball, subject and session are read '
+             'from the row given by SLURM_ARRAY_TASK_ID.')
+    parser.add_argument(
+        '--stage',
+        required=False,
+        dest='stage',
+        choices=STAGES,
+        default='all',
+        help='Workflow stage to run. "bidsify" runs the BIDSifier and BIDS '
+             'validation, "mriqc" runs MRIQC on an already converted '
+             'session, and "all" runs both.')
+    parser.add_argument(
+        '--resume',
+        required=False,
+        action='store_true',
+        dest='resume',
+        help='Skip stages that completed in a previous run on the same '
+             'inputs, using the markers left in the working directory.',
+        default=False)
+    parser.add_argument(
+        '--force-stage',
+        required=False,
+        action='append',
+        dest='force_stage',
+        choices=CHECKPOINT_STAGES,
+        default=None,
+        help='Rerun this stage (and the stages after it) even with '
+             '--resume. May be given more than once.')
     return parser
 
 
-def main(tarball, bids_dir, config, sub, ses=None, work_dir=None, datalad=False):
+def main(tarball, bids_dir, config, sub, ses=None, work_dir=None, datalad=False,
+         manifest=None, stage='all', resume=False, force_stage=None):
     """Runtime for conversion_workflow.py."""
-    CIS_DIR = '/scratch/cis_dataqc/'
+    if manifest is not None:
+        row = read_manifest_row(manifest)
+        tarball, sub, ses = row['tarball'], row['sub'], row['ses']
+
+    if tarball is None or sub is None:
+        raise ValueError('Arguments "tarball" and "sub" are required unless '
+                         'a manifest is used.')
 
     # Check inputs
     if work_dir is None:
         work_dir = CIS_DIR
 
-    if not op.isfile(tarball) or not tarball.endswith('.tar'):
+    if not op.isfile(tarball) or not tarball.endswith(ARCHIVE_EXTENSIONS):
         raise ValueError('Argument "tarball" must be an existing file with '
-                         'the suffix ".tar".')
+                         'one of the suffixes {0}.'.format(ARCHIVE_EXTENSIONS))
 
     if not op.isfile(config):
         raise ValueError('Argument "config" must be an existing file.')
@@ -98,12 +155,11 @@ def main(tarball, bids_dir, config, sub, ses=None, work_dir=None, datalad=False)
         '{0}-{1}-{2}'.format(config_options['project'], sub, ses)
     )
 
-    if not scan_work_dir.startswith('/scratch'):
+    if not scan_work_dir.startswith(SCRATCH_DIR):
         raise ValueError('Working directory must be in scratch.')
 
-    singularity_dir = '/home/data/cis/singularity-images/'
-    bidsifier_file = op.join(singularity_dir, config_options['bidsifier'])
-    mriqc_file = op.join(singularity_dir, config_options['mriqc'])
+    bidsifier_file = op.join(SINGULARITY_DIR, config_options['bidsifier'])
+    mriqc_file = op.join(SINGULARITY_DIR, config_options['mriqc'])
     mriqc_version = re.search(r'_([\d.]+)', mriqc_file).group(1)
     mriqc_out_dir = op.join(bids_dir,
                             'derivatives/mriqc-{0}'.format(mriqc_version))
@@ -115,96 +171,199 @@ def main(tarball, bids_dir, config, sub, ses=None, work_dir=None, datalad=False)
         raise ValueError('MRIQC image specified in config file must be '
                          'an existing file.')
 
-    # Make folders/files
-    if not op.isdir(scan_work_dir):
-        os.makedirs(scan_work_dir)
-
-    if not op.isdir(bids_dir):
-        os.makedirs(bids_dir)
-
-    # Change directory to parent folder of bids_dir to give Singularity images
-    # access to relevant directories.
-    os.chdir(op.dirname(bids_dir))
-
-    # Additional checks and copying for heuristic file
-    heuristic = config_options['heuristic']
-
-    # Heuristic may be file (absolute or relative path) or heudiconv builtin
-    # Use existence of file extension to determine if builtin or file
-    if op.splitext(heuristic)[1]:
-        if not heuristic.startswith('/'):
-            heuristic = op.join(op.dirname(bids_dir), heuristic)
-
-        if not op.isfile(heuristic):
-            raise ValueError('Heuristic file specified in config files must be '
-                             'an existing file.')
-        scratch_heuristic = op.join(scan_work_dir, 'heuristic.py')
-        shutil.copyfile(heuristic, scratch_heuristic)
-    else:
-        scratch_heuristic = heuristic
-
-    # Copy singularity images to scratch
-    scratch_bidsifier = op.join(scan_work_dir, op.basename(bidsifier_file))
-    scratch_mriqc = op.join(scan_work_dir, op.basename(mriqc_file))
-
-    if not op.isfile(scratch_bidsifier):
-        shutil.copyfile(bidsifier_file, scratch_bidsifier)
-        os.chmod(scratch_bidsifier, 0o775)
-
-    if not op.isfile(scratch_mriqc):
-        shutil.copyfile(mriqc_file, scratch_mriqc)
-        os.chmod(scratch_mriqc, 0o775)
-
-    mriqc_work_dir = op.join(scan_work_dir, 'work')
-
-    # Copy tar file to work_dir
-    work_tar_file = op.join(scan_work_dir, 'sub-{0}.tar'.format(sub))
-    if ses:  # If session is specified, replace .tar and add -ses-<session>.tar
-        work_tar_file = work_tar_file.replace(
-            '.tar', '-ses-{0}.tar'.format(ses))
-    shutil.copyfile(tarball, work_tar_file)
-
-    # Run BIDSifier
-    cmd = ('{sing} -d {input} --heuristic {heur} --sub {sub} '
-           '--ses {ses} -o {outdir} -w {workdir} {datalad_flag}'.format(
-               sing=scratch_bidsifier, input=work_tar_file,
-               heur=scratch_heuristic,
-               sub=sub, ses=ses, outdir=bids_dir, workdir=scan_work_dir,
-               datalad_flag='--datalad' if datalad else ''))
-    run(cmd)
-
-    # Check if BIDSification ran successfully
-    bids_successful = False
-    with open(op.join(scan_work_dir, 'validator.txt'), 'r') as fo:
-        validator_result = fo.read()
-
-    if 'This dataset appears to be BIDS compatible' in validator_result:
-        bids_successful = True
-
-    if not bids_successful:
-        raise RuntimeError('Heudiconv-generated dataset failed BIDS validator. '
-                           'Not running MRIQC')
-
-    # MRIQC time
-    if not op.isdir(mriqc_out_dir):
-        os.makedirs(mriqc_out_dir)
-
-    if not op.isdir(op.join(work_dir, 'templateflow')):
-        shutil.copytree('/home/data/cis/templateflow', op.join(work_dir, 'templateflow'))
-
-    username = getpass.getuser()
-    templateflow_dir = op.join('/home', username, '.cache/templateflow')
-    if not op.isdir(templateflow_dir):
-        os.makedirs(templateflow_dir)
-
-    run_mriqc(bids_dir=bids_dir, templateflow_dir=templateflow_dir,
-              mriqc_singularity=scratch_mriqc, work_dir=mriqc_work_dir,
-              out_dir=mriqc_out_dir,
-              mriqc_config=config_options['mriqc_settings'],
-              sub=sub, ses=ses)
-
-    # Finally, clean up working directory *if successful*
-    shutil.rmtree(scan_work_dir)
+    tracer = Tracer('conversion', op.dirname(bids_dir), sub=sub, ses=ses,
+                    job_stage=stage)
+    try:
+        # Markers left by a failed run let a rerun skip completed stages
+        checkpoints = Checkpoints(scan_work_dir, resume=resume, force=force_stage)
+
+        # Make folders/files. The claim keeps the work dir from being evicted
+        # while this job runs.
+        claim_work_dir(scan_work_dir)
+        if not op.isdir(scan_work_dir):
+            os.makedirs(scan_work_dir)
+
+        # Make room for the job before staging anything
+        with tracer.span('scratch_admission') as span:
+            images = []
+            if stage in ('all', 'bidsify'):
+                images.append(bidsifier_file)
+            if stage in ('all', 'mriqc'):
+                images.append(mriqc_file)
+            footprint = estimate_footprint(
+                tarball if stage in ('all', 'bidsify') else None,
+                strategy=config_options.get('staging', 'auto'), images=images,
+                cache_dir=config_options.get('image_cache_dir'),
+                mriqc_gb=(0 if stage == 'bidsify' else
+                          config_options.get('mriqc_scratch_gb', MRIQC_SCRATCH_GB)))
+            span['bytes'] = footprint
+            span['freed'] = ensure_space(
+                footprint, scan_work_dir,
+                quota_gb=config_options.get('scratch_quota_gb'),
+                reserve_gb=config_options.get('scratch_reserve_gb', 0),
+                cache_dir=config_options.get('image_cache_dir'))
+
+        if not op.isdir(bids_dir):
+            os.makedirs(bids_dir)
+
+        # Change directory to parent folder of bids_dir to give Singularity images
+        # access to relevant directories.
+        os.chdir(op.dirname(bids_dir))
+
+        if stage in ('all', 'bidsify'):
+            # Additional checks and copying for heuristic file
+            heuristic = config_options['heuristic']
+
+            # Heuristic may be file (absolute or relative path) or heudiconv builtin
+            # Use existence of file extension to determine if builtin or file
+            if op.splitext(heuristic)[1]:
+                if not heuristic.startswith('/'):
+                    heuristic = op.join(op.dirname(bids_dir), heuristic)
+
+                if not op.isfile(heuristic):
+                    raise ValueError('Heuristic file specified in config files must be '
+                                     'an existing file.')
+                scratch_heuristic = op.join(scan_work_dir, 'heuristic.py')
+                shutil.copyfile(heuristic, scratch_heuristic)
+                # Rule-table heuristics import the engine from their own folder
+                rule_table = op.join(op.dirname(heuristic), 'rule_table.py')
+                if not op.isfile(rule_table):
+                    rule_table = RULE_TABLE
+                shutil.copyfile(rule_table,
+                                op.join(scan_work_dir, 'rule_table.py'))
+            else:
+                scratch_heuristic = heuristic
+                rule_table = None
+
+            # Get the BIDSifier image from the shared scratch cache
+            with tracer.span('get_bidsifier_image'):
+                scratch_bidsifier = get_image(
+                    bidsifier_file,
+                    cache_dir=config_options.get('image_cache_dir'),
+                    max_size_gb=config_options.get('image_cache_size_gb'))
+
+            # Stage tar file in work_dir with the cheapest available strategy
+            work_tar_file = op.join(scan_work_dir, 'sub-{0}.tar'.format(sub))
+            if ses:  # If session is specified, replace .tar and add -ses-<session>.tar
+                work_tar_file = work_tar_file.replace(
+                    '.tar', '-ses-{0}.tar'.format(ses))
+            archive_options = get_archive_options(config_options)
+            staging_strategy = config_options.get('staging', 'auto')
+            staging_fingerprint = fingerprint(
+                file_fingerprint(tarball), work_tar_file, staging_strategy)
+            staged = checkpoints.completed('staging', staging_fingerprint)
+            if staged is not None and (staged['strategy'] == 'bind'
+                                       or op.exists(staged['input'])):
+                staged_input, staging_env = staged['input'], staged['env']
+            else:
+                with tracer.span('stage_tarball') as span:
+                    staged_input, strategy, staging_env = stage_archive(
+                        tarball, work_tar_file, strategy=staging_strategy,
+                        threads=archive_options['threads'])
+                    span['strategy'] = strategy
+                    span['bytes'] = (0 if strategy in ('bind', 'hardlink', 'reflink')
+                                     else op.getsize(tarball))
+                checkpoints.mark('staging', staging_fingerprint,
+                                 input=staged_input, strategy=strategy,
+                                 env=staging_env)
+
+            # The BIDSifier writes to a staging dataset in scratch, which is
+            # merged into the main dataset afterwards. BIDSification is redone
+            # whenever staging was, or if the session's BIDS data have since been
+            # removed from both.
+            # The heuristic is fingerprinted at its source, since the scratch
+            # copies are rewritten on every run
+            bidsify_fingerprint = fingerprint(
+                checkpoints.token('staging'), file_fingerprint(bidsifier_file),
+                file_fingerprint(heuristic),
+                file_fingerprint(rule_table) if rule_table else None,
+                sub, ses, bids_dir)
+            bids_staging_dir = op.join(scan_work_dir, 'bids')
+            bids_ses_dir = session_units(sub, ses)[0]
+            if (checkpoints.completed('bidsify', bidsify_fingerprint) is None
+                    or not (op.isdir(op.join(bids_staging_dir, bids_ses_dir))
+                            or op.isdir(op.join(bids_dir, bids_ses_dir)))):
+                if op.isdir(bids_staging_dir):
+                    shutil.rmtree(bids_staging_dir)
+                os.makedirs(bids_staging_dir)
+                # Run BIDSifier
+                cmd = ('{sing} -d {input} --heuristic {heur} --sub {sub} '
+                       '--ses {ses} -o {outdir} -w {workdir}'.format(
+                           sing=scratch_bidsifier, input=staged_input,
+                           heur=scratch_heuristic, sub=sub, ses=ses,
+                           outdir=bids_staging_dir, workdir=scan_work_dir))
+                with tracer.span('bidsify') as span:
+                    span['result'] = run(cmd, env=staging_env)
+
+                # Check if BIDSification ran successfully
+                with tracer.span('validator_check'):
+                    bids_successful = False
+                    with open(op.join(scan_work_dir, 'validator.txt'), 'r') as fo:
+                        validator_result = fo.read()
+
+                    if 'This dataset appears to be BIDS compatible' in validator_result:
+                        bids_successful = True
+
+                    if not bids_successful:
+                        raise RuntimeError('Heudiconv-generated dataset failed BIDS '
+                                           'validator. Not running MRIQC')
+                checkpoints.mark('bidsify', bidsify_fingerprint)
+
+            # Merge the session into the main dataset, unless a previous run
+            # already did
+            if op.isdir(bids_staging_dir):
+                with tracer.span('bids_merge') as span:
+                    # Datalad saves are batched across sessions if the config
+                    # has a "datalad_batch" field (true, or count and age
+                    # thresholds)
+                    batch = config_options.get('datalad_batch')
+                    span['files'] = len(merge_session(
+                        bids_staging_dir, bids_dir, sub, ses, datalad=datalad,
+                        message='Add sub-{0} ses-{1} from {2}'.format(
+                            sub, ses, op.basename(tarball)),
+                        batch={} if batch is True else batch or None))
+
+        if stage == 'bidsify':
+            # The MRIQC stage runs as a separate job
+            with tracer.span('cleanup'):
+                release_work_dir(scan_work_dir, remove=True)
+            return
+
+        # MRIQC time
+        with tracer.span('get_mriqc_image'):
+            scratch_mriqc = get_image(
+                mriqc_file,
+                cache_dir=config_options.get('image_cache_dir'),
+                max_size_gb=config_options.get('image_cache_size_gb'))
+        mriqc_work_dir = op.join(scan_work_dir, 'work')
+
+        if not op.isdir(mriqc_out_dir):
+            os.makedirs(mriqc_out_dir)
+
+        # Templateflow is either bound read-only from its source or mirrored
+        # incrementally into scratch
+        if config_options.get('templateflow_mode', 'sync') == 'bind':
+            templateflow_dir = TEMPLATEFLOW_DIR
+        else:
+            templateflow_dir = op.join(work_dir, 'templateflow')
+            with tracer.span('templateflow_sync') as span:
+                n_copied = sync_tree(TEMPLATEFLOW_DIR, templateflow_dir)
+                span['files'] = n_copied
+            print('Synced templateflow to {0} ({1} files copied).'.format(
+                templateflow_dir, n_copied))
+
+        run_mriqc(bids_dir=bids_dir, templateflow_dir=templateflow_dir,
+                  templateflow_readonly=templateflow_dir == TEMPLATEFLOW_DIR,
+                  mriqc_singularity=scratch_mriqc, work_dir=mriqc_work_dir,
+                  out_dir=mriqc_out_dir,
+                  mriqc_config=config_options['mriqc_settings'],
+                  sub=sub, ses=ses, tracer=tracer, checkpoints=checkpoints)
+
+        # Finally, clean up working directory *if successful*
+        with tracer.span('cleanup'):
+            release_work_dir(scan_work_dir, remove=True)
+    finally:
+        tracer.close()
 
 
 def _main(argv=None):
@@ -0,0 +1,299 @@
+"""Incrementally aggregate participant-level MRIQC IQMs into group outputs.
+
+MRIQC's group level rereads every participant's IQM JSON each time it runs.
+Instead, a group table holding each JSON's IQMs, size and modification time
+is kept next to the derivatives. Only new or changed JSONs are read, runs
+whose JSONs were removed are dropped, and the group CSV and reports are
+rewritten from the table only when something changed.
+
+Run this module on an MRIQC derivatives folder to update its group outputs::
+
+    python group_iqms.py /path/to/bids/derivatives/mriqc-0.15.1
+"""
+import os
+import os.path as op
+import json
+import fcntl
+import argparse
+import datetime
+import statistics
+from collections import OrderedDict
+
+GROUP_TABLE = '.group_iqms.json'
+MODALITIES = ('bold', 'T1w', 'T2w')
+# Nested metadata that MRIQC leaves out of its group tables
+SKIP_FIELDS = ('bids_meta', 'provenance')
+
+
+def find_iqm_files(deriv_dir):
+    """List the participant IQM JSONs in an MRIQC derivatives folder.
+
+    Returns
+    -------
+    iqm_files : dict
+        [size, mtime_ns] keyed by JSON path relative to deriv_dir.
+    """
+    iqm_files = {}
+    stack = [e.path for e in os.scandir(deriv_dir)
+             if e.is_dir() and e.name.startswith('sub-')]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif (entry.name.endswith('.json')
+                      and _get_modality(entry.name) in MODALITIES):
+                    stat = entry.stat()
+                    iqm_files[op.relpath(entry.path, deriv_dir)] = [
+                        stat.st_size, stat.st_mtime_ns]
+    return iqm_files
+
+
+def _get_modality(fname):
+    return fname[:-len('.json')].split('_')[-1]
+
+
+def _flatten(iqms, prefix=''):
+    flat = OrderedDict()
+    for key in sorted(iqms):
+        if not prefix and key in SKIP_FIELDS:
+            continue
+        value = iqms[key]
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix + key + '_'))
+        elif not isinstance(value, list):
+            flat[prefix + key] = value
+    return flat
+
+
+def _load_table(table_file):
+    if not op.isfile(table_file):
+        return {}
+    with open(table_file, 'r') as fo:
+        return json.load(fo)
+
+
+def update_group_table(deriv_dir):
+    """Bring the group table up to date with the participant IQM JSONs.
+
+    Parameters
+    ----------
+    deriv_dir : str
+        MRIQC derivatives folder.
+
+    Returns
+    -------
+    table : dict
+        IQMs of every run, keyed by JSON path relative to deriv_dir.
+    changed : set of str
+        Modalities with new, changed or removed runs.
+    """
+    table_file = op.join(deriv_dir, GROUP_TABLE)
+    with open(table_file + '.lock', 'a') as lock_fo:
+        fcntl.flock(lock_fo, fcntl.LOCK_EX)
+        table = _load_table(table_file)
+        iqm_files = find_iqm_files(deriv_dir)
+
+        changed = set()
+        for rel_path in set(table) - set(iqm_files):
+            changed.add(table.pop(rel_path)['modality'])
+
+        n_read = 0
+        for rel_path, stat in iqm_files.items():
+            entry = table.get(rel_path)
+            if entry is not None and entry['stat'] == stat:
+                continue
+            with open(op.join(deriv_dir, rel_path), 'r') as fo:
+                iqms = json.load(fo)
+            fname = op.basename(rel_path)
+            table[rel_path] = {'stat': stat,
+                               'modality': _get_modality(fname),
+                               'bids_name': fname[:-len('.json')],
+                               'iqms': _flatten(iqms)}
+            changed.add(table[rel_path]['modality'])
+            n_read += 1
+
+        if changed:
+            tmp_file = '{0}.tmp-{1}'.format(table_file, os.getpid())
+            with open(tmp_file, 'w') as fo:
+                json.dump(table, fo)
+            os.replace(tmp_file, table_file)
+    print('Read {0} new or changed IQM files ({1} runs in total).'.format(
+        n_read, len(table)))
+    return table, changed
+
+
+def _get_rows(table, modality):
+    rows = sorted((entry for entry in table.values()
+                   if entry['modality'] == modality),
+                  key=lambda entry: entry['bids_name'])
+    columns = sorted(set(k for entry in rows for k in entry['iqms']))
+    return rows, columns
+
+
+def _format(value):
+    if value is None:
+        return ''
+    return str(value)
+
+
+def write_group_csv(table, modality, out_file):
+    """Write one modality's IQMs as an MRIQC-style group CSV."""
+    rows, columns = _get_rows(table, modality)
+    tmp_file = '{0}.tmp-{1}'.format(out_file, os.getpid())
+    with open(tmp_file, 'w') as fo:
+        fo.write(','.join(['bids_name'] + columns) + '\n')
+        for entry in rows:
+            fo.write(','.join([entry['bids_name']]
+                              + [_format(entry['iqms'].get(c))
+                                 for c in columns]) + '\n')
+    os.replace(tmp_file, out_file)
+
+
+def _summarize(rows, columns):
+    """Summary statistics and Tukey fences for each numeric IQM."""
+    summary = OrderedDict()
+    for column in columns:
+        values = sorted(entry['iqms'][column] for entry in rows
+                        if isinstance(entry['iqms'].get(column), (int, float))
+                        and not isinstance(entry['iqms'][column], bool))
+        if len(values) < 2:
+            continue
+        q1, median, q3 = statistics.quantiles(values, n=4)
+        iqr = q3 - q1
+        summary[column] = OrderedDict([
+            ('n', len(values)), ('mean', statistics.mean(values)),
+            ('sd', statistics.stdev(values)), ('median', median),
+            ('low', q1 - 1.5 * iqr), ('high', q3 + 1.5 * iqr)])
+    return summary
+
+
+def _html(title, sections):
+    """Render (heading, header, rows) tables as an HTML page.
+
+    Cells given as 1-tuples are highlighted as outliers.
+    """
+    lines = ['<html><head><meta charset="utf-8"><title>{0}</title>'
+             '<style>td, th {{padding: 2px 6px; text-align: right}} '
+             '.outlier {{background: #f4cccc}}</style></head><body>'.format(
+                 title),
+             '<h1>{0}</h1>'.format(title),
+             '<p>Generated {0}</p>'.format(
+                 datetime.datetime.now().strftime('%Y-%m-%d %H:%M'))]
+    for heading, header, rows in sections:
+        lines.append('<h2>{0}</h2>'.format(heading))
+        lines.append('<table><tr>{0}</tr>'.format(
+            ''.join('<th>{0}</th>'.format(h) for h in header)))
+        for row in rows:
+            lines.append('<tr>{0}</tr>'.format(''.join(
+                '<td class="outlier">{0}</td>'.format(v[0])
+                if isinstance(v, tuple) else '<td>{0}</td>'.format(v)
+                for v in row)))
+        lines.append('</table>')
+    lines.append('</body></html>')
+    return '\n'.join(lines) + '\n'
+
+
+def write_group_reports(table, modality, reports_dir, project=None):
+    """Write one modality's group reports.
+
+    <modality>.html lists every run's IQMs, with values outside the Tukey
+    fences (1.5 IQRs beyond the quartiles) highlighted. <modality>_group.html
+    summarizes each IQM and lists the runs with outlying values.
+    """
+    rows, columns = _get_rows(table, modality)
+    summary = _summarize(rows, columns)
+    title = '{0}{1} group report'.format(
+        '{0} '.format(project) if project else '', modality)
+
+    def _is_outlier(column, value):
+        stats = summary.get(column)
+        return (stats is not None and isinstance(value, (int, float))
+                and not stats['low'] <= value <= stats['high'])
+
+    run_rows = []
+    outliers = []
+    for entry in rows:
+        row = [entry['bids_name']]
+        flagged = []
+        for column in columns:
+            value = entry['iqms'].get(column)
+            if _is_outlier(column, value):
+                row.append((_format(value),))
+                flagged.append(column)
+            else:
+                row.append(_format(value))
+        run_rows.append(row)
+        if flagged:
+            outliers.append([entry['bids_name'], ', '.join(flagged)])
+
+    summary_rows = [[column] + [_format(v) for v in stats.values()]
+                    for column, stats in summary.items()]
+    reports = {
+        modality + '.html': _html(title, [
+            ('IQMs', ['bids_name'] + columns, run_rows)]),
+        modality + '_group.html': _html(title, [
+            ('Summary', ['IQM', 'n', 'mean', 'sd', 'median', 'low fence',
+                         'high fence'], summary_rows),
+            ('Outlying runs', ['bids_name', 'IQMs'], outliers)]),
+    }
+    if not op.isdir(reports_dir):
+        os.makedirs(reports_dir, exist_ok=True)
+    for name, html in reports.items():
+        out_file = op.join(reports_dir, name)
+        tmp_file = '{0}.tmp-{1}'.format(out_file, os.getpid())
+        with open(tmp_file, 'w') as fo:
+            fo.write(html)
+        os.replace(tmp_file, out_file)
+
+
+def aggregate(deriv_dir, project=None):
+    """Update the group CSVs and reports of an MRIQC derivatives folder.
+
+    Parameters
+    ----------
+    deriv_dir : str
+        MRIQC derivatives folder.
+    project : str or None, optional
+        Project name, used in report titles. Default is None.
+
+    Returns
+    -------
+    changed : list of str
+        Modalities whose group outputs were rewritten.
+    """
+    table, changed = update_group_table(deriv_dir)
+    modalities = set(entry['modality'] for entry in table.values())
+    updated = []
+    for modality in MODALITIES:
+        if modality not in modalities:
+            continue
+        out_csv = op.join(deriv_dir, modality + '.csv')
+        reports_dir = op.join(deriv_dir, 'reports')
+        if modality not in changed and op.isfile(out_csv) and op.isfile(
+                op.join(reports_dir, modality + '_group.html')):
+            continue
+        write_group_csv(table, modality, out_csv)
+        write_group_reports(table, modality, reports_dir, project=project)
+        updated.append(modality)
+    return updated
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Incrementally update MRIQC group CSVs and reports.')
+    parser.add_argument('deriv_dir', help='MRIQC derivatives folder.')
+    parser.add_argument('--project', default=None,
+                        help='Project name, used in report titles.')
+    return parser
+
+
+def _main(argv=None):
+    options = _get_parser().parse_args(argv)
+    updated = aggregate(**vars(options))
+    print('Updated group outputs for {0}.'.format(
+        ', '.join(updated) if updated else 'no modalities'))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,202 @@
+"""
+Declarative rule tables for heudiconv heuristics.
+
+A heuristic is a list of rules, checked in order like an if/elif chain: each
+series goes to the first rule whose protocol name test and dimension
+predicates all pass. Rules are compiled once. Suffix tests are looked up in a
+dictionary keyed by suffix (one lookup per distinct suffix length), so the
+cost per series does not grow with the number of rules, and only the few
+substring tests are scanned.
+
+A heuristic file then only needs its keys and a table::
+
+    import os.path as op
+    import sys
+    sys.path.insert(0, op.dirname(op.abspath(__file__)))
+    from rule_table import create_key, rule, fieldmap_rule, RuleTable
+
+    t1 = create_key('sub-{subject}/{session}/anat/sub-{subject}_{session}_T1w')
+    rules = RuleTable([rule(t1, endswith='T1w_MPR_vNav', dim3=176)])
+    infotodict = rules.infotodict
+
+The heuristic is copied to the working directory before conversion, so this
+file is copied next to it.
+"""
+from collections import OrderedDict
+
+# Fields of heudiconv's SeqInfo used by the rules
+SERIES_ID = 2
+DIM3 = 8
+DIM4 = 9
+PROTOCOL_NAME = 12
+APPEND, REPLACE, FIELDMAP = range(3)
+_UNSEEN = object()
+
+
+def create_key(template, outtype=('nii.gz',), annotation_classes=None):
+    if template is None or not template:
+        raise ValueError('Template must be a valid format string')
+    return template, outtype, annotation_classes
+
+
+def rule(key, endswith=None, contains=None, dim3=None, dim4=None,
+         replace=False, as_int=False):
+    """Define a rule assigning matching series to a key.
+
+    Parameters
+    ----------
+    key : tuple
+        Key made with create_key.
+    endswith, contains : str or None, optional
+        The protocol name must end with, or contain, this string. Exactly one
+        must be given.
+    dim3, dim4 : int, callable or None, optional
+        Required number of slices and volumes, or a predicate on them.
+        Default is None (any).
+    replace : bool, optional
+        Whether a match replaces earlier matches for the key instead of being
+        appended (e.g., to keep only the last T1w). Default is False.
+    as_int : bool, optional
+        Whether to record the series ID as an int. Default is False.
+    """
+    if (endswith is None) == (contains is None):
+        raise ValueError('Exactly one of "endswith" and "contains" must be '
+                         'given.')
+    return {'key': key, 'endswith': endswith, 'contains': contains,
+            'dims': [(field, test) for field, test in ((DIM3, dim3),
+                                                       (DIM4, dim4))
+                     if test is not None],
+            'replace': replace, 'as_int': as_int, 'fieldmap': None}
+
+
+def fieldmap_rule(func_key, dwi_key, contains='DistortionMap',
+                  directions=('PA', 'AP', 'RL', 'LR'), with_acq=True):
+    """Define a rule for spin-echo field maps.
+
+    The phase encoding direction comes from the protocol name's
+    "<contains>_<direction>" suffix. A field map goes to dwi_key when one of
+    the next two series is a dMRI and the next one is not an fMRI, and to
+    func_key otherwise. A field map that is the last series is skipped.
+
+    Parameters
+    ----------
+    func_key, dwi_key : tuple
+        Keys made with create_key.
+    contains : str, optional
+        Protocol name substring identifying field maps.
+    directions : tuple of str, optional
+        Supported phase encoding directions. Others raise a ValueError.
+    with_acq : bool, optional
+        Whether to add an "acq" field ("func" or "dwi") to each item.
+    """
+    fieldmap = rule(None, contains=contains)
+    fieldmap['fieldmap'] = {
+        'func': func_key, 'dwi': dwi_key, 'with_acq': with_acq,
+        'suffixes': OrderedDict(('{0}_{1}'.format(contains, d), d)
+                                for d in directions)}
+    return fieldmap
+
+
+class RuleTable(object):
+    """A compiled, ordered rule table.
+
+    Parameters
+    ----------
+    rules : list of dict
+        Rules made with rule and fieldmap_rule, in priority order.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.keys = []
+        for rule_ in rules:
+            keys = ([rule_['fieldmap']['func'], rule_['fieldmap']['dwi']]
+                    if rule_['fieldmap'] else [rule_['key']])
+            self.keys += [k for k in keys if k not in self.keys]
+
+        # Rule indices keyed by suffix, and the suffix lengths to try
+        self.suffixes = {}
+        for i, rule_ in enumerate(rules):
+            if rule_['endswith'] is not None:
+                self.suffixes.setdefault(rule_['endswith'], []).append(i)
+        self.suffix_lengths = sorted(set(len(s) for s in self.suffixes))
+        self.substrings = [(i, rule_['contains'])
+                           for i, rule_ in enumerate(rules)
+                           if rule_['contains'] is not None]
+        self._cache = {}
+
+    def candidates(self, protocol_name):
+        """Rules whose name test passes, in priority order."""
+        indices = []
+        for length in self.suffix_lengths:
+            indices += self.suffixes.get(protocol_name[-length:], [])
+        indices += [i for i, substring in self.substrings
+                    if substring in protocol_name]
+        return [self.rules[i] for i in sorted(indices)]
+
+    def match(self, s):
+        """Return the first rule that matches a series, or None."""
+        for rule_ in self.candidates(s[PROTOCOL_NAME]):
+            if all(test(s[field]) if callable(test) else s[field] == test
+                   for field, test in rule_['dims']):
+                return rule_
+        return None
+
+    def _action(self, s):
+        """What to do with a series: (kind, key or field map, as_int)."""
+        rule_ = self.match(s)
+        if rule_ is None:
+            return None
+        if rule_['fieldmap']:
+            return (FIELDMAP, rule_['fieldmap'], False)
+        return (REPLACE if rule_['replace'] else APPEND, rule_['key'],
+                rule_['as_int'])
+
+    def _fieldmap_item(self, fieldmap, seqinfo, i):
+        s = seqinfo[i]
+        if i >= len(seqinfo) - 1:
+            return None, None
+        next_scan = seqinfo[i + 1]
+        next_next_scan = seqinfo[min(i + 2, len(seqinfo) - 1)]
+
+        for suffix, direction in fieldmap['suffixes'].items():
+            if s[PROTOCOL_NAME].endswith(suffix):
+                break
+        else:
+            raise ValueError('Fieldmap scan {0} not '
+                             'supported'.format(s[PROTOCOL_NAME]))
+
+        acq = 'func'
+        if ((next_scan[PROTOCOL_NAME].endswith('dMRI')
+                or next_next_scan[PROTOCOL_NAME].endswith('dMRI'))
+                and 'fMRI' not in next_scan[PROTOCOL_NAME]):
+            acq = 'dwi'
+        item = {'item': s[SERIES_ID], 'dir': direction}
+        if fieldmap['with_acq']:
+            item['acq'] = acq
+        return fieldmap[acq], item
+
+    def infotodict(self, seqinfo):
+        """Heuristic evaluator for determining which runs belong where."""
+        info = {key: [] for key in self.keys}
+        # Actions only depend on the protocol name and dimensions, which
+        # repeat across series and sessions, so they are memoized
+        cache = self._cache
+        for i, s in enumerate(seqinfo):
+            signature = (s[PROTOCOL_NAME], s[DIM3], s[DIM4])
+            action = cache.get(signature, _UNSEEN)
+            if action is _UNSEEN:
+                action = cache[signature] = self._action(s)
+            if action is None:
+                continue
+            kind, target, as_int = action
+            if kind == APPEND:
+                info[target].append(int(s[SERIES_ID]) if as_int
+                                    else s[SERIES_ID])
+            elif kind == REPLACE:
+                info[target] = [s[SERIES_ID]]
+            else:
+                key, item = self._fieldmap_item(target, seqinfo, i)
+                if key is not None:
+                    info[key].append(item)
+        return info
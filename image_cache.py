@@ -0,0 +1,182 @@
+"""A shared, concurrency-safe cache of Singularity images in scratch.
+
+Images are copied from the central image directory into a single cache in
+/scratch, keyed by image name, size and modification time, so every job on
+the cluster reuses the same copy instead of making its own.
+
+Jobs hold a shared lock on each cache entry they use for as long as they
+run. The lock is released by the operating system when the job exits (even
+if it crashes), so eviction can skip images that are in use without any
+bookkeeping files to clean up.
+"""
+import os
+import os.path as op
+import time
+import fcntl
+import shutil
+
+from utils import CIS_DIR
+
+CACHE_DIR = op.join(CIS_DIR, 'singularity-cache/')
+
+# Open lock files for the entries used by this process, keyed by image path.
+_HELD_LOCKS = {}
+
+
+def _entry_key(image_file):
+    """Build a cache key from an image's name, size and modification time."""
+    stat = os.stat(image_file)
+    return '{0}-{1}-{2}'.format(op.basename(image_file), stat.st_size,
+                                int(stat.st_mtime))
+
+
+def get_image(image_file, cache_dir=None, max_size_gb=None):
+    """Get a cached copy of a Singularity image, populating it if needed.
+
+    On a cache hit this only takes a shared lock and updates the entry's
+    access time. On a miss, one process copies the image to a temporary file
+    and renames it into place while the others wait on the lock.
+
+    Parameters
+    ----------
+    image_file : str
+        Path to the image in the central image directory.
+    cache_dir : str or None, optional
+        Cache directory. Default is CACHE_DIR.
+    max_size_gb : float or None, optional
+        If set, evict least recently used images after populating the cache
+        so that it stays below this size. Default is None.
+
+    Returns
+    -------
+    cached_file : str
+        Path to the cached image.
+    """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+
+    if not op.isfile(image_file):
+        raise ValueError('Image "{0}" must be an existing '
+                         'file.'.format(image_file))
+
+    key = _entry_key(image_file)
+    entry_dir = op.join(cache_dir, key)
+    cached_file = op.join(entry_dir, op.basename(image_file))
+    if cached_file in _HELD_LOCKS:
+        return cached_file
+
+    if not op.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    lock_fo = open(op.join(cache_dir, key + '.lock'), 'a')
+    fcntl.flock(lock_fo, fcntl.LOCK_SH)
+    populated = False
+    if not op.isfile(cached_file):
+        fcntl.flock(lock_fo, fcntl.LOCK_EX)
+        if not op.isfile(cached_file):
+            os.makedirs(entry_dir, exist_ok=True)
+            tmp_file = '{0}.tmp-{1}'.format(cached_file, os.getpid())
+            shutil.copyfile(image_file, tmp_file)
+            os.chmod(tmp_file, 0o775)
+            os.replace(tmp_file, cached_file)
+            populated = True
+        fcntl.flock(lock_fo, fcntl.LOCK_SH)
+    else:
+        os.utime(cached_file)
+
+    _HELD_LOCKS[cached_file] = lock_fo
+
+    if populated and max_size_gb is not None:
+        evict_images(cache_dir, max_size_gb)
+
+    return cached_file
+
+
+def release_image(cached_file):
+    """Release this process's hold on a cached image."""
+    lock_fo = _HELD_LOCKS.pop(cached_file, None)
+    if lock_fo is not None:
+        lock_fo.close()
+
+
+def list_entries(cache_dir=None):
+    """List cached images, least recently used first.
+
+    Returns
+    -------
+    entries : list of tuple
+        (last use time, size in bytes, entry key) for each cached image.
+    """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+
+    entries = []
+    if not op.isdir(cache_dir):
+        return entries
+
+    for key in os.listdir(cache_dir):
+        entry_dir = op.join(cache_dir, key)
+        if not op.isdir(entry_dir):
+            continue
+        for fname in os.listdir(entry_dir):
+            if '.tmp-' in fname:
+                continue
+            stat = os.stat(op.join(entry_dir, fname))
+            entries.append((stat.st_mtime, stat.st_size, key))
+    return sorted(entries)
+
+
+def evict_entry(cache_dir, key):
+    """Remove a cached image unless it is in use.
+
+    Returns
+    -------
+    evicted : bool
+        Whether the image was removed.
+    """
+    with open(op.join(cache_dir, key + '.lock'), 'a') as lock_fo:
+        try:
+            fcntl.flock(lock_fo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Image is in use by a running job
+            return False
+        if op.isdir(op.join(cache_dir, key)):
+            shutil.rmtree(op.join(cache_dir, key))
+    return True
+
+
+def evict_images(cache_dir=None, max_size_gb=0, min_age=0):
+    """Evict least recently used images that are not in use.
+
+    Parameters
+    ----------
+    cache_dir : str or None, optional
+        Cache directory. Default is CACHE_DIR.
+    max_size_gb : float, optional
+        Target cache size. Default is 0 (evict everything not in use).
+    min_age : float, optional
+        Never evict images used within this many seconds. Default is 0.
+
+    Returns
+    -------
+    freed : int
+        Number of bytes freed.
+    """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+
+    entries = list_entries(cache_dir)
+    total = sum(entry[1] for entry in entries)
+    max_bytes = max_size_gb * 1024 ** 3
+    freed = 0
+    now = time.time()
+    for last_used, size, key in entries:
+        if total <= max_bytes:
+            break
+        if now - last_used < min_age:
+            continue
+        if not evict_entry(cache_dir, key):
+            continue
+        total -= size
+        freed += size
+    return freed
@@ -0,0 +1,390 @@
+"""A SQLite store of MRIQC IQMs across projects and MRIQC versions.
+
+Each run is stored once, with its project, MRIQC version, modality and BIDS
+entities, and its IQMs are stored as one row per (run, IQM) with indexes on
+both, so queries across projects only touch the IQMs they ask for instead of
+re-parsing every project's CSV and JSON files. Missing values are stored as
+NULL and only replaced (e.g., by zeros for the MRIQC classifier, as
+utils.clean_csv does) when the store is queried or exported.
+
+Ingest an MRIQC derivatives folder (reading only new or changed IQM JSONs)
+or group CSVs, then export a classifier-ready CSV::
+
+    python iqm_store.py ingest --project myproj bids/derivatives/mriqc-0.15.1
+    python iqm_store.py export --modality T1w --fill 0 T1w_cleaned.csv
+"""
+import os
+import os.path as op
+import re
+import csv
+import math
+import sqlite3
+import argparse
+import datetime
+
+import group_iqms
+
+IQM_DB = os.environ.get('CIS_IQM_DB', '/home/data/cis/mriqc-iqms.sqlite')
+ENTITIES = ('sub', 'ses', 'task', 'run')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    project TEXT NOT NULL,
+    mriqc_version TEXT NOT NULL,
+    modality TEXT NOT NULL,
+    bids_name TEXT NOT NULL,
+    sub TEXT,
+    ses TEXT,
+    task TEXT,
+    run TEXT,
+    source TEXT,
+    stat TEXT,
+    ingested TEXT,
+    UNIQUE (project, mriqc_version, bids_name)
+);
+CREATE TABLE IF NOT EXISTS iqms (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (run_id, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS runs_modality
+    ON runs (modality, project, mriqc_version);
+CREATE INDEX IF NOT EXISTS iqms_name ON iqms (name, value);
+"""
+
+
+def connect(db_file=None):
+    """Open (and if needed, create) an IQM store."""
+    if db_file is None:
+        db_file = IQM_DB
+    db_dir = op.dirname(op.abspath(db_file))
+    if not op.isdir(db_dir):
+        os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(db_file, timeout=60)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def parse_entities(bids_name):
+    """Get the subject, session, task and run labels from a BIDS name."""
+    entities = dict(pair.split('-', 1) for pair in bids_name.split('_')
+                    if '-' in pair)
+    return [entities.get(entity) for entity in ENTITIES]
+
+
+def _to_value(value):
+    """Convert an IQM to a float, with missing values and NaNs as None."""
+    if value is None or value == '' or isinstance(value, bool):
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(value) else value
+
+
+def _is_iqm(value):
+    """Whether a value is an IQM, rather than metadata such as a label."""
+    if isinstance(value, str) and value != '':
+        try:
+            float(value)
+        except ValueError:
+            return False
+    return True
+
+
+def _store_runs(conn, project, mriqc_version, records, source):
+    """Insert or replace runs, given as (bids_name, modality, stat, iqms).
+
+    Runs whose stored stat matches are left alone.
+
+    Returns
+    -------
+    n_stored : int
+        Number of runs inserted or replaced.
+    """
+    now = datetime.datetime.now().isoformat()
+    n_stored = 0
+    for bids_name, modality, stat, iqms in records:
+        existing = conn.execute(
+            'SELECT run_id, stat FROM runs WHERE project = ? AND '
+            'mriqc_version = ? AND bids_name = ?',
+            (project, mriqc_version, bids_name)).fetchone()
+        if existing is not None:
+            if stat is not None and existing[1] == stat:
+                continue
+            conn.execute('DELETE FROM iqms WHERE run_id = ?', (existing[0],))
+            conn.execute('DELETE FROM runs WHERE run_id = ?', (existing[0],))
+        run_id = conn.execute(
+            'INSERT INTO runs (project, mriqc_version, modality, bids_name, '
+            'sub, ses, task, run, source, stat, ingested) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [project, mriqc_version, modality, bids_name]
+            + parse_entities(bids_name) + [source, stat, now]).lastrowid
+        conn.executemany(
+            'INSERT INTO iqms (run_id, name, value) VALUES (?, ?, ?)',
+            ((run_id, name, _to_value(value)) for name, value in iqms.items()
+             if _is_iqm(value)))
+        n_stored += 1
+    return n_stored
+
+
+def _chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def ingest_csv(conn, csv_file, project, mriqc_version, modality=None,
+               chunk_size=1000):
+    """Ingest an MRIQC group CSV in chunks.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Store opened with connect.
+    csv_file : str
+        Group CSV with a "bids_name" column (e.g., T1w.csv).
+    project, mriqc_version : str
+        Project and MRIQC version the IQMs belong to.
+    modality : str or None, optional
+        Modality of the runs. Default is the CSV's file name (e.g., "T1w").
+    chunk_size : int, optional
+        Number of runs committed at once. Default is 1000.
+
+    Returns
+    -------
+    n_stored : int
+        Number of runs inserted or replaced.
+    """
+    if modality is None:
+        modality = op.splitext(op.basename(csv_file))[0].split('_')[0]
+    n_stored = 0
+    with open(csv_file, 'r', newline='') as fo:
+        rows = ((row.pop('bids_name'), modality, None, row)
+                for row in csv.DictReader(fo))
+        for chunk in _chunks(rows, chunk_size):
+            with conn:
+                n_stored += _store_runs(conn, project, mriqc_version, chunk,
+                                        op.abspath(csv_file))
+    return n_stored
+
+
+def ingest_derivatives(conn, deriv_dir, project, mriqc_version=None,
+                       chunk_size=1000):
+    """Ingest the participant IQMs of an MRIQC derivatives folder.
+
+    The folder's group table (see group_iqms) is brought up to date first,
+    so only new or changed IQM JSONs are read, and only runs whose JSON
+    changed since the last ingestion are written. Runs whose JSONs were
+    removed are dropped from the store.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Store opened with connect.
+    deriv_dir : str
+        MRIQC derivatives folder (e.g., derivatives/mriqc-0.15.1).
+    project : str
+        Project the IQMs belong to.
+    mriqc_version : str or None, optional
+        MRIQC version. Default is taken from the folder's name.
+    chunk_size : int, optional
+        Number of runs committed at once. Default is 1000.
+
+    Returns
+    -------
+    n_stored : int
+        Number of runs inserted or replaced.
+    """
+    if mriqc_version is None:
+        match = re.search(r'mriqc-([\d.]*\d)', op.basename(op.abspath(
+            deriv_dir)))
+        if not match:
+            raise ValueError('MRIQC version could not be determined from '
+                             '{0}.'.format(deriv_dir))
+        mriqc_version = match.group(1)
+
+    table, _ = group_iqms.update_group_table(deriv_dir)
+    source = op.abspath(deriv_dir)
+    records = ((entry['bids_name'], entry['modality'],
+                '{0}:{1}'.format(*entry['stat']), entry['iqms'])
+               for entry in table.values())
+    n_stored = 0
+    for chunk in _chunks(records, chunk_size):
+        with conn:
+            n_stored += _store_runs(conn, project, mriqc_version, chunk,
+                                    source)
+
+    current = set(entry['bids_name'] for entry in table.values())
+    with conn:
+        for run_id, bids_name in conn.execute(
+                'SELECT run_id, bids_name FROM runs WHERE project = ? AND '
+                'mriqc_version = ? AND source = ?',
+                (project, mriqc_version, source)).fetchall():
+            if bids_name not in current:
+                conn.execute('DELETE FROM iqms WHERE run_id = ?', (run_id,))
+                conn.execute('DELETE FROM runs WHERE run_id = ?', (run_id,))
+    return n_stored
+
+
+def query_iqms(conn, modality, projects=None, mriqc_versions=None, iqms=None,
+               fill_value=None):
+    """Read IQMs as a wide table, one row per run.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Store opened with connect.
+    modality : str
+        Modality (e.g., "T1w" or "bold").
+    projects, mriqc_versions : list of str or None, optional
+        Only return runs from these projects or MRIQC versions. Default is
+        all.
+    iqms : list of str or None, optional
+        IQMs to return. Default is all IQMs of the selected runs.
+    fill_value : float or None, optional
+        Value for missing IQMs (NULLs, NaNs and IQMs a run lacks). Use 0 for
+        the MRIQC classifier. Default is None (missing values are None).
+
+    Returns
+    -------
+    columns : list of str
+        Column names: project, mriqc_version, bids_name, the BIDS entities,
+        then the IQMs.
+    rows : generator of list
+        Rows, ordered by project, MRIQC version and BIDS name.
+    """
+    where = ['r.modality = ?']
+    params = [modality]
+    for column, values in (('r.project', projects),
+                           ('r.mriqc_version', mriqc_versions)):
+        if values:
+            where.append('{0} IN ({1})'.format(
+                column, ', '.join('?' * len(values))))
+            params += list(values)
+    where = ' AND '.join(where)
+
+    if iqms is None:
+        iqms = [name for name, in conn.execute(
+            'SELECT DISTINCT i.name FROM iqms i JOIN runs r '
+            'ON i.run_id = r.run_id WHERE {0} ORDER BY i.name'.format(where),
+            params)]
+    meta = ['project', 'mriqc_version', 'bids_name'] + list(ENTITIES)
+    columns = meta + list(iqms)
+
+    def _rows():
+        index = {name: i for i, name in enumerate(iqms)}
+        cursor = conn.execute(
+            'SELECT r.run_id, {0}, i.name, i.value FROM runs r '
+            'LEFT JOIN iqms i ON i.run_id = r.run_id '
+            'WHERE {1} ORDER BY r.project, r.mriqc_version, r.bids_name, '
+            'r.run_id'.format(', '.join('r.' + m for m in meta), where),
+            params)
+        current, row = None, None
+        for record in cursor:
+            if record[0] != current:
+                if row is not None:
+                    yield row
+                current = record[0]
+                row = list(record[1:len(meta) + 1]) + [fill_value] * len(iqms)
+            name, value = record[-2], record[-1]
+            if name in index and value is not None:
+                row[len(meta) + index[name]] = value
+        if row is not None:
+            yield row
+
+    return columns, _rows()
+
+
+def export_csv(conn, out_file, modality, projects=None, mriqc_versions=None,
+               iqms=None, fill_value=0):
+    """Export IQMs to a CSV, by default with missing values set to zero.
+
+    See query_iqms for the parameters.
+
+    Returns
+    -------
+    n_rows : int
+        Number of runs written.
+    """
+    columns, rows = query_iqms(conn, modality, projects=projects,
+                               mriqc_versions=mriqc_versions, iqms=iqms,
+                               fill_value=fill_value)
+    n_rows = 0
+    tmp_file = '{0}.tmp-{1}'.format(out_file, os.getpid())
+    with open(tmp_file, 'w', newline='') as fo:
+        writer = csv.writer(fo, lineterminator='\n')
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(['' if v is None else v for v in row])
+            n_rows += 1
+    os.replace(tmp_file, out_file)
+    return n_rows
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Store and query MRIQC IQMs across projects.')
+    parser.add_argument('--db', dest='db_file', default=None,
+                        help='SQLite store. Default is {0}.'.format(IQM_DB))
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    ingest = subparsers.add_parser(
+        'ingest', help='Ingest MRIQC derivatives folders or group CSVs.')
+    ingest.add_argument('paths', nargs='+',
+                        help='Derivatives folders or group CSV files.')
+    ingest.add_argument('--project', required=True,
+                        help='Project the IQMs belong to.')
+    ingest.add_argument('--mriqc_version', default=None,
+                        help='MRIQC version. Required for CSV files.')
+    ingest.add_argument('--chunk_size', type=int, default=1000,
+                        help='Number of runs committed at once.')
+
+    export = subparsers.add_parser(
+        'export', help='Export IQMs to a classifier-ready CSV.')
+    export.add_argument('out_file', help='Output CSV file.')
+    export.add_argument('--modality', required=True,
+                        help='Modality (e.g., T1w or bold).')
+    export.add_argument('--project', dest='projects', nargs='+',
+                        default=None, help='Projects to export.')
+    export.add_argument('--mriqc_version', dest='mriqc_versions', nargs='+',
+                        default=None, help='MRIQC versions to export.')
+    export.add_argument('--iqms', nargs='+', default=None,
+                        help='IQMs to export. Default is all.')
+    export.add_argument('--fill', dest='fill_value', type=float, default=0,
+                        help='Value for missing IQMs. Default is 0.')
+    return parser
+
+
+def _main(argv=None):
+    options = vars(_get_parser().parse_args(argv))
+    conn = connect(options.pop('db_file'))
+    command = options.pop('command')
+    if command == 'ingest':
+        n_stored = 0
+        for path in options.pop('paths'):
+            if op.isdir(path):
+                n_stored += ingest_derivatives(conn, path, **options)
+            else:
+                if options['mriqc_version'] is None:
+                    raise ValueError('Argument "mriqc_version" is required '
+                                     'to ingest CSV files.')
+                n_stored += ingest_csv(conn, path, **options)
+        print('Stored {0} runs.'.format(n_stored))
+    else:
+        n_rows = export_csv(conn, **options)
+        print('Exported {0} runs to {1}.'.format(n_rows, options['out_file']))
+    conn.close()
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,134 @@
+"""An append-only ledger of archived sessions (raw/scans.tsv).
+
+New sessions are added as single-row appends under a file lock
+(scans.tsv.lock), so updating the ledger costs the same no matter how many
+sessions it already holds.
+If a session is archived more than once, the most recent row wins. The
+compact function rewrites the ledger with one row per session.
+"""
+import os
+import os.path as op
+import fcntl
+import argparse
+from collections import OrderedDict
+
+SCANS_COLUMNS = ['sub', 'ses', 'file', 'creation']
+
+
+def read_scans(scans_file):
+    """Load the ledger into an index keyed by (sub, ses).
+
+    Parameters
+    ----------
+    scans_file : str
+        Path to the scans.tsv ledger. A missing file is treated as empty.
+
+    Returns
+    -------
+    index : collections.OrderedDict
+        Rows of the ledger, as dictionaries, keyed by (sub, ses).
+    """
+    index = OrderedDict()
+    if not op.isfile(scans_file):
+        return index
+
+    with open(scans_file, 'r') as fo:
+        header = fo.readline().rstrip('\n').split('\t')
+        for line in fo:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            row = dict(zip(header, line.split('\t')))
+            key = (row.get('sub'), row.get('ses'))
+            # Move re-archived sessions to the end, like a fresh append
+            index.pop(key, None)
+            index[key] = row
+    return index
+
+
+def append_scan(scans_file, row, index=None):
+    """Append one session to the ledger.
+
+    Parameters
+    ----------
+    scans_file : str
+        Path to the scans.tsv ledger. Created with a header if missing.
+    row : dict
+        Values for the new row, keyed by column name. Missing columns are
+        written as "n/a".
+    index : dict or None, optional
+        In-memory index from read_scans, updated in place. Default is None.
+    """
+    with open(scans_file + '.lock', 'a') as lock_fo:
+        fcntl.flock(lock_fo, fcntl.LOCK_EX)
+        # Opened once locked, in case compact_scans replaced the ledger
+        with open(scans_file, 'a+') as fo:
+            fo.seek(0)
+            header = fo.readline().rstrip('\n').split('\t')
+            if header == ['']:
+                header = SCANS_COLUMNS
+                fo.write('\t'.join(header) + '\n')
+            else:
+                # Guard against a final row without a trailing newline
+                fo.seek(0, os.SEEK_END)
+                fo.seek(fo.tell() - 1)
+                if fo.read(1) != '\n':
+                    fo.write('\n')
+            fo.write('\t'.join(str(row.get(col, 'n/a')) for col in header) + '\n')
+            fo.flush()
+            os.fsync(fo.fileno())
+
+    if index is not None:
+        key = (row.get('sub'), row.get('ses'))
+        index.pop(key, None)
+        index[key] = {col: str(row.get(col, 'n/a')) for col in header}
+
+
+def compact_scans(scans_file):
+    """Rewrite the ledger with only the most recent row for each session.
+
+    The compacted ledger is written to a temporary file and renamed into
+    place while holding the ledger's lock. The lock is a separate file, so
+    appends waiting on it open the new ledger once they get it.
+    """
+    with open(scans_file + '.lock', 'a') as lock_fo:
+        fcntl.flock(lock_fo, fcntl.LOCK_EX)
+        with open(scans_file, 'r') as fo:
+            header = fo.readline().rstrip('\n').split('\t')
+        index = read_scans(scans_file)
+        tmp_file = scans_file + '.tmp'
+        with open(tmp_file, 'w') as tmp_fo:
+            tmp_fo.write('\t'.join(header) + '\n')
+            for row in index.values():
+                tmp_fo.write('\t'.join(row.get(col, 'n/a')
+                                       for col in header) + '\n')
+        os.replace(tmp_file, scans_file)
+
+
+def write_processed_list(index, out_file):
+    """Write the archive names in the ledger, one per line.
+
+    This is the list of already-processed sessions given to the XNAT
+    downloader.
+    """
+    with open(out_file, 'w') as fo:
+        fo.write('file\n')
+        for row in index.values():
+            fo.write(row['file'] + '\n')
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Compact a scans.tsv ledger to one row per session.')
+    parser.add_argument('scans_file',
+                        help='Path to the scans.tsv file.')
+    return parser
+
+
+def _main(argv=None):
+    options = _get_parser().parse_args(argv)
+    compact_scans(options.scans_file)
+
+
+if __name__ == '__main__':
+    _main()
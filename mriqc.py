@@ -6,16 +6,122 @@ import os.path as op
 import re
 import json
 import shutil
+import hashlib
 import datetime
 from glob import glob
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from utils import run
+from utils import run, CIS_DIR, SCRATCH_DIR, SINGULARITY_DIR
+from image_cache import get_image
+from scratch import (claim_work_dir, release_work_dir, estimate_footprint,
+                     ensure_space, tree_size, MRIQC_SCRATCH_GB)
+from tracing import Tracer
+from tree_sync import build_manifest
+from checkpoint import Checkpoints, fingerprint
+import group_iqms
+import iqm_store
+
+CACHE_DIR = '.iqm_cache'
+GROUP_ENGINES = ('python', 'container')
+
+
+def _get_kwarg_str(settings_dict):
+    """Convert a dictionary of MRIQC settings to command-line arguments."""
+    kwarg_str = ''
+    for field in settings_dict.keys():
+        if isinstance(settings_dict[field], list):
+            val = ' '.join(settings_dict[field])
+        else:
+            val = settings_dict[field]
+        kwarg_str += '--{0} {1} '.format(field, val)
+    return kwarg_str.rstrip()
+
+
+def _find_inputs(bids_dir, sub, ses, folder, pattern):
+    """Find a session's NIfTI files for one modality or task."""
+    if ses:
+        prefix = 'sub-{sub}/ses-{ses}/{folder}/sub-{sub}_ses-{ses}_'.format(
+            sub=sub, ses=ses, folder=folder)
+    else:
+        prefix = 'sub-{sub}/{folder}/sub-{sub}_'.format(sub=sub,
+                                                        folder=folder)
+    return sorted(glob(op.join(bids_dir, prefix + pattern + '.nii'))
+                  + glob(op.join(bids_dir, prefix + pattern + '.nii.gz')))
+
+
+def _hash_file(in_file):
+    sha1 = hashlib.sha1()
+    with open(in_file, 'rb') as fo:
+        for chunk in iter(lambda: fo.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _expected_outputs(bids_dir, out_dir, in_file):
+    """MRIQC's IQM JSON and individual report for an input NIfTI file."""
+    name = op.basename(in_file).split('.nii')[0]
+    rel_dir = op.relpath(op.dirname(in_file), bids_dir)
+    return [op.join(out_dir, rel_dir, name + '.json'),
+            op.join(out_dir, name + '.html')]
+
+
+def _cache_record(out_dir, sub, ses, unit):
+    name = 'sub-{0}'.format(sub)
+    if ses:
+        name += '_ses-{0}'.format(ses)
+    return op.join(out_dir, CACHE_DIR, '{0}_{1}.json'.format(name, unit))
+
+
+def _check_cache(bids_dir, out_dir, record_file, in_files, image, kwarg_str):
+    """Look up one modality or task in the MRIQC result cache.
+
+    The cache key covers the content of the input NIfTI files, the MRIQC
+    image and the MRIQC settings. A cached result is only used while its
+    IQM JSON and report still exist.
+
+    Returns
+    -------
+    hit : bool
+        Whether the outputs are up to date.
+    cache_key : str
+        Key to record once the outputs are (re)generated.
+    """
+    cache_key = hashlib.sha1(json.dumps(
+        [[op.basename(f), _hash_file(f)] for f in in_files]
+        + [image, kwarg_str]).encode()).hexdigest()
+    if not in_files or not op.isfile(record_file):
+        return False, cache_key
+    with open(record_file, 'r') as fo:
+        record = json.load(fo)
+    hit = record['key'] == cache_key and all(
+        op.isfile(out_file) for in_file in in_files
+        for out_file in _expected_outputs(bids_dir, out_dir, in_file))
+    return hit, cache_key
+
+
+def _write_cache_record(record_file, cache_key, in_files):
+    record_dir = op.dirname(record_file)
+    if not op.isdir(record_dir):
+        os.makedirs(record_dir, exist_ok=True)
+    tmp_file = '{0}.tmp-{1}'.format(record_file, os.getpid())
+    with open(tmp_file, 'w') as fo:
+        json.dump({'key': cache_key,
+                   'inputs': [op.basename(f) for f in in_files],
+                   'created': datetime.datetime.now().isoformat()}, fo)
+    os.replace(tmp_file, record_file)
 
 
 def run_mriqc(bids_dir, templateflow_dir, mriqc_singularity, work_dir,
-              out_dir, mriqc_config, sub, ses=None):
+              out_dir, mriqc_config, sub, ses=None,
+              templateflow_readonly=False, tracer=None, checkpoints=None):
     """Run MRIQC.
 
+    Anatomical modalities and functional tasks with identical settings are
+    batched into single MRIQC calls. These calls are run concurrently,
+    splitting the n_procs budget between them. Each run gets its own working
+    directory, and a failed run does not stop the others.
+
     Parameters
     ----------
     bids_dir : str
@@ -29,51 +135,91 @@ def run_mriqc(bids_dir, templateflow_dir, mriqc_singularity, work_dir,
     mriqc_singularity : str
         Singularity image for MRIQC.
     mriqc_config : dict
-        Nested dictionary containing configuration information.
+        Nested dictionary containing configuration information. The optional
+        "max_procs_per_run" field caps the cores given to any one run,
+        "batch_runs" (default True) controls whether modalities and tasks
+        with identical settings share one MRIQC call, and
+        "startup_overhead" (seconds per MRIQC start-up) is used to report
+        the time saved by batching. Modalities and tasks whose outputs in
+        out_dir are up to date with their input NIfTI files, MRIQC image
+        and settings are skipped unless "cache" is False.
     sub : str
         Subject identifier.
     ses : str or None, optional
         Session identifier. Default is None.
+    templateflow_readonly : bool, optional
+        Whether to bind the templateflow directory read-only. Default is
+        False.
+    tracer : tracing.Tracer or None, optional
+        Tracer recording a span for each MRIQC call. Default is None.
+    checkpoints : checkpoint.Checkpoints or None, optional
+        Completion markers. MRIQC calls that already completed on the same
+        BIDS data, image and settings are skipped when resuming. Default is
+        None.
     """
+    if tracer is None:
+        tracer = Tracer(None)
+
+    if checkpoints is None:
+        checkpoints = Checkpoints(work_dir)
 
     if 'n_procs' not in mriqc_config.keys():
         n_procs = 1
     else:
         n_procs = int(mriqc_config['n_procs'])
 
-    # Run MRIQC anat
+    batch_runs = mriqc_config.get('batch_runs', True)
+    use_cache = (mriqc_config.get('cache', True)
+                 and not checkpoints.forced('mriqc'))
+    image = op.basename(mriqc_singularity)
+
+    # Collect MRIQC runs as (label, MRIQC arguments, cache records).
+    # Modalities and tasks with up-to-date results are skipped, and the
+    # rest are batched into a single MRIQC call when their settings are
+    # identical, so they share container start-up, BIDS indexing and
+    # template loading.
+    runs = []
+    n_unbatched = 0
+    hits, misses = [], []
+
+    def _lookup(unit, folder, pattern, kwarg_str):
+        in_files = _find_inputs(bids_dir, sub, ses, folder, pattern)
+        record_file = _cache_record(out_dir, sub, ses, unit)
+        hit, cache_key = _check_cache(bids_dir, out_dir, record_file,
+                                      in_files, image, kwarg_str)
+        if use_cache and hit:
+            hits.append(unit)
+            return None
+        misses.append(unit)
+        return (record_file, cache_key, in_files)
+
+    # MRIQC anat
     anat_config = mriqc_config['anat']
+    anat_groups = OrderedDict()
     for modality in anat_config.keys():
-        kwarg_str = ''
-        settings_dict = anat_config[modality]
-        for field in settings_dict.keys():
-            if isinstance(settings_dict[field], list):
-                val = ' '.join(settings_dict[field])
-            else:
-                val = settings_dict[field]
-            kwarg_str += '--{0} {1} '.format(field, val)
-        kwarg_str = kwarg_str.rstrip()
-        cmd = ('singularity run --cleanenv '
-               '-B {templateflow_dir}:$HOME/.cache/templateflow '
-               '{mriqc} {bids_dir} {out_dir} participant '
-               '--no-sub --verbose-reports '
-               '-m {modality} '
-               '-w {work_dir} --n_procs {n_procs} '
-               '{kwarg_str}'.format(
-                   templateflow_dir=templateflow_dir,
-                   mriqc=mriqc_singularity,
-                   bids_dir=bids_dir,
-                   out_dir=out_dir,
-                   modality=modality,
-                   work_dir=work_dir,
-                   n_procs=n_procs,
-                   kwarg_str=kwarg_str))
-        run(cmd)
+        kwarg_str = _get_kwarg_str(anat_config[modality])
+        record = _lookup(modality, 'anat', '*{0}'.format(modality),
+                         kwarg_str)
+        if record is None:
+            continue
+        key = kwarg_str if batch_runs else modality
+        group = anat_groups.setdefault(key, (kwarg_str, [], []))
+        group[1].append(modality)
+        group[2].append(record)
+        n_unbatched += 1
+
+    for kwarg_str, modalities, records in anat_groups.values():
+        runs.append((
+            '_'.join(modalities),
+            '-m {modalities} {kwarg_str}'.format(
+                modalities=' '.join(modalities),
+                kwarg_str=kwarg_str),
+            records))
 
-    # Run MRIQC func
+    # MRIQC func
     func_config = mriqc_config['func']
+    func_groups = OrderedDict()
     for task in func_config.keys():
-        run_mriqc = False
         task_json_files = glob(op.join(
             bids_dir,
             'sub-{sub}/func/sub-{sub}_*_task-{task}_*_bold.'
@@ -86,41 +232,120 @@ def run_mriqc(bids_dir, templateflow_dir, mriqc_singularity, work_dir,
                     sub=sub, ses=ses, task=task)))
 
         if len(task_json_files):
-            run_mriqc = True
-
-        if run_mriqc:
-            kwarg_str = ''
-            settings_dict = func_config[task]
-            for field in settings_dict.keys():
-                if isinstance(settings_dict[field], list):
-                    val = ' '.join(settings_dict[field])
-                else:
-                    val = settings_dict[field]
-                kwarg_str += '--{0} {1} '.format(field, val)
-            kwarg_str = kwarg_str.rstrip()
-            cmd = ('singularity run --cleanenv '
-                   '-B {templateflowdir}:$HOME/.cache/templateflow '
-                   '{mriqc} {bids_dir} {out_dir} participant '
-                   '--no-sub --verbose-reports '
-                   '--task-id {task} -m bold '
-                   '-w {work_dir} --n_procs {n_procs} --correct-slice-timing '
-                   '{kwarg_str}'.format(
-                       templateflowdir=templateflow_dir,
-                       mriqc=mriqc_singularity,
-                       bids_dir=bids_dir,
-                       out_dir=out_dir,
-                       task=task,
-                       work_dir=work_dir,
-                       n_procs=n_procs,
-                       kwarg_str=kwarg_str))
-            run(cmd)
+            kwarg_str = _get_kwarg_str(func_config[task])
+            record = _lookup('task-{0}'.format(task), 'func',
+                             '*_task-{0}_*_bold'.format(task), kwarg_str)
+            if record is None:
+                continue
+            key = kwarg_str if batch_runs else task
+            group = func_groups.setdefault(key, (kwarg_str, [], []))
+            group[1].append(task)
+            group[2].append(record)
+            n_unbatched += 1
+
+    for kwarg_str, tasks, records in func_groups.values():
+        runs.append((
+            'task-{0}'.format('_'.join(tasks)),
+            '--task-id {tasks} -m bold --correct-slice-timing '
+            '{kwarg_str}'.format(
+                tasks=' '.join(tasks),
+                kwarg_str=kwarg_str),
+            records))
+
+    if use_cache:
+        print('MRIQC cache for sub-{0}{1}: {2} hits{3}, {4} misses{5}.'.format(
+            sub, ' ses-{0}'.format(ses) if ses else '', len(hits),
+            ' ({0})'.format(', '.join(hits)) if hits else '', len(misses),
+            ' ({0})'.format(', '.join(misses)) if misses else ''))
+
+    if not runs:
+        return
+
+    n_saved = n_unbatched - len(runs)
+    if n_saved:
+        message = ('Batched {0} MRIQC runs into {1} calls, saving {2} '
+                   'container start-ups'.format(n_unbatched, len(runs),
+                                                n_saved))
+        if 'startup_overhead' in mriqc_config.keys():
+            message += ' (about {0:.0f} s)'.format(
+                n_saved * float(mriqc_config['startup_overhead']))
+        print(message)
+
+    # Each call is keyed on the session's BIDS files, so it is rerun if the
+    # session was BIDSified again
+    session_dir = op.join(bids_dir, 'sub-{0}'.format(sub))
+    if ses:
+        session_dir = op.join(session_dir, 'ses-{0}'.format(ses))
+    bids_manifest = (build_manifest(session_dir) if op.isdir(session_dir)
+                     else {})
+    run_fingerprints = {
+        label: fingerprint(bids_manifest, checkpoints.token('bidsify'),
+                           mriqc_singularity, out_dir, args)
+        for label, args, _ in runs}
+    runs = [(label, args, records) for label, args, records in runs
+            if checkpoints.completed('mriqc-{0}'.format(label),
+                                     run_fingerprints[label]) is None]
+    if not runs:
+        return
+
+    # Split the core budget between concurrent runs
+    procs_per_run = max(1, n_procs // len(runs))
+    if 'max_procs_per_run' in mriqc_config.keys():
+        procs_per_run = min(procs_per_run,
+                            int(mriqc_config['max_procs_per_run']))
+    n_workers = max(1, n_procs // procs_per_run)
+
+    def _run(label, args, records):
+        cmd = ('singularity run --cleanenv '
+               '-B {templateflow_dir}:$HOME/.cache/templateflow{ro} '
+               '{mriqc} {bids_dir} {out_dir} participant '
+               '--no-sub --verbose-reports '
+               '-w {work_dir} --n_procs {n_procs} '
+               '{args}'.format(
+                   templateflow_dir=templateflow_dir,
+                   ro=':ro' if templateflow_readonly else '',
+                   mriqc=mriqc_singularity,
+                   bids_dir=bids_dir,
+                   out_dir=out_dir,
+                   work_dir=op.join(work_dir, label),
+                   n_procs=procs_per_run,
+                   args=args))
+        with tracer.span('mriqc-{0}'.format(label)) as span:
+            span['result'] = run(cmd.rstrip(), prefix='[{0}] '.format(label))
+        checkpoints.mark('mriqc-{0}'.format(label), run_fingerprints[label])
+        for record_file, cache_key, in_files in records:
+            if in_files:
+                _write_cache_record(record_file, cache_key, in_files)
+
+    failures = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_run, *run_args): run_args[0]
+                   for run_args in runs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as exc:
+                failures[futures[future]] = exc
+
+    if failures:
+        raise RuntimeError('{0} of {1} MRIQC runs failed:\n{2}'.format(
+            len(failures), len(runs),
+            '\n'.join('{0}: {1}'.format(label, exc)
+                      for label, exc in sorted(failures.items()))))
 
 
 def mriqc_group(bids_dir, config, work_dir=None, sub=None, ses=None,
-                participant=False, group=False):
-    """Run group-level MRIQC."""
-    CIS_DIR = '/scratch/cis_dataqc/'
+                participant=False, group=False, engine=None):
+    """Run group-level MRIQC.
 
+    With the default "python" engine, the group CSVs and reports are updated
+    in place from the new or changed participant IQMs (see group_iqms). The
+    "container" engine copies the derivatives to scratch and runs MRIQC's
+    group level instead. The engine may also be set with the config file's
+    "mriqc_group_engine" field. If the config file has an "iqm_store" field
+    (a SQLite file, or true for iqm_store.IQM_DB), the project's IQMs are
+    also added to that store.
+    """
     # Check inputs
     if work_dir is None:
         work_dir = CIS_DIR
@@ -140,11 +365,10 @@ def mriqc_group(bids_dir, config, work_dir=None, sub=None, ses=None,
         raise Exception('Config File must be updated with project field'
                         'See Sample Config File for More information')
 
-    if not work_dir.startswith('/scratch'):
+    if not work_dir.startswith(SCRATCH_DIR):
         raise ValueError('Working directory must be in scratch.')
 
-    mriqc_file = op.join('/home/data/cis/singularity-images/',
-                         mriqc_config['mriqc'])
+    mriqc_file = op.join(SINGULARITY_DIR, mriqc_config['mriqc'])
     mriqc_version = re.search(r'_([\d.]+)', mriqc_file).group(1)
 
     out_deriv_dir = op.join(bids_dir,
@@ -157,14 +381,36 @@ def mriqc_group(bids_dir, config, work_dir=None, sub=None, ses=None,
         raise ValueError('MRIQC image specified in config files must be '
                          'an existing file.')
 
-    # Copy singularity images to scratch
-    scratch_mriqc = op.join(CIS_DIR, op.basename(mriqc_file))
+    if engine is None:
+        engine = mriqc_config.get('mriqc_group_engine', 'python')
+    if engine not in GROUP_ENGINES:
+        raise ValueError('MRIQC group engine must be one of {0}, not '
+                         '"{1}".'.format(GROUP_ENGINES, engine))
+
+    if group and engine == 'python':
+        group_iqms.aggregate(out_deriv_dir,
+                             project=mriqc_config['project'])
+    elif group:
+        # Claim the scratch copies so they are not evicted while MRIQC runs
+        claim_work_dir(out_dir)
+        claim_work_dir(scratch_mriqc_work_dir)
+        ensure_space(
+            estimate_footprint(
+                images=[mriqc_file],
+                cache_dir=mriqc_config.get('image_cache_dir'),
+                mriqc_gb=mriqc_config.get('mriqc_scratch_gb',
+                                          MRIQC_SCRATCH_GB))
+            + tree_size(out_deriv_dir), work_dir,
+            quota_gb=mriqc_config.get('scratch_quota_gb'),
+            reserve_gb=mriqc_config.get('scratch_reserve_gb', 0),
+            cache_dir=mriqc_config.get('image_cache_dir'))
 
-    if not op.isfile(scratch_mriqc):
-        shutil.copyfile(mriqc_file, scratch_mriqc)
-        os.chmod(scratch_mriqc, 0o775)
+        # Get singularity images from the shared scratch cache
+        scratch_mriqc = get_image(
+            mriqc_file,
+            cache_dir=mriqc_config.get('image_cache_dir'),
+            max_size_gb=mriqc_config.get('image_cache_size_gb'))
 
-    if group:
         shutil.copytree(out_deriv_dir, out_dir)
         cmd = ('{mriqc} {bids_dir} {out_dir} group --no-sub --verbose-reports '
                '-w {work_dir} --n_procs {n_procs} '.format(
@@ -173,12 +419,20 @@ def mriqc_group(bids_dir, config, work_dir=None, sub=None, ses=None,
                    work_dir=scratch_mriqc_work_dir, n_procs=n_procs))
         run(cmd)
 
-    for modality in ['bold', 'T1w', 'T2w']:
-        out_csv = op.join(out_dir, modality + '.csv')
-        out_html = op.join(out_dir, 'reports', modality + '.html')
-        if op.isfile(out_csv):
-            shutil.copy(out_csv, out_deriv_dir)
-            shutil.copy(out_html, op.join(out_deriv_dir, 'reports'))
+        for modality in group_iqms.MODALITIES:
+            out_csv = op.join(out_dir, modality + '.csv')
+            out_html = op.join(out_dir, 'reports', modality + '.html')
+            if op.isfile(out_csv):
+                shutil.copy(out_csv, out_deriv_dir)
+                shutil.copy(out_html, op.join(out_deriv_dir, 'reports'))
+
+    # Add the project's IQMs to the cross-project IQM store
+    if group and mriqc_config.get('iqm_store'):
+        db_file = mriqc_config['iqm_store']
+        conn = iqm_store.connect(None if db_file is True else db_file)
+        iqm_store.ingest_derivatives(conn, out_deriv_dir,
+                                     mriqc_config['project'])
+        conn.close()
 
     # get date and time
     now = datetime.datetime.now()
@@ -202,5 +456,6 @@ def mriqc_group(bids_dir, config, work_dir=None, sub=None, ses=None,
                message=message_file))
     run(cmd)
 
-    shutil.rmtree(out_dir)
+    release_work_dir(out_dir, remove=True)
+    release_work_dir(scratch_mriqc_work_dir, remove=True)
     os.remove(message_file)
@@ -0,0 +1,124 @@
+"""A producer/consumer pipeline from downloaded sessions to conversion jobs.
+
+Downloads put each session on a bounded queue as soon as it is complete. A
+pool of workers protocol checks and archives queued sessions, and a
+submitter sends archived sessions to SLURM in batches, so the first
+conversion job starts while later sessions are still downloading. The
+bounded queue holds downloads back when archiving falls behind, so
+downloaded sessions do not pile up in scratch.
+"""
+import time
+import queue
+import threading
+
+_DONE = object()
+
+
+class SessionPipeline(object):
+    """Process sessions as they arrive and submit them in batches.
+
+    Parameters
+    ----------
+    process : callable
+        process(key, *args) checks and archives one session. Returns a
+        (tarball, sub, ses) tuple to convert, or None.
+    submit : callable
+        submit(conversions) submits a list of (tarball, sub, ses) tuples.
+    n_workers : int, optional
+        Number of sessions processed at once. Default is 2.
+    max_queue : int, optional
+        Number of sessions waiting to be processed beyond which put blocks.
+        Default is 4.
+    submit_interval : float, optional
+        Minimum number of seconds between submissions. The first session is
+        submitted as soon as it is archived, and sessions archived in the
+        meantime are grouped into the next submission. Default is 60.
+    """
+
+    def __init__(self, process, submit, n_workers=2, max_queue=4,
+                 submit_interval=60):
+        self.process = process
+        self.submit = submit
+        self.submit_interval = submit_interval
+        self.conversions = []
+        self.failures = {}
+        self.submit_errors = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max(1, max_queue))
+        self._ready = queue.Queue()
+        self._workers = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(max(1, n_workers))]
+        self._submitter = threading.Thread(target=self._submit_batches,
+                                           daemon=True)
+        for thread in self._workers + [self._submitter]:
+            thread.start()
+
+    def put(self, key, *args):
+        """Queue a session, waiting while the queue is full.
+
+        key identifies the session in failures (e.g., its XNAT experiment).
+        """
+        self._queue.put((key, args))
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+            key, args = item
+            try:
+                conversion = self.process(key, *args)
+            except Exception as exc:
+                with self._lock:
+                    self.failures[key] = exc
+                continue
+            if conversion is not None:
+                self._ready.put(conversion)
+
+    def _submit_batches(self):
+        last_submit = None
+        done = False
+        while not done:
+            item = self._ready.get()
+            if item is _DONE:
+                return
+            batch = [item]
+            deadline = (time.time() if last_submit is None
+                        else last_submit + self.submit_interval)
+            # Group the sessions archived until the next submission is due
+            while True:
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        item = self._ready.get(timeout=timeout)
+                    else:
+                        item = self._ready.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+
+            try:
+                self.submit(batch)
+            except Exception as exc:
+                self.submit_errors.append(exc)
+            self.conversions += batch
+            last_submit = time.time()
+
+    def close(self):
+        """Wait for queued sessions to be processed and submitted.
+
+        Returns
+        -------
+        conversions : list of tuple
+            (tarball, sub, ses) of every archived session.
+        """
+        for _ in self._workers:
+            self._queue.put(_DONE)
+        for thread in self._workers:
+            thread.join()
+        self._ready.put(_DONE)
+        self._submitter.join()
+        return self.conversions
@@ -1,8 +1,17 @@
 """Run a protocol check."""
 import os
 import os.path as op
+import re
 import json
+import time
+import fcntl
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+IGNORE_NAMES = ['PMU', 'setter']
+HEADER_CACHE = '.dicom_header_cache.json'
+# Header cache entries not used for this many days are dropped
+HEADER_CACHE_DAYS = 30
 
 
 def _get_parser():
@@ -16,21 +25,29 @@ def _get_parser():
                         help='The label of the subject to analyze.')
     parser.add_argument('--ses', required=True, dest='ses',
                         help='Session number', default=None)
+    parser.add_argument('--deep', required=False, action='store_true',
+                        help='Also read DICOM headers to check instance '
+                             'numbers and series UIDs.')
     return parser
 
 
-def main(work_dir, bids_dir, sub, ses=None):
-    # Check inputs
-    if not op.isdir(work_dir):
-        raise ValueError('Argument "workdir" must be an existing directory.')
+def load_protocol(bids_dir):
+    """Load a project's protocol, as named in its code/config.json.
+
+    Parameters
+    ----------
+    bids_dir : str
+        Full path to the BIDS directory. The project directory is its parent.
 
+    Returns
+    -------
+    protocol_options : dict
+        The protocol, with the scan requirements plus "project" and "email".
+    """
     if not op.isdir(op.dirname(bids_dir)):
         raise ValueError('Argument "bids_dir" must be an existing directory.')
 
     config_file = op.join(op.dirname(bids_dir), 'code/config.json')
-    message_file = op.join(
-        work_dir, '{sub}-{ses}-protocol_error.txt'.format(sub=sub, ses=ses))
-
     with open(config_file, 'r') as fo:
         config_options = json.load(fo)
     protocol_file = op.join(op.dirname(bids_dir), config_options['protocol'])
@@ -38,60 +55,320 @@ def main(work_dir, bids_dir, sub, ses=None):
     if not op.isfile(protocol_file):
         raise ValueError('Argument "protocol" must exist.')
 
-    # Additional checks
-    if not op.isdir(op.join(work_dir, sub)):
-        raise ValueError('Subject directory does not exist '
-                         'in working directory.')
-
-    if not op.isdir(op.join(work_dir, sub, ses)):
-        raise ValueError('Session directory does not exist in subjects '
-                         'working directory.')
-
     with open(protocol_file, 'r') as fo:
         protocol_options = json.load(fo)
+    return protocol_options
+
+
+def compile_protocol(protocol_options, ignore_names=None):
+    """Compile a protocol into a scan matcher.
+
+    Parameters
+    ----------
+    protocol_options : dict
+        Protocol loaded with load_protocol.
+    ignore_names : list of str or None, optional
+        Scan directories containing any of these strings are never matched.
+        Default is IGNORE_NAMES.
+
+    Returns
+    -------
+    matcher : dict
+        Requirements for each protocol scan ("scans"), plus one regular
+        expression matching any protocol scan name ("pattern") and one
+        matching any ignored name ("ignore").
+    """
+    if ignore_names is None:
+        ignore_names = IGNORE_NAMES
+
+    scans = {name: (opts['n_runs'], opts['n_dicoms'])
+             for name, opts in protocol_options.items()
+             if name not in ('email', 'project')}
+    # Longest names first, so the alternation prefers the most specific scan
+    names = sorted(scans, key=len, reverse=True)
+    matcher = {
+        'scans': scans,
+        'pattern': re.compile('|'.join(re.escape(n) for n in names) or '$^'),
+        'ignore': re.compile('|'.join(re.escape(n) for n in ignore_names)
+                             or '$^'),
+    }
+    return matcher
+
+
+def match_scans(matcher, scan_dirs):
+    """Assign scan directories to the protocol scans whose names they contain.
+
+    Returns
+    -------
+    matches : dict
+        Sorted lists of scan directories, keyed by protocol scan name.
+    """
+    matches = {name: [] for name in matcher['scans']}
+    for scan_dir in scan_dirs:
+        if (not matcher['pattern'].search(scan_dir)
+                or matcher['ignore'].search(scan_dir)):
+            continue
+        # A directory may contain more than one protocol scan name
+        for name in matches:
+            if name in scan_dir:
+                matches[name].append(scan_dir)
+    return {name: sorted(found) for name, found in matches.items()}
+
+
+def count_dicoms(dicom_dir):
+    """Count the entries in a DICOM directory."""
+    with os.scandir(dicom_dir) as it:
+        return sum(1 for _ in it)
+
+
+def read_header(dicom_file):
+    """Read the instance number and series UID from a DICOM file.
+
+    Only the header is parsed; reading stops before the pixel data.
+
+    Returns
+    -------
+    header : tuple
+        (InstanceNumber, SeriesInstanceUID). Both are None if the file could
+        not be read.
+    """
+    try:
+        import pydicom
+    except ImportError:
+        raise ImportError('pydicom is required for the deep protocol check.')
+
+    try:
+        dcm = pydicom.dcmread(
+            dicom_file, stop_before_pixels=True,
+            specific_tags=['InstanceNumber', 'SeriesInstanceUID'])
+        return (int(dcm.InstanceNumber), str(dcm.SeriesInstanceUID))
+    except Exception:
+        return (None, None)
+
+
+def _load_header_cache(cache_file):
+    if cache_file is None or not op.isfile(cache_file):
+        return {}
+    with open(cache_file, 'r') as fo:
+        return json.load(fo)
 
-    warning = False
-    scans = protocol_options.keys()
-    scan_list = os.listdir(op.join(work_dir, sub, ses))
-    for tmp_scan in scans:
-        if (tmp_scan != 'email') and (tmp_scan != 'project'):
-            n_runs_required = protocol_options[tmp_scan]['n_runs']
-            n_dicoms_required = protocol_options[tmp_scan]['n_dicoms']
-
-            ignore_names = ['PMU', 'setter']
-            tmp_scan_list = []
-            for tmp in scan_list:
-                if ((tmp_scan in tmp)
-                   and all([igname not in tmp for igname in ignore_names])):
-                    tmp_scan_list.append(tmp)
 
+def _save_header_cache(cache_file, cache):
+    """Merge new header cache entries into the cache file."""
+    if cache_file is None:
+        return
+    with open(cache_file + '.lock', 'a') as lock_fo:
+        fcntl.flock(lock_fo, fcntl.LOCK_EX)
+        merged = _load_header_cache(cache_file)
+        merged.update(cache)
+        # Sessions are removed once archived, but may be downloaded again,
+        # so entries are kept until they go unused
+        cutoff = time.time() - HEADER_CACHE_DAYS * 24 * 3600
+        merged = {key: entry for key, entry in merged.items()
+                  if len(entry) > 4 and entry[4] >= cutoff}
+        tmp_file = '{0}.tmp-{1}'.format(cache_file, os.getpid())
+        with open(tmp_file, 'w') as fo:
+            json.dump(merged, fo)
+        os.replace(tmp_file, cache_file)
+
+
+def check_series_headers(dicom_dir, n_dicoms_required, cache, root=None):
+    """Check a series' DICOM headers for truncated or duplicated files.
+
+    Parameters
+    ----------
+    dicom_dir : str
+        Directory with the series' DICOM files.
+    n_dicoms_required : int
+        Number of DICOMs the protocol requires.
+    cache : dict
+        Header cache, keyed by file path, holding [size, mtime, instance
+        number, series UID, last used]. Entries are only reused while size
+        and mtime match, and are updated in place.
+    root : str or None, optional
+        Directory the cache keys are relative to, so that they still match
+        when a session is downloaded again elsewhere. Default is None
+        (absolute paths).
+
+    Returns
+    -------
+    messages : list of str
+        Problems found in the series.
+    """
+    instances = []
+    series_uids = set()
+    n_unreadable = 0
+    now = time.time()
+    with os.scandir(dicom_dir) as it:
+        for entry in it:
+            stat = entry.stat()
+            key = op.relpath(entry.path, root) if root else entry.path
+            cached = cache.get(key)
+            if (cached is not None and cached[0] == stat.st_size
+                    and cached[1] == stat.st_mtime):
+                instance, series_uid = cached[2], cached[3]
+            else:
+                instance, series_uid = read_header(entry.path)
+            cache[key] = [stat.st_size, stat.st_mtime, instance, series_uid,
+                          now]
+            if instance is None:
+                n_unreadable += 1
+                continue
+            instances.append(instance)
+            series_uids.add(series_uid)
+
+    name = op.basename(op.dirname(op.dirname(op.dirname(dicom_dir))))
+    messages = []
+    if n_unreadable:
+        messages.append('There are {0} unreadable DICOMs for {1}'.format(
+            n_unreadable, name))
+    unique_instances = sorted(set(instances))
+    if len(unique_instances) != len(instances):
+        messages.append('There are {0} duplicated instance numbers for '
+                        '{1}'.format(len(instances) - len(unique_instances),
+                                     name))
+    if unique_instances and (unique_instances[-1] - unique_instances[0] + 1
+                             != len(unique_instances)):
+        messages.append('Instance numbers for {0} are not contiguous '
+                        '({1} to {2}, with {3} unique)'.format(
+                            name, unique_instances[0], unique_instances[-1],
+                            len(unique_instances)))
+    if len(unique_instances) != n_dicoms_required:
+        messages.append('There are {0} unique DICOM instances for {1}, but '
+                        'should be {2}'.format(len(unique_instances), name,
+                                               n_dicoms_required))
+    if len(series_uids) > 1:
+        messages.append('There are {0} series UIDs for {1}, but should be '
+                        '1'.format(len(series_uids), name))
+    return messages
+
+
+def check_sessions(work_dir, sessions, protocol_options, n_threads=8,
+                   deep=False, cache_file=None):
+    """Check many downloaded sessions against a protocol at once.
+
+    Parameters
+    ----------
+    work_dir : str
+        Directory with downloaded data, organized as <sub>/<ses>/<scan>.
+    sessions : list of tuple
+        (sub, ses) pairs to check.
+    protocol_options : dict
+        Protocol loaded with load_protocol.
+    n_threads : int, optional
+        Number of threads used to count DICOMs. Default is 8.
+    deep : bool, optional
+        Whether to also check the DICOM headers of each series (see
+        check_series_headers). Default is False.
+    cache_file : str or None, optional
+        Header cache used by the deep check, keyed by paths relative to
+        work_dir. It should be kept outside of work_dir, which is listed as
+        subjects. Default is HEADER_CACHE in the parent of work_dir.
+
+    Returns
+    -------
+    warnings : dict
+        Lists of warning messages keyed by (sub, ses). Sessions that comply
+        with the protocol have an empty list.
+    """
+    matcher = compile_protocol(protocol_options)
+    session_matches = {}
+    dicom_dirs = []
+    required = {}
+    for sub, ses in sessions:
+        ses_dir = op.join(work_dir, sub, ses)
+        if not op.isdir(ses_dir):
+            raise ValueError('Session directory {0} does not exist in '
+                             'working directory.'.format(ses_dir))
+        matches = match_scans(matcher, os.listdir(ses_dir))
+        session_matches[(sub, ses)] = matches
+        for name, found in matches.items():
+            for t in found:
+                dicom_dir = op.join(ses_dir, t, 'resources/DICOM/files')
+                dicom_dirs.append(dicom_dir)
+                required[dicom_dir] = matcher['scans'][name][1]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        counts = dict(zip(dicom_dirs, executor.map(count_dicoms, dicom_dirs)))
+
+    header_messages = {}
+    if deep:
+        if cache_file is None:
+            cache_file = op.join(op.dirname(op.abspath(work_dir)),
+                                 HEADER_CACHE)
+        cache = _load_header_cache(cache_file)
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            header_messages = dict(zip(dicom_dirs, executor.map(
+                lambda d: check_series_headers(d, required[d], cache,
+                                               root=work_dir),
+                dicom_dirs)))
+        _save_header_cache(cache_file, cache)
+
+    warnings = {}
+    for (sub, ses), matches in session_matches.items():
+        messages = []
+        for tmp_scan, (n_runs_required, n_dicoms_required) in \
+                matcher['scans'].items():
+            tmp_scan_list = matches[tmp_scan]
             if len(tmp_scan_list) != n_runs_required:
-                warning = True
-                with open(message_file, 'a') as fo:
-                    fo.write('There are {0} scans for {1}, but should be {2}'
-                             '\n'.format(len(tmp_scan_list), tmp_scan, n_runs_required))
+                messages.append(
+                    'There are {0} scans for {1}, but should be {2}'.format(
+                        len(tmp_scan_list), tmp_scan, n_runs_required))
 
             for t in tmp_scan_list:
                 dicom_dir = op.join(
                     work_dir, sub, ses, t, 'resources/DICOM/files')
-                n_dicoms_found = len(os.listdir(dicom_dir))
+                n_dicoms_found = counts[dicom_dir]
                 if n_dicoms_found != n_dicoms_required:
-                    warning = True
-                    with open(message_file, 'a') as fo:
-                        fo.write('There are {0} DICOMs for {1}, but should be '
-                                 '{2}\n'.format(n_dicoms_found,
-                                                t, n_dicoms_required))
-
-    if warning:
-        cmd = ("mail -s '{proj} Protocol Check Warning {sub} {ses}' "
-               "{email_list} < {message}".format(
-                   proj=protocol_options['project'],
-                   sub=sub,
-                   ses=ses,
-                   email_list=protocol_options['email'],
-                   message=message_file))
-        os.system(cmd)
-        os.remove(message_file)
+                    messages.append(
+                        'There are {0} DICOMs for {1}, but should be '
+                        '{2}'.format(n_dicoms_found, t, n_dicoms_required))
+                messages += header_messages.get(dicom_dir, [])
+        warnings[(sub, ses)] = messages
+    return warnings
+
+
+def report_warnings(work_dir, sub, ses, messages, protocol_options):
+    """Email a session's protocol check warnings to the project personnel."""
+    if not messages:
+        return
+
+    message_file = op.join(
+        work_dir, '{sub}-{ses}-protocol_error.txt'.format(sub=sub, ses=ses))
+    with open(message_file, 'a') as fo:
+        fo.write(''.join(message + '\n' for message in messages))
+
+    cmd = ("mail -s '{proj} Protocol Check Warning {sub} {ses}' "
+           "{email_list} < {message}".format(
+               proj=protocol_options['project'],
+               sub=sub,
+               ses=ses,
+               email_list=protocol_options['email'],
+               message=message_file))
+    os.system(cmd)
+    os.remove(message_file)
+
+
+def main(work_dir, bids_dir, sub, ses=None, deep=False):
+    # Check inputs
+    if not op.isdir(work_dir):
+        raise ValueError('Argument "workdir" must be an existing directory.')
+
+    protocol_options = load_protocol(bids_dir)
+
+    # Additional checks
+    if not op.isdir(op.join(work_dir, sub)):
+        raise ValueError('Subject directory does not exist '
+                         'in working directory.')
+
+    if not op.isdir(op.join(work_dir, sub, ses)):
+        raise ValueError('Session directory does not exist in subjects '
+                         'working directory.')
+
+    warnings = check_sessions(work_dir, [(sub, ses)], protocol_options,
+                              deep=deep)
+    report_warnings(work_dir, sub, ses, warnings[(sub, ses)],
+                    protocol_options)
 
 
 def _main(argv=None):
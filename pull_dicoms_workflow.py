@@ -2,13 +2,18 @@
 """A wrapper around conversion_workflow.py and cis-xget.
 
 This workflow does the following:
-1. Copy XNAT downloader Singularity image to scratch.
-2. Download tarball using XNAT downloader.
+1. Get XNAT downloader Singularity image from the scratch image cache.
+2. Download tarball using XNAT downloader (optionally running several
+   downloads at once, see --shards).
 3. Run protocol check on downloaded data.
 4. Email project-related personnel warnings about missing data based on protocol check.
-5. Submit conversion_workflow as a job.
+5. Submit conversion_workflow for the downloaded sessions as job arrays.
 6. Email project-related personnel update about downloaded/converted data.
 
+Steps 3 to 5 are pipelined: each session is checked and archived by a pool
+of workers as soon as it has been downloaded, and archived sessions are
+submitted in batches while later sessions are still downloading.
+
 Because the workflow downloads data from XNAT (which requires internet access),
 it cannot be called within a SLURM job, as none of the processing nodes have
 internet access. The workflow is thus called on the login or visualization
@@ -18,14 +23,27 @@ nodes.
 import os
 import os.path as op
 import json
+import fcntl
+import time
 import shutil
-import tarfile
 import datetime
 
 import argparse
-import pandas as pd
 
-from utils import run
+from utils import (run, CIS_DIR, SCRATCH_DIR, SINGULARITY_DIR,
+                   get_archive_options, write_archive, stage_archive)
+from image_cache import get_image
+from scratch import claim_work_dir, release_work_dir, ensure_space
+from ledger import read_scans, append_scan, write_processed_list
+from slurm import write_manifest, sbatch
+from tracing import Tracer
+from tree_sync import build_manifest
+from xnat import (BandwidthLimiter, list_experiments, list_scans,
+                  download_scans, download_sharded, watch_download)
+from session_index import SessionIndex, INDEX_FILE, checksum
+from pipeline import SessionPipeline
+from protocol_check import (load_protocol, check_sessions, report_warnings,
+                            HEADER_CACHE)
 
 
 def _get_parser():
@@ -55,6 +73,19 @@ def _get_parser():
         action='store_true',
         help='Will perform a protocol check to determine if '
              'the correct number of scans and TRs are present.')
+    parser.add_argument(
+        '--deep_protocol_check',
+        required=False,
+        action='store_true',
+        help='Will also read DICOM headers during the protocol check to '
+             'catch truncated or duplicated DICOMs. Requires pydicom.')
+    parser.add_argument(
+        '--staged',
+        required=False,
+        action='store_true',
+        help='Will submit the BIDSify and MRIQC stages of the conversion '
+             'as separate, dependency-chained jobs, each with the resources '
+             'set for it in the config file.')
     parser.add_argument(
         '--autocheck',
         required=False,
@@ -68,14 +99,402 @@ def _get_parser():
         default=None,
         help='XNAT Experiment ID (i.e., XNAT_E*) for single '
              'session download.')
+    parser.add_argument(
+        '--shards',
+        required=False,
+        type=int,
+        default=None,
+        help='With --autocheck, list pending XNAT experiments and run up to '
+             'this many downloads at once, archiving each session as soon '
+             'as it arrives. Defaults to "shards" in the config\'s "xnat" '
+             'field, or 1 (a single download call).')
     return parser
 
 
+def _strip_prefix(label, prefix):
+    """Remove a BIDS entity prefix (e.g., "sub-") from a label."""
+    if label.startswith(prefix):
+        return label[len(prefix):]
+    return label
+
+
+def submit_conversions(conversions, proj_dir, bids_dir, work_dir, config,
+                       config_options, staged=False):
+    """Submit conversion_workflow for many sessions as one SLURM job array.
+
+    In staged mode, the BIDSify and MRIQC stages are submitted as two job
+    arrays, with the MRIQC array starting once the BIDSify array succeeds.
+    Each stage's "nprocs", "mem" and "time" are read from the config's
+    "resources" field.
+
+    Parameters
+    ----------
+    conversions : list of tuple
+        (tarball, sub, ses) for each session to convert.
+    proj_dir : str
+        Project directory. The manifest is written to code/manifests and the
+        logs to code/err and code/out.
+    bids_dir, work_dir, config : str
+        Arguments passed on to conversion_workflow.
+    config_options : dict
+        Project configuration. The optional "array_throttle" field limits
+        the number of conversions running at once. With a "datalad_batch"
+        field, conversions save their sessions with datalad in batches, and
+        a job saving the remaining sessions runs after each array.
+    staged : bool, optional
+        Whether to submit the BIDSify and MRIQC stages as separate job
+        arrays. Each MRIQC task starts as soon as the BIDSify task for the
+        same session succeeds. Default is False.
+
+    Returns
+    -------
+    job_id : str
+        The ID of the last job array submitted.
+    """
+    now = datetime.datetime.now()
+    manifest_file = op.join(
+        proj_dir, 'code/manifests',
+        'convert-{0}.tsv'.format(now.strftime('%Y%m%d-%H%M%S-%f')))
+    write_manifest(manifest_file, conversions)
+
+    wrap = ('python {fdir}/conversion_workflow.py --manifest {manifest} '
+            '-b {bids_dir} -w {work_dir} --config {config}'.format(
+                fdir=op.dirname(op.abspath(__file__)),
+                manifest=manifest_file,
+                bids_dir=bids_dir,
+                work_dir=work_dir,
+                config=config))
+    if config_options.get('datalad_batch'):
+        wrap += ' --datalad'
+
+    if not staged:
+        job_id = sbatch(
+            wrap,
+            job_name='convert-{0}'.format(config_options['project']),
+            err_file=op.join(proj_dir, 'code/err/convert-%A_%a'),
+            out_file=op.join(proj_dir, 'code/out/convert-%A_%a'),
+            config_options=config_options,
+            nprocs=config_options.get('nprocs', 1),
+            array_size=len(conversions),
+            throttle=config_options.get('array_throttle'))
+        print('Submitted {0} conversions as job array {1} (manifest: '
+              '{2})'.format(len(conversions), job_id, manifest_file))
+        _submit_datalad_save(job_id, proj_dir, bids_dir, config_options)
+        return job_id
+
+    # BIDSification is mostly single-threaded, while MRIQC uses many cores
+    default_resources = {
+        'bidsify': {'nprocs': 1},
+        'mriqc': {'nprocs': config_options.get(
+            'mriqc_settings', {}).get('n_procs', 1)},
+    }
+    job_id = None
+    for stage in ['bidsify', 'mriqc']:
+        resources = default_resources[stage]
+        resources.update(config_options.get('resources', {}).get(stage, {}))
+        job_id = sbatch(
+            '{0} --stage {1}'.format(wrap, stage),
+            job_name='{0}-{1}'.format(stage, config_options['project']),
+            err_file=op.join(proj_dir, 'code/err/{0}-%A_%a'.format(stage)),
+            out_file=op.join(proj_dir, 'code/out/{0}-%A_%a'.format(stage)),
+            config_options=config_options,
+            nprocs=resources['nprocs'],
+            array_size=len(conversions),
+            throttle=config_options.get('array_throttle'),
+            dependency='aftercorr:{0}'.format(job_id) if job_id else None,
+            mem=resources.get('mem'),
+            time=resources.get('time'))
+        print('Submitted {0} {1} jobs as job array {2} (manifest: '
+              '{3})'.format(len(conversions), stage, job_id, manifest_file))
+        if stage == 'bidsify':
+            # Sessions are merged into the BIDS dataset by the BIDSify stage
+            _submit_datalad_save(job_id, proj_dir, bids_dir, config_options)
+    return job_id
+
+
+def _submit_datalad_save(job_id, proj_dir, bids_dir, config_options):
+    """Save a job array's sessions with datalad once all its tasks end.
+
+    Only done with batched datalad saves (the config's "datalad_batch"
+    field). The job saves whichever sessions are still pending, including
+    those of failed or earlier arrays.
+    """
+    if not config_options.get('datalad_batch'):
+        return
+    save_job_id = sbatch(
+        'python {fdir}/bids_merge.py save {bids_dir}'.format(
+            fdir=op.dirname(op.abspath(__file__)), bids_dir=bids_dir),
+        job_name='datalad-save-{0}'.format(config_options['project']),
+        err_file=op.join(proj_dir, 'code/err/datalad-save-%j'),
+        out_file=op.join(proj_dir, 'code/out/datalad-save-%j'),
+        config_options=config_options,
+        dependency='afterany:{0}'.format(job_id))
+    print('Submitted datalad save of job array {0} as job {1}.'.format(
+        job_id, save_job_id))
+
+
+def archive_session(session_root, raw_dir, tmp_sub, tmp_ses,
+                    archive_options, scans_file, scans_index, tracer):
+    """Archive a downloaded session to the raw folder and add it to the ledger.
+
+    Parameters
+    ----------
+    session_root : str
+        Folder the session was downloaded to, holding <sub>/<ses>.
+    raw_dir : str
+        The project's raw folder.
+    tmp_sub, tmp_ses : str
+        Subject and session folder names.
+    archive_options : dict
+        Archive format and compression settings.
+    scans_file : str
+        Path to the scans.tsv ledger.
+    scans_index : dict or None
+        In-memory ledger index, updated in place.
+    tracer : tracing.Tracer
+        Tracer recording the archive and ledger update spans.
+
+    Returns
+    -------
+    conversion : tuple
+        (tarball, sub, ses) to pass on to conversion_workflow.
+    """
+    # tar the session directory (as <sub>/<ses>) and copy to raw dir
+    if not op.isdir(op.join(raw_dir, tmp_sub, tmp_ses)):
+        os.makedirs(op.join(raw_dir, tmp_sub, tmp_ses), exist_ok=True)
+
+    with tracer.span('archive', sub=tmp_sub, ses=tmp_ses) as span:
+        tarball = write_archive(
+            op.join(session_root, tmp_sub, tmp_ses),
+            op.join(raw_dir, '{sub}/{ses}/{sub}-{ses}'.format(
+                sub=tmp_sub, ses=tmp_ses)),
+            archive_options,
+            arcname='{0}/{1}'.format(tmp_sub, tmp_ses))
+        shutil.rmtree(op.join(session_root, tmp_sub, tmp_ses))
+        try:
+            # the subject's other sessions may still be downloading
+            os.rmdir(op.join(session_root, tmp_sub))
+        except OSError:
+            pass
+        span['bytes'] = op.getsize(tarball)
+
+    moddate = os.path.getmtime(tarball)
+    timedateobj = datetime.datetime.fromtimestamp(moddate)
+    with tracer.span('scans_update', sub=tmp_sub, ses=tmp_ses):
+        append_scan(
+            scans_file,
+            {'sub': tmp_sub, 'ses': tmp_ses,
+             'file': op.basename(tarball),
+             'creation': datetime.datetime.strftime(
+                 timedateobj, "%m/%d/%Y, %H:%M")},
+            index=scans_index)
+
+    return (tarball, _strip_prefix(tmp_sub, 'sub-'),
+            _strip_prefix(tmp_ses, 'ses-'))
+
+
+def _write_message(message_file, project, sub, ses):
+    """Append a transferred session to the email message."""
+    date_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+    with open(message_file, 'a') as fo:
+        fcntl.flock(fo, fcntl.LOCK_EX)
+        fo.write('Data transferred from XNAT to FIU-HPC for '
+                 'Project: {proj} Subject: {sub} Session: {ses} '
+                 'on {datetime}\n'.format(
+                     proj=project, sub=sub, ses=ses, datetime=date_time))
+
+
+def process_session(session_root, tmp_sub, tmp_ses, raw_dir, message_file,
+                    config_options, archive_options, scans_file, tracer,
+                    protocol_options=None, deep_protocol_check=False):
+    """Protocol check and archive one downloaded session.
+
+    The protocol check runs only if protocol_options is given, with its
+    DICOM header cache in the project's code folder. Warnings are emailed
+    to the project personnel, the session is archived and added to the
+    ledger, and it is added to the transfer email.
+
+    Returns
+    -------
+    conversion : tuple
+        (tarball, sub, ses) to pass on to conversion_workflow.
+    """
+    if protocol_options is not None:
+        with tracer.span('protocol_check', sub=tmp_sub, ses=tmp_ses,
+                         deep=deep_protocol_check):
+            warnings = check_sessions(
+                session_root, [(tmp_sub, tmp_ses)], protocol_options,
+                deep=deep_protocol_check,
+                cache_file=op.join(op.dirname(raw_dir), 'code', HEADER_CACHE))
+        for (sub, ses), messages in warnings.items():
+            report_warnings(session_root, sub, ses, messages,
+                            protocol_options)
+
+    # the ledger file is locked, but the in-memory index is not thread-safe
+    conversion = archive_session(
+        session_root, raw_dir, tmp_sub, tmp_ses, archive_options, scans_file,
+        None, tracer)
+    _write_message(message_file, config_options['project'], tmp_sub,
+                   tmp_ses)
+    return conversion
+
+
+def _pull_sharded(scratch_xnatdownload, proj_work_dir, raw_dir, tar_list,
+                  message_file, config_options, xnat_options, shards,
+                  archive_options, scans_index, process, pipeline, tracer):
+    """Download new and amended XNAT experiments concurrently.
+
+    Experiments are listed through the XNAT REST API ("url" field of the
+    config's "xnat" settings). Those missing from the session index
+    (raw/sessions.json) are downloaded, one downloader call per experiment,
+    in up to `shards` concurrent calls. Those modified on XNAT since they were
+    indexed are re-fetched incrementally: their archive is unpacked and only
+    the new or changed series are downloaded. With "bandwidth_mbps" set,
+    fewer downloads run at once when they slow each other down, starting
+    from as many as the link carries at "stream_mbps", if set. Each
+    session is put on the pipeline as soon as its download finishes, to be
+    processed (see process_session) and added to the index.
+
+    Parameters
+    ----------
+    process : callable
+        process(session_root, sub, ses) checks and archives a session.
+    pipeline : callable
+        Returns a pipeline.SessionPipeline running a given process function.
+
+    Returns
+    -------
+    sessions : pipeline.SessionPipeline
+        The closed pipeline, holding the submitted conversions.
+    """
+    project = config_options['project']
+    xnat_url = xnat_options.get('url')
+    if not xnat_url:
+        raise ValueError('Sharded downloads require the XNAT url ("url" in '
+                         'the config\'s "xnat" field).')
+
+    session_index = SessionIndex(op.join(raw_dir, INDEX_FILE))
+    with tracer.span('list_experiments') as span:
+        experiments = list_experiments(xnat_url, project)
+        last_modified = {e['ID']: e.get('last_modified')
+                         for e in experiments}
+        pending = [e['ID'] for e in experiments
+                   if e['ID'] not in session_index]
+        amended = [e['ID'] for e in experiments
+                   if e['ID'] in session_index
+                   and session_index.changed(e['ID'], e.get('last_modified'))]
+        span['experiments'] = len(experiments)
+        span['pending'] = len(pending)
+        span['amended'] = len(amended)
+    print('{0} of {1} XNAT experiments are pending download, and {2} were '
+          'modified since they were downloaded.'.format(
+              len(pending), len(experiments), len(amended)))
+
+    # Only sessions archived before the index existed need to be skipped
+    # by name
+    write_processed_list(
+        {key: row for key, row in scans_index.items()
+         if session_index.find(*key) is None}, tar_list)
+
+    shards_dir = op.join(proj_work_dir, 'shards')
+    remote_scans = {}
+
+    def _download(experiment, shard_dir):
+        # Returns the bytes transferred and the transfer time, for the
+        # limiter. Unpacking an amended session's archive is not a transfer.
+        with tracer.span('list_scans', xnat_experiment=experiment):
+            scans = list_scans(xnat_url, experiment)
+        remote_scans[experiment] = scans
+        entry = session_index.get(experiment)
+        if entry is None:
+            cmd = ('{sing} -w {work_dir} --project {proj} --session '
+                   '{xnat_exp} --processed {tar_list}'.format(
+                       sing=scratch_xnatdownload, work_dir=shard_dir,
+                       proj=project, xnat_exp=experiment, tar_list=tar_list))
+            start = time.time()
+            with tracer.span('download', xnat_experiment=experiment) as span:
+                span['result'] = run(cmd, prefix='[{0}] '.format(experiment))
+            seconds = time.time() - start
+            raw_work_dir = op.join(shard_dir, 'raw')
+            if not op.isdir(raw_work_dir):
+                return None
+            return (sum(size for size, _ in
+                        build_manifest(raw_work_dir).values()), seconds)
+        if not entry.get('sub'):
+            # indexed without an archive (archived before the index)
+            return None
+
+        fetch = sorted(scan for scan, stat in scans.items()
+                       if entry.get('scans', {}).get(scan) != stat)
+        if not fetch:
+            return None
+        tarball = op.join(raw_dir, entry['sub'], entry['ses'], entry['file'])
+        session_root = op.join(shard_dir, 'raw')
+        if op.isfile(tarball) and checksum(tarball) == entry['checksum']:
+            with tracer.span('unpack', xnat_experiment=experiment):
+                stage_archive(tarball, session_root + '.tar',
+                              strategy='extract',
+                              threads=archive_options['threads'])
+        else:
+            print('Archive of XNAT experiment {0} does not match the index, '
+                  'so all of its scans will be downloaded.'.format(
+                      experiment))
+            fetch = sorted(scans)
+        start = time.time()
+        with tracer.span('download', xnat_experiment=experiment,
+                         scans=len(fetch)) as span:
+            span['bytes'] = download_scans(
+                xnat_url, experiment, fetch,
+                op.join(session_root, entry['sub'], entry['ses']))
+        seconds = time.time() - start
+        print('Re-fetched {0} new or changed series of XNAT experiment '
+              '{1}.'.format(len(fetch), experiment))
+        return span['bytes'], seconds
+
+    def _process(experiment, session_root, tmp_sub, tmp_ses):
+        if tmp_sub is None:
+            # nothing was downloaded: already archived, or unchanged scans
+            session_index.update(experiment,
+                                 last_modified=last_modified[experiment],
+                                 scans=remote_scans[experiment])
+            return None
+
+        conversion = process(session_root, tmp_sub, tmp_ses)
+        session_index.update(
+            experiment, sub=tmp_sub, ses=tmp_ses,
+            file=op.basename(conversion[0]), checksum=checksum(conversion[0]),
+            last_modified=last_modified[experiment],
+            scans=remote_scans[experiment])
+        return conversion
+
+    sessions = pipeline(_process)
+    limiter = BandwidthLimiter(shards, xnat_options.get('bandwidth_mbps'),
+                               xnat_options.get('stream_mbps'))
+    claim_work_dir(shards_dir)
+    try:
+        failures = download_sharded(pending + amended, _download, shards_dir,
+                                    limiter, sessions.put)
+    finally:
+        sessions.close()
+        # Sessions were journaled one by one; rewrite the index once
+        session_index.compact()
+    release_work_dir(shards_dir, remove=True)
+
+    failures.update(sessions.failures)
+    for experiment, exc in sorted(failures.items()):
+        print('Failed to download XNAT experiment {0}: {1}'.format(
+            experiment, exc))
+        with open(message_file, 'a') as fo:
+            fo.write('Failed to transfer XNAT experiment {0} for Project: '
+                     '{1}. It will be retried on the next run.\n'.format(
+                         experiment, project))
+    return sessions
+
+
 def main(bids_dir, config, work_dir=None, protocol_check=False,
-         autocheck=False, xnatexp=None):
+         deep_protocol_check=False, staged=False, autocheck=False,
+         xnatexp=None, shards=None):
     """Runtime for CIS processing."""
-    CIS_DIR = '/scratch/cis_dataqc/'
-
     # Check inputs
     if work_dir is None:
         work_dir = CIS_DIR
@@ -94,11 +513,13 @@ def main(bids_dir, config, work_dir=None, protocol_check=False,
         raise Exception('Config file must be updated with project field. '
                         'See sample config file for more information')
 
+    archive_options = get_archive_options(config_options)
+
     proj_work_dir = op.join(work_dir, config_options['project'])
-    if not proj_work_dir.startswith('/scratch'):
+    if not proj_work_dir.startswith(SCRATCH_DIR):
         raise ValueError('Working directory must be in scratch.')
 
-    xnatdownload_file = op.join('/home/data/cis/singularity-images/',
+    xnatdownload_file = op.join(SINGULARITY_DIR,
                                 config_options['xnatdownload'])
 
     # Additional checks and copying for XNAT Download file
@@ -115,166 +536,140 @@ def main(bids_dir, config, work_dir=None, protocol_check=False,
     if not op.isdir(proj_work_dir):
         os.makedirs(proj_work_dir)
 
+    # Downloads' sizes are not known up front, so only keep the reserve free
+    ensure_space(0, proj_work_dir,
+                 quota_gb=config_options.get('scratch_quota_gb'),
+                 reserve_gb=config_options.get('scratch_reserve_gb', 0),
+                 cache_dir=config_options.get('image_cache_dir'))
+
     raw_dir = op.join(proj_dir, 'raw')
     if not op.isdir(raw_dir):
         os.makedirs(raw_dir)
 
-    fdir = op.dirname(__file__)
-
-    scans_df = pd.read_csv(op.join(raw_dir, 'scans.tsv'), sep='\t')
-    scans_df = scans_df['file']
-    scans_df.to_csv(
-        op.join(
+    tracer = Tracer('pull', proj_dir)
+
+    try:
+        scans_file = op.join(raw_dir, 'scans.tsv')
+        scans_index = read_scans(scans_file)
+        write_processed_list(
+            scans_index,
+            op.join(
+                proj_work_dir,
+                '{0}-processed.txt'.format(config_options['project'])))
+
+        # Get singularity images from the shared scratch cache
+        with tracer.span('get_xnatdownload_image'):
+            scratch_xnatdownload = get_image(
+                xnatdownload_file,
+                cache_dir=config_options.get('image_cache_dir'),
+                max_size_gb=config_options.get('image_cache_size_gb'))
+
+        tar_list = op.join(proj_work_dir,
+                           '{0}-processed.txt'.format(config_options['project']))
+        message_file = op.join(
             proj_work_dir,
-            '{0}-processed.txt'.format(config_options['project'])),
-        sep='\t', line_terminator='\n', na_rep='n/a', index=False)
-
-    # Copy singularity images to scratch
-    scratch_xnatdownload = op.join(work_dir, op.basename(xnatdownload_file))
-    if not op.isfile(scratch_xnatdownload):
-        shutil.copyfile(xnatdownload_file, scratch_xnatdownload)
-        os.chmod(scratch_xnatdownload, 0o775)
-
-    # Run XNAT Download
-    if autocheck:
-        tar_list = op.join(
-            proj_work_dir,
-            '{0}-processed.txt'.format(config_options['project']))
-        cmd = ('{sing} -w {work_dir} --project {proj} --autocheck --processed '
-               '{tar_list}'.format(
-                   sing=scratch_xnatdownload,
-                   work_dir=proj_work_dir,
-                   proj=config_options['project'],
-                   tar_list=tar_list))
-        run(cmd)
-    elif xnatexp is not None:
-        tar_list = op.join(
-            proj_work_dir,
-            '{0}-processed.txt'.format(config_options['project']))
-        cmd = ('{sing} -w {work_dir} --project {proj} --session {xnat_exp} '
-               '--processed {tar_list}'.format(
-                   sing=scratch_xnatdownload,
-                   work_dir=proj_work_dir,
-                   proj=config_options['project'],
-                   xnat_exp=xnatexp,
-                   tar_list=tar_list))
-        run(cmd)
-    else:
-        raise Exception('A valid XNAT Experiment session was not entered for '
-                        'the project or you are not running autocheck.')
-
-    os.remove(
-        op.join(
-            proj_work_dir,
-            '{0}-processed.txt'.format(config_options['project'])))
-    os.remove(scratch_xnatdownload)
-    # Temporary raw directory in work_dir
-    raw_work_dir = op.join(proj_work_dir, 'raw')
-
-    if op.isdir(raw_work_dir):
-        # Check if anything was downloaded
-        for tmp_sub in os.listdir(raw_work_dir):
-            ses_list = os.listdir(op.join(raw_work_dir, tmp_sub))
-            for tmp_ses in ses_list:
-                # run the protocol check if requested
-                if protocol_check:
-                    cmd = ('python {fdir}/protocol_check.py -w {work_dir} '
-                           '--bids_dir {bids_dir} '
-                           '--sub {sub} --ses {ses}'.format(
-                               fdir=fdir,
-                               work_dir=raw_work_dir,
-                               bids_dir=bids_dir,
-                               sub=tmp_sub,
-                               ses=tmp_ses))
-                    run(cmd)
-
-                # tar the subject and session directory and copy to raw dir
-                if not op.isdir(op.join(raw_dir, tmp_sub, tmp_ses)):
-                    os.makedirs(op.join(raw_dir, tmp_sub, tmp_ses))
-
-                tarball = op.join(
-                    raw_dir,
-                    '{sub}/{ses}/{sub}-{ses}.tar'.format(
-                        sub=tmp_sub, ses=tmp_ses)
-                )
-                with tarfile.open(tarball, 'w') as tar:
-                    tar.add(
-                        op.join(raw_work_dir, tmp_sub),
-                        arcname=op.basename(op.join(raw_work_dir, tmp_sub)))
-                    shutil.rmtree(op.join(raw_work_dir, tmp_sub))
-
-                scans_df = pd.read_csv(op.join(raw_dir, 'scans.tsv'), sep='\t')
-                tmp_df = pd.DataFrame()
-                tmp_df = tmp_df.append({'sub': tmp_sub}, ignore_index=True)
-                tmp_df['ses'] = tmp_ses
-                tmp_df['file'] = '{sub}-{ses}.tar'.format(
-                    sub=tmp_sub, ses=tmp_ses)
-                moddate = os.path.getmtime(tarball)
-                timedateobj = datetime.datetime.fromtimestamp(moddate)
-                tmp_df['creation'] = datetime.datetime.strftime(
-                    timedateobj, "%m/%d/%Y, %H:%M")
-                scans_df = scans_df.append(tmp_df)
-                scans_df.to_csv(
-                    op.join(raw_dir, 'scans.tsv'), sep='\t',
-                    line_terminator='\n', na_rep='n/a', index=False)
-
-                # run conversion_workflow.py
-                err_file = op.join(
-                    proj_dir,
-                    'code/err/convert-{0}-{1}'.format(tmp_sub, tmp_ses)
-                )
-                out_file = op.join(
-                    proj_dir,
-                    'code/out/convert-{0}-{1}'.format(tmp_sub, tmp_ses)
-                )
-                cmd = ('sbatch -J convert-{proj}-{sub}-{ses} '
-                       '-e {err_file_loc} -o {out_file_loc} '
-                       '-c {nprocs} --qos {hpc_queue} --account {hpc_acct} '
-                       '-p centos7 '
-                       '--wrap="python {fdir}/conversion_workflow.py -t {tarball} '
-                       '-b {bids_dir} -w {work_dir} --config {config} '
-                       '--sub {sub} --ses {ses}"'.format(
-                           fdir=fdir,
-                           hpc_queue=config_options['hpc_queue'],
-                           hpc_acct=config_options['hpc_account'],
+            '{0}-processed-message.txt'.format(config_options['project']))
+        xnat_options = config_options.get('xnat', {})
+        if shards is None:
+            shards = xnat_options.get('shards', 1)
+
+        protocol_options = load_protocol(bids_dir) if protocol_check else None
+
+        def _process(session_root, tmp_sub, tmp_ses):
+            return process_session(
+                session_root, tmp_sub, tmp_ses, raw_dir, message_file,
+                config_options, archive_options, scans_file, tracer,
+                protocol_options=protocol_options,
+                deep_protocol_check=deep_protocol_check)
+
+        def _submit(conversions):
+            # run conversion_workflow.py for the sessions as one job array
+            with tracer.span('sbatch', sessions=len(conversions)):
+                submit_conversions(conversions, proj_dir, bids_dir,
+                                   proj_work_dir, config, config_options,
+                                   staged=staged)
+
+        def _pipeline(process):
+            # sessions are checked and archived by a pool of workers, and
+            # submitted while later sessions are still downloading
+            return SessionPipeline(
+                process, _submit,
+                n_workers=config_options.get('archive_workers', 2),
+                max_queue=config_options.get('archive_queue_size', 4),
+                submit_interval=config_options.get('submit_interval', 60))
+
+        # Run XNAT Download
+        if autocheck and shards > 1:
+            # list pending experiments, then download them in parallel shards
+            sessions = _pull_sharded(
+                scratch_xnatdownload, proj_work_dir, raw_dir, tar_list,
+                message_file, config_options, xnat_options, shards,
+                archive_options, scans_index, _process, _pipeline, tracer)
+            os.remove(tar_list)
+        else:
+            if autocheck:
+                cmd = ('{sing} -w {work_dir} --project {proj} --autocheck '
+                       '--processed {tar_list}'.format(
+                           sing=scratch_xnatdownload,
+                           work_dir=proj_work_dir,
                            proj=config_options['project'],
-                           err_file_loc=err_file,
-                           out_file_loc=out_file,
-                           tarball=tarball,
-                           bids_dir=bids_dir,
+                           tar_list=tar_list))
+                span_args = {}
+            elif xnatexp is not None:
+                cmd = ('{sing} -w {work_dir} --project {proj} --session '
+                       '{xnat_exp} --processed {tar_list}'.format(
+                           sing=scratch_xnatdownload,
                            work_dir=proj_work_dir,
-                           config=config,
-                           sub=tmp_sub.strip('sub-'),
-                           ses=tmp_ses.strip('ses-')))
-                run(cmd)
-
-                # get date and time
-                now = datetime.datetime.now()
-                date_time = now.strftime("%Y-%m-%d %H:%M")
-
-                # append the email message
-                message_file = op.join(
-                    proj_work_dir,
-                    '{0}-processed-message.txt'.format(
-                        config_options['project']))
+                           proj=config_options['project'],
+                           xnat_exp=xnatexp,
+                           tar_list=tar_list))
+                span_args = {'xnat_experiment': xnatexp}
+            else:
+                raise Exception('A valid XNAT Experiment session was not entered '
+                                'for the project or you are not running '
+                                'autocheck.')
+
+            def _download():
+                with tracer.span('download', **span_args) as span:
+                    span['result'] = run(cmd)
+
+            # Temporary raw directory in work_dir
+            raw_work_dir = op.join(proj_work_dir, 'raw')
+            claim_work_dir(raw_work_dir)
+            sessions = _pipeline(lambda key, *args: _process(*args))
+            try:
+                # each session goes down the pipeline once the downloader has
+                # moved on to the next one
+                watch_download(
+                    _download, raw_work_dir,
+                    lambda root, sub, ses: sessions.put(
+                        '{0}-{1}'.format(sub, ses), root, sub, ses),
+                    poll_interval=config_options.get('download_poll_interval',
+                                                     5))
+            finally:
+                sessions.close()
+                os.remove(tar_list)
+                release_work_dir(raw_work_dir, remove=True)
+
+            for session, exc in sorted(sessions.failures.items()):
+                print('Failed to archive {0}: {1}'.format(session, exc))
                 with open(message_file, 'a') as fo:
-                    fo.write('Data transferred from XNAT to FIU-HPC for '
-                             'Project: {proj} Subject: {sub} Session: {ses} '
-                             'on {datetime}\n'.format(
-                                 proj=config_options['project'],
-                                 sub=tmp_sub,
-                                 ses=tmp_ses,
-                                 datetime=date_time))
-
-        shutil.rmtree(op.join(raw_work_dir))
-
-        cmd = ("mail -s 'FIU XNAT-HPC Data Transfer Update Project {proj}' "
-               "{email_list} < {message}".format(
-                   proj=config_options['project'],
-                   email_list=config_options['email'],
-                   message=message_file))
-        run(cmd)
-        os.remove(message_file)
+                    fo.write('Failed to archive {0} for Project: {1}.\n'.format(
+                        session, config_options['project']))
+
+        if op.isfile(message_file):
+            cmd = ("mail -s 'FIU XNAT-HPC Data Transfer Update Project {proj}' "
+                   "{email_list} < {message}".format(
+                       proj=config_options['project'],
+                       email_list=config_options['email'],
+                       message=message_file))
+            run(cmd)
+            os.remove(message_file)
+
+        if sessions.submit_errors:
+            raise sessions.submit_errors[0]
+    finally:
+        tracer.close()
 
 
 def _main(argv=None):
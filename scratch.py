@@ -0,0 +1,436 @@
+"""Scratch space admission control and eviction of abandoned work dirs.
+
+Jobs claim their working directories in /scratch. A claim is a heartbeat
+file in a central registry (<CIS_DIR>/.heartbeats), holding the directory's
+path, host, PID and SLURM job ID. The claiming process holds a shared lock on
+the file, and a background thread touches it every HEARTBEAT_INTERVAL
+seconds. A directory is live while its heartbeat is locked or was touched
+within STALE_AFTER seconds (locks are not always visible across nodes), so
+directories of running jobs are never evicted. A directory left behind by a
+crashed or failed job keeps its heartbeat file until it is evicted, so it can
+still be resumed until scratch space runs low.
+
+Before staging, a job estimates its footprint (staged archive, images not
+yet cached and the MRIQC working directory) and checks it against free space
+and the optional quota. When space runs low, stale work dirs and unused
+image cache entries are evicted, least recently used first.
+
+Run this module to list claimed work dirs or to collect garbage::
+
+    python scratch.py status
+    python scratch.py gc --min-age 24
+    python scratch.py gc --free-gb 500 --dry-run
+"""
+import os
+import os.path as op
+import json
+import time
+import fcntl
+import socket
+import shutil
+import hashlib
+import argparse
+import threading
+
+from utils import CIS_DIR
+import image_cache
+
+HEARTBEAT_DIR = op.join(CIS_DIR, '.heartbeats')
+HEARTBEAT_INTERVAL = 60
+STALE_AFTER = 15 * 60
+# Typical zstd compression ratio of DICOM archives
+ZSTD_RATIO = 3
+# Default size of a session's MRIQC working directory
+MRIQC_SCRATCH_GB = 4
+
+# Claims held by this process, keyed by work dir
+_CLAIMS = {}
+
+
+class ScratchSpaceError(Exception):
+    """Not enough scratch space, even after evicting stale data."""
+
+
+def _heartbeat_file(work_dir, heartbeat_dir=None):
+    if heartbeat_dir is None:
+        heartbeat_dir = HEARTBEAT_DIR
+    key = hashlib.sha1(op.abspath(work_dir).encode()).hexdigest()
+    return op.join(heartbeat_dir, key + '.json')
+
+
+def _beat(heartbeat_file, stop):
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            os.utime(heartbeat_file)
+        except OSError:
+            pass
+
+
+def claim_work_dir(work_dir, heartbeat_dir=None):
+    """Mark a work dir as in use by this process.
+
+    The claim lasts until release_work_dir is called or the process exits.
+
+    Parameters
+    ----------
+    work_dir : str
+        Working directory.
+    heartbeat_dir : str or None, optional
+        Heartbeat registry. Default is HEARTBEAT_DIR.
+    """
+    work_dir = op.abspath(work_dir)
+    if work_dir in _CLAIMS:
+        return
+    if heartbeat_dir is None:
+        heartbeat_dir = HEARTBEAT_DIR
+    os.makedirs(heartbeat_dir, exist_ok=True)
+    heartbeat_file = _heartbeat_file(work_dir, heartbeat_dir)
+    while True:
+        lock_fo = open(heartbeat_file, 'a')
+        fcntl.flock(lock_fo, fcntl.LOCK_SH)
+        # The file may have been removed by an eviction we waited on
+        try:
+            if os.fstat(lock_fo.fileno()).st_ino == os.stat(
+                    heartbeat_file).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        lock_fo.close()
+
+    # Rewrite the contents through the locked inode
+    os.ftruncate(lock_fo.fileno(), 0)
+    json.dump({'work_dir': work_dir, 'host': socket.gethostname(),
+               'pid': os.getpid(), 'job_id': os.environ.get('SLURM_JOB_ID'),
+               'claimed': time.time()}, lock_fo)
+    lock_fo.flush()
+
+    stop = threading.Event()
+    thread = threading.Thread(target=_beat, args=(heartbeat_file, stop),
+                              daemon=True)
+    thread.start()
+    _CLAIMS[work_dir] = (lock_fo, stop, heartbeat_file)
+
+
+def release_work_dir(work_dir, remove=False):
+    """End this process's claim on a work dir.
+
+    Parameters
+    ----------
+    work_dir : str
+        Working directory.
+    remove : bool, optional
+        Whether to remove the directory and its heartbeat (e.g., after a
+        successful run). Otherwise the heartbeat goes stale, and the
+        directory can be resumed until it is evicted. Default is False.
+    """
+    work_dir = op.abspath(work_dir)
+    claim = _CLAIMS.pop(work_dir, None)
+    if claim is not None:
+        lock_fo, stop, heartbeat_file = claim
+        stop.set()
+    else:
+        lock_fo, heartbeat_file = None, _heartbeat_file(work_dir)
+    if remove:
+        if op.isdir(work_dir):
+            shutil.rmtree(work_dir)
+        if op.isfile(heartbeat_file):
+            os.remove(heartbeat_file)
+    if lock_fo is not None:
+        lock_fo.close()
+
+
+def tree_size(path):
+    """Total size of the files under path, in bytes."""
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            continue
+    return total
+
+
+def list_work_dirs(heartbeat_dir=None, stale_after=STALE_AFTER):
+    """List claimed work dirs.
+
+    Returns
+    -------
+    work_dirs : list of dict
+        "work_dir", "heartbeat_file", "last_beat" (time), "live" and the
+        claim's "host", "pid" and "job_id", least recently used first.
+    """
+    if heartbeat_dir is None:
+        heartbeat_dir = HEARTBEAT_DIR
+    work_dirs = []
+    if not op.isdir(heartbeat_dir):
+        return work_dirs
+    now = time.time()
+    for fname in os.listdir(heartbeat_dir):
+        if not fname.endswith('.json'):
+            continue
+        heartbeat_file = op.join(heartbeat_dir, fname)
+        try:
+            with open(heartbeat_file, 'r') as fo:
+                info = json.load(fo)
+            last_beat = os.stat(heartbeat_file).st_mtime
+        except (OSError, ValueError):
+            # being written
+            continue
+        with open(heartbeat_file, 'a') as lock_fo:
+            try:
+                fcntl.flock(lock_fo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = False
+            except OSError:
+                locked = True
+        info.update({'heartbeat_file': heartbeat_file, 'last_beat': last_beat,
+                     'live': locked or now - last_beat < stale_after})
+        work_dirs.append(info)
+    return sorted(work_dirs, key=lambda info: info['last_beat'])
+
+
+def _evict_work_dir(info):
+    """Remove a stale work dir unless it was claimed meanwhile."""
+    with open(info['heartbeat_file'], 'a') as lock_fo:
+        try:
+            fcntl.flock(lock_fo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        if os.stat(info['heartbeat_file']).st_mtime != info['last_beat']:
+            # touched since it was listed
+            return False
+        if op.isdir(info['work_dir']):
+            shutil.rmtree(info['work_dir'])
+        os.remove(info['heartbeat_file'])
+    return True
+
+
+def find_evictable(heartbeat_dir=None, cache_dir=None,
+                   stale_after=STALE_AFTER, min_age=0):
+    """List stale work dirs and image cache entries, least recently used first.
+
+    Work dirs holding a live work dir are left out.
+
+    Returns
+    -------
+    candidates : list of tuple
+        (last use time, size in bytes, kind, item), where kind is "work_dir"
+        (item is a list_work_dirs entry) or "image" (item is a cache key).
+    """
+    now = time.time()
+    work_dirs = list_work_dirs(heartbeat_dir, stale_after)
+    live = [info['work_dir'] for info in work_dirs if info['live']]
+    candidates = []
+    for info in work_dirs:
+        if info['live'] or now - info['last_beat'] < min_age:
+            continue
+        if any(op.commonpath([info['work_dir'], path]) == info['work_dir']
+               for path in live):
+            continue
+        candidates.append((info['last_beat'], tree_size(info['work_dir']),
+                           'work_dir', info))
+    for last_used, size, key in image_cache.list_entries(cache_dir):
+        if now - last_used >= min_age:
+            candidates.append((last_used, size, 'image', key))
+    return sorted(candidates, key=lambda candidate: candidate[0])
+
+
+def evict(target_bytes=None, heartbeat_dir=None, cache_dir=None,
+          stale_after=STALE_AFTER, min_age=0, dry_run=False):
+    """Evict stale work dirs and unused cached images in LRU order.
+
+    Parameters
+    ----------
+    target_bytes : int or None, optional
+        Stop once this many bytes were freed. Default is None (evict every
+        candidate).
+    min_age : float, optional
+        Only evict items unused for this many seconds. Default is 0.
+    dry_run : bool, optional
+        Only report what would be evicted. Default is False.
+
+    Returns
+    -------
+    freed : int
+        Number of bytes freed.
+    """
+    if cache_dir is None:
+        cache_dir = image_cache.CACHE_DIR
+    freed = 0
+    for last_used, size, kind, item in find_evictable(
+            heartbeat_dir, cache_dir, stale_after, min_age):
+        if target_bytes is not None and freed >= target_bytes:
+            break
+        name = item['work_dir'] if kind == 'work_dir' else item
+        if dry_run:
+            evicted = True
+        elif kind == 'work_dir':
+            evicted = _evict_work_dir(item)
+        else:
+            evicted = image_cache.evict_entry(cache_dir, item)
+        if evicted:
+            freed += size
+            print('{0} {1} {2} ({3:.2f} GB, last used {4}).'.format(
+                'Would evict' if dry_run else 'Evicted', kind, name,
+                size / 1024 ** 3, time.strftime('%Y-%m-%d %H:%M',
+                                                time.localtime(last_used))))
+    return freed
+
+
+def available_bytes(path, quota_gb=None, scratch_dir=None):
+    """Free space for a path, capped by a quota on scratch_dir's usage."""
+    while not op.exists(path):
+        path = op.dirname(path)
+    available = shutil.disk_usage(path).free
+    if quota_gb is not None:
+        if scratch_dir is None:
+            scratch_dir = CIS_DIR
+        available = min(available,
+                        int(quota_gb * 1024 ** 3) - tree_size(scratch_dir))
+    return available
+
+
+def estimate_footprint(tarball=None, strategy='auto', images=(),
+                       cache_dir=None, mriqc_gb=0):
+    """Estimate the scratch space a conversion job needs.
+
+    Parameters
+    ----------
+    tarball : str or None, optional
+        Raw data archive to stage, if any. Default is None.
+    strategy : str, optional
+        Staging strategy (see utils.stage_archive). Default is "auto".
+    images : list of str, optional
+        Singularity images the job uses. Those not cached yet count in
+        full. Default is ().
+    cache_dir : str or None, optional
+        Image cache directory. Default is image_cache.CACHE_DIR.
+    mriqc_gb : float, optional
+        Size of MRIQC's working directory. Default is 0.
+
+    Returns
+    -------
+    footprint : int
+        Estimated number of bytes.
+    """
+    if cache_dir is None:
+        cache_dir = image_cache.CACHE_DIR
+    footprint = int(mriqc_gb * 1024 ** 3)
+    if tarball is not None:
+        size = op.getsize(tarball)
+        if tarball.endswith('.tar.zst'):
+            footprint += size * ZSTD_RATIO
+        elif strategy not in ('auto', 'bind', 'hardlink', 'reflink'):
+            # "auto" binds tar files in place when it cannot link them
+            footprint += size
+    for image_file in images:
+        if not op.isdir(op.join(cache_dir,
+                                image_cache._entry_key(image_file))):
+            footprint += op.getsize(image_file)
+    return footprint
+
+
+def ensure_space(needed, path, quota_gb=None, reserve_gb=0, cache_dir=None,
+                 heartbeat_dir=None):
+    """Make sure a job fits in scratch, evicting stale data if needed.
+
+    Parameters
+    ----------
+    needed : int
+        Number of bytes the job needs (see estimate_footprint).
+    path : str
+        Path in the scratch filesystem (e.g., the job's work dir).
+    quota_gb : float or None, optional
+        Scratch quota for CIS_DIR. Default is None (no quota).
+    reserve_gb : float, optional
+        Space to keep free on top of the job's needs. Default is 0.
+
+    Returns
+    -------
+    freed : int
+        Number of bytes evicted.
+    """
+    needed += int(reserve_gb * 1024 ** 3)
+    available = available_bytes(path, quota_gb)
+    shortfall = needed - available
+    if shortfall <= 0:
+        return 0
+    print('Scratch is {0:.2f} GB short of the {1:.2f} GB needed; evicting '
+          'stale data.'.format(shortfall / 1024 ** 3, needed / 1024 ** 3))
+    freed = evict(shortfall, heartbeat_dir=heartbeat_dir, cache_dir=cache_dir)
+    # Evicted data frees both disk space and quota, so scratch is not
+    # walked again
+    available += freed
+    if needed > available:
+        raise ScratchSpaceError(
+            'Not enough scratch space: {0:.2f} GB needed, {1:.2f} GB '
+            'available after evicting {2:.2f} GB of stale data.'.format(
+                needed / 1024 ** 3, available / 1024 ** 3,
+                freed / 1024 ** 3))
+    return freed
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Manage CIS scratch space.')
+    parser.add_argument('--heartbeat-dir', dest='heartbeat_dir',
+                        default=None,
+                        help='Heartbeat registry. Defaults to {0}.'.format(
+                            HEARTBEAT_DIR))
+    parser.add_argument('--cache-dir', dest='cache_dir', default=None,
+                        help='Singularity image cache. Defaults to '
+                             '{0}.'.format(image_cache.CACHE_DIR))
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    subparsers.add_parser('status', help='List claimed work dirs.')
+
+    gc_parser = subparsers.add_parser(
+        'gc', help='Evict stale work dirs and unused cached images.')
+    gc_parser.add_argument('--min-age', dest='min_age', type=float,
+                           default=24,
+                           help='Only evict items unused for this many '
+                                'hours.')
+    gc_parser.add_argument('--free-gb', dest='free_gb', type=float,
+                           default=None,
+                           help='Only evict until this much space is free, '
+                                'least recently used first.')
+    gc_parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                           help='Only list what would be evicted.')
+    return parser
+
+
+def _main(argv=None):
+    options = _get_parser().parse_args(argv)
+    if options.command == 'status':
+        row = '{0:<6} {1:>9} {2:<16} {3:<12} {4:<10} {5}'
+        print(row.format('state', 'size (GB)', 'last heartbeat', 'host',
+                         'job', 'work dir'))
+        for info in list_work_dirs(options.heartbeat_dir):
+            print(row.format(
+                'live' if info['live'] else 'stale',
+                '{0:.2f}'.format(tree_size(info['work_dir']) / 1024 ** 3),
+                time.strftime('%Y-%m-%d %H:%M',
+                              time.localtime(info['last_beat'])),
+                info['host'], info['job_id'] or info['pid'],
+                info['work_dir']))
+        return
+
+    target = None
+    if options.free_gb is not None:
+        target = max(0, int(options.free_gb * 1024 ** 3)
+                     - available_bytes(CIS_DIR))
+    freed = evict(target, heartbeat_dir=options.heartbeat_dir,
+                  cache_dir=options.cache_dir,
+                  min_age=options.min_age * 3600, dry_run=options.dry_run)
+    print('{0} {1:.2f} GB.'.format(
+        'Would free' if options.dry_run else 'Freed', freed / 1024 ** 3))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,184 @@
+"""A persistent index of downloaded XNAT sessions (raw/sessions.json).
+
+For each XNAT experiment, the index records where it was archived (subject,
+session and archive file), the archive's checksum, XNAT's last modification
+time, and the number of files and bytes of each scan at download time. Its
+entries are keyed by experiment ID, with a second in-memory index by
+(sub, ses), so lookups take constant time however many sessions it holds.
+
+The index lets pull_dicoms_workflow detect sessions that were amended on
+XNAT after they were downloaded (a newer "last_modified"), and re-fetch only
+the series that are new or changed.
+
+Updates are appended to a journal (sessions.json.journal) under a file lock
+(sessions.json.lock), so recording a session costs the same however many
+sessions the index holds, and concurrent writers never lose each other's
+entries. Loading the index replays the journal on top of sessions.json, and
+SessionIndex.compact folds the journal into sessions.json (e.g., once per
+pull).
+"""
+import os
+import os.path as op
+import json
+import fcntl
+import hashlib
+import argparse
+import datetime
+
+INDEX_FILE = 'sessions.json'
+
+
+def checksum(in_file):
+    """SHA-1 checksum of a file."""
+    sha1 = hashlib.sha1()
+    with open(in_file, 'rb') as fo:
+        for chunk in iter(lambda: fo.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _journal_file(index_file):
+    return index_file + '.journal'
+
+
+def _load(index_file):
+    """Load the index and replay its journal (lock held)."""
+    sessions = {}
+    if op.isfile(index_file):
+        with open(index_file, 'r') as fo:
+            sessions = json.load(fo)
+    if op.isfile(_journal_file(index_file)):
+        with open(_journal_file(index_file), 'r') as fo:
+            for line in fo:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                entry = sessions.setdefault(record['experiment'],
+                                            {'sub': None, 'ses': None})
+                entry.update(record['fields'])
+    return sessions
+
+
+class SessionIndex(object):
+    """Downloaded sessions, keyed by XNAT experiment ID.
+
+    Parameters
+    ----------
+    index_file : str
+        Path to the index. A missing file is treated as empty.
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        with open(index_file + '.lock', 'a') as lock_fo:
+            fcntl.flock(lock_fo, fcntl.LOCK_SH)
+            self.sessions = _load(index_file)
+        self.by_session = {(entry['sub'], entry['ses']): experiment
+                           for experiment, entry in self.sessions.items()
+                           if entry.get('sub')}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, experiment):
+        return experiment in self.sessions
+
+    def get(self, experiment):
+        """Entry of an experiment, or None."""
+        return self.sessions.get(experiment)
+
+    def find(self, sub, ses):
+        """Experiment ID archived as a subject and session, or None."""
+        return self.by_session.get((sub, ses))
+
+    def changed(self, experiment, last_modified):
+        """Whether an indexed experiment was modified on XNAT since."""
+        entry = self.sessions[experiment]
+        return bool(last_modified) and entry.get(
+            'last_modified') != last_modified
+
+    def update(self, experiment, **fields):
+        """Add or update an experiment's entry, appending it to the journal.
+
+        Parameters
+        ----------
+        experiment : str
+            XNAT experiment ID.
+        **fields
+            Values to set, among "sub", "ses", "file", "checksum",
+            "last_modified", "scans" ([n_files, n_bytes] keyed by scan ID).
+            The total number of scans and bytes are derived from "scans".
+        """
+        fields = dict(fields)
+        if 'scans' in fields:
+            fields['n_scans'] = len(fields['scans'])
+            fields['bytes'] = sum(stat[1]
+                                  for stat in fields['scans'].values())
+        fields['updated'] = datetime.datetime.now().isoformat()
+        with open(self.index_file + '.lock', 'a') as lock_fo:
+            fcntl.flock(lock_fo, fcntl.LOCK_EX)
+            with open(_journal_file(self.index_file), 'a+') as fo:
+                # Guard against a final line cut short by a crash
+                if fo.tell() > 0:
+                    fo.seek(fo.tell() - 1)
+                    if fo.read(1) != '\n':
+                        fo.write('\n')
+                fo.write(json.dumps({'experiment': experiment,
+                                     'fields': fields}) + '\n')
+                fo.flush()
+                os.fsync(fo.fileno())
+
+        entry = self.sessions.setdefault(experiment,
+                                         {'sub': None, 'ses': None})
+        entry.update(fields)
+        if entry.get('sub'):
+            self.by_session[(entry['sub'], entry['ses'])] = experiment
+        return entry
+
+    def compact(self):
+        """Fold the journal into the index file.
+
+        The index is written to a temporary file and renamed into place
+        before the journal is removed, while holding the lock. A crash in
+        between only leaves journal entries to be replayed again.
+        """
+        with open(self.index_file + '.lock', 'a') as lock_fo:
+            fcntl.flock(lock_fo, fcntl.LOCK_EX)
+            if not op.isfile(_journal_file(self.index_file)):
+                return
+            sessions = _load(self.index_file)
+            tmp_file = '{0}.tmp-{1}'.format(self.index_file, os.getpid())
+            with open(tmp_file, 'w') as fo:
+                json.dump(sessions, fo, indent=1, sort_keys=True)
+            os.replace(tmp_file, self.index_file)
+            os.remove(_journal_file(self.index_file))
+        self.sessions = sessions
+        self.by_session = {(entry['sub'], entry['ses']): experiment
+                           for experiment, entry in sessions.items()
+                           if entry.get('sub')}
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Show downloaded XNAT sessions.')
+    parser.add_argument('index_file', help='Path to raw/sessions.json.')
+    return parser
+
+
+def _main(argv=None):
+    options = _get_parser().parse_args(argv)
+    index = SessionIndex(options.index_file)
+    row = '{0:<16} {1:<14} {2:<10} {3:>6} {4:>12}  {5}'
+    print(row.format('experiment', 'sub', 'ses', 'scans', 'bytes',
+                     'last_modified'))
+    for experiment, entry in sorted(index.sessions.items()):
+        print(row.format(experiment, entry.get('sub') or 'n/a',
+                         entry.get('ses') or 'n/a', entry.get('n_scans', 0),
+                         entry.get('bytes', 0),
+                         entry.get('last_modified') or 'n/a'))
+
+
+if __name__ == '__main__':
+    _main()
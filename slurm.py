@@ -0,0 +1,124 @@
+"""Submit cis-processing jobs to SLURM."""
+import os
+import os.path as op
+
+from utils import run
+
+MANIFEST_COLUMNS = ['tarball', 'sub', 'ses']
+
+
+def write_manifest(manifest_file, rows):
+    """Write a job array manifest.
+
+    Parameters
+    ----------
+    manifest_file : str
+        Output TSV file.
+    rows : list of tuple
+        (tarball, sub, ses) for each array task, in task ID order.
+    """
+    manifest_dir = op.dirname(manifest_file)
+    if not op.isdir(manifest_dir):
+        os.makedirs(manifest_dir)
+
+    with open(manifest_file, 'w') as fo:
+        fo.write('\t'.join(MANIFEST_COLUMNS) + '\n')
+        for row in rows:
+            fo.write('\t'.join(row) + '\n')
+
+
+def read_manifest_row(manifest_file, task_id=None):
+    """Read one array task's row from a manifest.
+
+    Parameters
+    ----------
+    manifest_file : str
+        Manifest written by write_manifest.
+    task_id : int or None, optional
+        Array task ID. Default is the SLURM_ARRAY_TASK_ID environment
+        variable.
+
+    Returns
+    -------
+    row : dict
+        The task's tarball, sub and ses.
+    """
+    if task_id is None:
+        if 'SLURM_ARRAY_TASK_ID' not in os.environ:
+            raise ValueError('SLURM_ARRAY_TASK_ID must be set to read a job '
+                             'from a manifest.')
+        task_id = os.environ['SLURM_ARRAY_TASK_ID']
+
+    with open(manifest_file, 'r') as fo:
+        lines = fo.read().splitlines()
+
+    header = lines[0].split('\t')
+    rows = lines[1:]
+    if not 0 <= int(task_id) < len(rows):
+        raise ValueError('Task {0} is not in manifest {1}, which has {2} '
+                         'rows.'.format(task_id, manifest_file, len(rows)))
+    return dict(zip(header, rows[int(task_id)].split('\t')))
+
+
+def sbatch(wrap, job_name, err_file, out_file, config_options, nprocs=1,
+           array_size=None, throttle=None, dependency=None, mem=None,
+           time=None):
+    """Submit a command as a SLURM job and return its job ID.
+
+    Parameters
+    ----------
+    wrap : str
+        Command to run in the job.
+    job_name : str
+        Job name.
+    err_file, out_file : str
+        Standard error and output files. For job arrays, SLURM's %A (job ID)
+        and %a (task ID) patterns may be used.
+    config_options : dict
+        Project configuration, with "hpc_queue" and "hpc_account" fields.
+    nprocs : int, optional
+        Number of cores per task. Default is 1.
+    array_size : int or None, optional
+        Submit a job array with this many tasks. Default is None.
+    throttle : int or None, optional
+        Maximum number of array tasks running at once. Default is None.
+    dependency : str or None, optional
+        SLURM dependency specification (e.g., "afterok:1234").
+        Default is None.
+    mem : str or None, optional
+        Memory per node (e.g., "16G"). Default is None.
+    time : str or None, optional
+        Time limit (e.g., "04:00:00"). Default is None.
+
+    Returns
+    -------
+    job_id : str
+        The submitted job's ID.
+    """
+    options = ''
+    if array_size is not None:
+        options += '--array=0-{0}{1} '.format(
+            array_size - 1, '%{0}'.format(throttle) if throttle else '')
+    if dependency:
+        options += '--dependency={0} '.format(dependency)
+    if mem:
+        options += '--mem={0} '.format(mem)
+    if time:
+        options += '--time={0} '.format(time)
+
+    cmd = ('sbatch --parsable -J {job_name} '
+           '-e {err_file_loc} -o {out_file_loc} '
+           '-c {nprocs} --qos {hpc_queue} --account {hpc_acct} '
+           '-p centos7 {options}'
+           '--wrap="{wrap}"'.format(
+               job_name=job_name,
+               err_file_loc=err_file,
+               out_file_loc=out_file,
+               nprocs=nprocs,
+               hpc_queue=config_options['hpc_queue'],
+               hpc_acct=config_options['hpc_account'],
+               options=options,
+               wrap=wrap))
+    output = run(cmd).output
+    # --parsable prints "<job ID>[;<cluster>]"
+    return output.strip().splitlines()[-1].split(';')[0]
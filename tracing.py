@@ -0,0 +1,206 @@
+"""Per-stage timing traces for cis-processing workflows.
+
+Each workflow run records a span for every stage, with its duration, bytes
+moved and exit status. Spans are appended to a JSON lines file as they end,
+and a Chrome trace file (viewable in chrome://tracing or Perfetto) is
+written when the run finishes (see Tracer.close). Both go to code/trace,
+next to the code/out logs.
+
+Run this module on many trace files to summarize the time spent in each
+stage across sessions::
+
+    python tracing.py /path/to/project/code/trace/*.jsonl
+"""
+import os
+import os.path as op
+import json
+import math
+import time
+import atexit
+import argparse
+import datetime
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from utils import RunResult, CommandError
+
+
+class Tracer(object):
+    """Record workflow stages as timed spans.
+
+    Parameters
+    ----------
+    workflow : str or None
+        Workflow name (e.g., "conversion"). If None, spans are timed but not
+        written anywhere.
+    proj_dir : str or None, optional
+        Project directory. Traces are written to its code/trace folder.
+    **labels
+        Labels (e.g., sub and ses) added to every span.
+    """
+
+    def __init__(self, workflow, proj_dir=None, **labels):
+        self.workflow = workflow
+        self.labels = labels
+        self.events = []
+        self._lock = threading.Lock()
+        self.jsonl_file = None
+        self.chrome_file = None
+        if workflow is None or proj_dir is None:
+            return
+
+        trace_dir = op.join(proj_dir, 'code', 'trace')
+        if not op.isdir(trace_dir):
+            os.makedirs(trace_dir, exist_ok=True)
+        name = '-'.join([workflow] + [str(v) for v in labels.values()]
+                        + [datetime.datetime.now().strftime('%Y%m%d-%H%M%S'),
+                           str(os.getpid())])
+        self.jsonl_file = op.join(trace_dir, name + '.jsonl')
+        self.chrome_file = op.join(trace_dir, name + '.trace.json')
+        atexit.register(self.close)
+
+    @contextmanager
+    def span(self, stage, **args):
+        """Time a stage.
+
+        Yields a dictionary of span arguments that the stage can fill in
+        (e.g., "bytes"). RunResult values are expanded into the command's
+        return code, CPU time and peak RSS.
+        """
+        start = time.time()
+        status = 'ok'
+        try:
+            yield args
+        except BaseException as exc:
+            status = 'error'
+            args['error'] = str(exc).splitlines()[0] if str(exc) else \
+                type(exc).__name__
+            if isinstance(exc, CommandError):
+                args['result'] = exc.result
+            raise
+        finally:
+            self._record(stage, start, time.time() - start, status, args)
+
+    def _record(self, stage, start, duration, status, args):
+        span = OrderedDict([('workflow', self.workflow), ('stage', stage),
+                            ('start', start), ('duration', duration),
+                            ('status', status)])
+        span.update(self.labels)
+        for key, value in args.items():
+            if isinstance(value, RunResult):
+                span['returncode'] = value.returncode
+                span['cpu_time'] = value.cpu_time
+                span['max_rss'] = value.max_rss
+            else:
+                span[key] = value
+        span['thread'] = threading.get_ident()
+
+        with self._lock:
+            self.events.append(span)
+            if self.jsonl_file is not None:
+                with open(self.jsonl_file, 'a') as fo:
+                    fo.write(json.dumps(span) + '\n')
+
+    def close(self):
+        """Write the Chrome trace file.
+
+        Workflows call this when they finish; otherwise it is called at
+        exit. Nothing is written if the trace folder has since been removed.
+        """
+        if self.chrome_file is None:
+            return
+        atexit.unregister(self.close)
+        if not op.isdir(op.dirname(self.chrome_file)):
+            return
+        trace_events = []
+        for span in self.events:
+            trace_events.append({
+                'name': span['stage'],
+                'cat': span['workflow'],
+                'ph': 'X',
+                'ts': int(span['start'] * 1e6),
+                'dur': int(span['duration'] * 1e6),
+                'pid': os.getpid(),
+                'tid': span['thread'],
+                'args': {k: v for k, v in span.items()
+                         if k not in ('stage', 'workflow', 'start',
+                                      'duration', 'thread')},
+            })
+        with open(self.chrome_file, 'w') as fo:
+            json.dump({'traceEvents': trace_events}, fo)
+
+
+def _percentile(values, q):
+    """Nearest-rank percentile of a sorted list.
+
+    Examples
+    --------
+    >>> _percentile([1, 2], 50)
+    1
+    >>> _percentile(list(range(1, 21)), 95)
+    19
+    """
+    rank = int(math.ceil(q * len(values) / 100.)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def summarize(jsonl_files):
+    """Summarize span durations per workflow stage.
+
+    Returns
+    -------
+    summary : list of dict
+        Count, failures, p50, p95 and total duration (in seconds) and total
+        bytes for each (workflow, stage).
+    """
+    durations = OrderedDict()
+    failures = {}
+    nbytes = {}
+    for jsonl_file in jsonl_files:
+        with open(jsonl_file, 'r') as fo:
+            for line in fo:
+                if not line.strip():
+                    continue
+                span = json.loads(line)
+                key = (span['workflow'], span['stage'])
+                durations.setdefault(key, []).append(span['duration'])
+                failures[key] = (failures.get(key, 0)
+                                 + (span['status'] != 'ok'))
+                nbytes[key] = nbytes.get(key, 0) + span.get('bytes', 0)
+
+    summary = []
+    for (workflow, stage), values in durations.items():
+        values = sorted(values)
+        summary.append(OrderedDict([
+            ('workflow', workflow), ('stage', stage), ('n', len(values)),
+            ('failed', failures[(workflow, stage)]),
+            ('p50', _percentile(values, 50)),
+            ('p95', _percentile(values, 95)),
+            ('total', sum(values)),
+            ('bytes', nbytes[(workflow, stage)])]))
+    return summary
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Summarize stage timings across workflow traces.')
+    parser.add_argument('jsonl_files', nargs='+',
+                        help='Trace files (code/trace/*.jsonl).')
+    return parser
+
+
+def _main(argv=None):
+    options = _get_parser().parse_args(argv)
+    row = '{0:<12} {1:<28} {2:>6} {3:>6} {4:>10} {5:>10} {6:>12} {7:>14}'
+    print(row.format('workflow', 'stage', 'n', 'failed', 'p50 (s)',
+                     'p95 (s)', 'total (s)', 'bytes'))
+    for stats in summarize(options.jsonl_files):
+        print(row.format(stats['workflow'], stats['stage'], stats['n'],
+                         stats['failed'], '{0:.2f}'.format(stats['p50']),
+                         '{0:.2f}'.format(stats['p95']),
+                         '{0:.2f}'.format(stats['total']), stats['bytes']))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,145 @@
+"""Incrementally mirror a directory tree (e.g., templateflow) into scratch.
+
+Only files whose size or modification time changed are copied, in parallel.
+Many jobs may start at once, so the copy is done under a lock, and a
+completion marker holding the source manifest is written only once the
+mirror is complete. A copy interrupted by a killed job therefore has no
+marker and is finished by the next job instead of being treated as done.
+"""
+import os
+import os.path as op
+import json
+import fcntl
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+COMPLETE_MARKER = '.sync_complete'
+
+
+def build_manifest(src_dir):
+    """List the files in a tree with their sizes and modification times.
+
+    Returns
+    -------
+    manifest : dict
+        [size, mtime] keyed by path relative to src_dir.
+    """
+    manifest = {}
+    stack = [src_dir]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=True):
+                    stack.append(entry.path)
+                else:
+                    stat = entry.stat()
+                    manifest[op.relpath(entry.path, src_dir)] = [
+                        stat.st_size, int(stat.st_mtime)]
+    return manifest
+
+
+def _read_marker(dst_dir):
+    marker = op.join(dst_dir, COMPLETE_MARKER)
+    if not op.isfile(marker):
+        return None
+    with open(marker, 'r') as fo:
+        return json.load(fo)
+
+
+def _copy_file(src_file, dst_file):
+    dst_subdir = op.dirname(dst_file)
+    if not op.isdir(dst_subdir):
+        os.makedirs(dst_subdir, exist_ok=True)
+    tmp_file = '{0}.tmp-{1}'.format(dst_file, os.getpid())
+    shutil.copy2(src_file, tmp_file)
+    os.replace(tmp_file, dst_file)
+
+
+def sync_tree(src_dir, dst_dir, n_threads=8):
+    """Mirror src_dir into dst_dir, copying only changed files.
+
+    Parameters
+    ----------
+    src_dir : str
+        Source tree.
+    dst_dir : str
+        Mirror of the source tree.
+    n_threads : int, optional
+        Number of files copied at once. Default is 8.
+
+    Returns
+    -------
+    n_copied : int
+        Number of files copied. 0 if the mirror was already up to date.
+    """
+    if not op.isdir(src_dir):
+        raise ValueError('Source directory {0} must be an existing '
+                         'directory.'.format(src_dir))
+
+    manifest = build_manifest(src_dir)
+    # Fast path: no lock is needed to confirm a complete, current mirror
+    if _read_marker(dst_dir) == manifest:
+        return 0
+
+    parent_dir = op.dirname(op.abspath(dst_dir))
+    if not op.isdir(parent_dir):
+        os.makedirs(parent_dir, exist_ok=True)
+
+    with open(op.abspath(dst_dir) + '.lock', 'a') as lock_fo:
+        fcntl.flock(lock_fo, fcntl.LOCK_EX)
+        # Another job may have finished the sync while we waited
+        if _read_marker(dst_dir) == manifest:
+            return 0
+
+        if not op.isdir(dst_dir):
+            os.makedirs(dst_dir)
+        marker = op.join(dst_dir, COMPLETE_MARKER)
+        if op.isfile(marker):
+            os.remove(marker)
+
+        to_copy = []
+        for rel_path, (size, mtime) in manifest.items():
+            dst_file = op.join(dst_dir, rel_path)
+            if op.isfile(dst_file):
+                stat = os.stat(dst_file)
+                if stat.st_size == size and int(stat.st_mtime) == mtime:
+                    continue
+            to_copy.append(rel_path)
+
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(
+                lambda rel_path: _copy_file(op.join(src_dir, rel_path),
+                                            op.join(dst_dir, rel_path)),
+                to_copy))
+
+        # Remove files that are no longer in the source
+        for rel_path in build_manifest(dst_dir):
+            if rel_path not in manifest and rel_path != COMPLETE_MARKER:
+                os.remove(op.join(dst_dir, rel_path))
+
+        tmp_marker = '{0}.tmp-{1}'.format(marker, os.getpid())
+        with open(tmp_marker, 'w') as fo:
+            json.dump(manifest, fo)
+        os.replace(tmp_marker, marker)
+    return len(to_copy)
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        description='Incrementally mirror a directory into scratch.')
+    parser.add_argument('src_dir', help='Source directory.')
+    parser.add_argument('dst_dir', help='Mirror directory.')
+    parser.add_argument('--n_threads', type=int, default=8,
+                        help='Number of files copied at once.')
+    return parser
+
+
+def _main(argv=None):
+    options = _get_parser().parse_args(argv)
+    n_copied = sync_tree(**vars(options))
+    print('Copied {0} files.'.format(n_copied))
+
+
+if __name__ == '__main__':
+    _main()
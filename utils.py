@@ -1,30 +1,401 @@
 """Utilities used by other modules in the cis-processing workflow."""
 import os
 import os.path as op
+import time
+import signal
+import shutil
+import asyncio
+import tarfile
+import selectors
+import functools
 import subprocess
+from collections import deque, namedtuple
 
-import pandas as pd
+# Cluster locations. These can be overridden with environment variables
+# (e.g., to run the workflows against local stand-ins for benchmarking).
+SCRATCH_DIR = os.environ.get('CIS_SCRATCH_DIR', '/scratch')
+CIS_DIR = op.join(SCRATCH_DIR, 'cis_dataqc/')
+SINGULARITY_DIR = os.environ.get('CIS_SINGULARITY_DIR',
+                                 '/home/data/cis/singularity-images/')
+TEMPLATEFLOW_DIR = os.environ.get('CIS_TEMPLATEFLOW_DIR',
+                                  '/home/data/cis/templateflow')
 
+ARCHIVE_EXTENSIONS = ('.tar', '.tar.zst')
+STAGING_STRATEGIES = ('auto', 'hardlink', 'reflink', 'bind', 'copy',
+                      'decompress', 'extract')
 
-def run(command, env=None):
-    """Run a given command with certain environment variables set."""
-    merged_env = os.environ
+
+class CommandError(Exception):
+    """A command run with run() failed or timed out."""
+
+    def __init__(self, result, timed_out=False):
+        self.result = result
+        self.timed_out = timed_out
+        if timed_out:
+            reason = 'Timed out after {0:.0f} s'.format(result.wall_time)
+        else:
+            reason = 'Non zero return code: {0}'.format(result.returncode)
+        super(CommandError, self).__init__(
+            '{0}\n{1}\n\n{2}'.format(reason, result.command, result.output))
+
+
+# The outcome of a command run with run(). output holds the last lines of
+# the command's combined stdout and stderr. cpu_time (user plus system, in
+# seconds) and max_rss (peak resident set size, in bytes) cover the command
+# and the child processes it waited for.
+RunResult = namedtuple('RunResult', ['command', 'returncode', 'output',
+                                     'wall_time', 'cpu_time', 'max_rss'])
+
+
+def run(command, env=None, timeout=None, tail_lines=200, prefix=''):
+    """Run a given command with certain environment variables set.
+
+    Output is streamed as it arrives. Only the last tail_lines lines are
+    kept in memory, for the result and for error messages.
+
+    Parameters
+    ----------
+    command : str
+        Shell command to run.
+    env : dict or None, optional
+        Environment variables to set for the command, on top of the current
+        environment. The current environment is not modified.
+    timeout : float or None, optional
+        Kill the command (and any processes it started) after this many
+        seconds. Default is None (no timeout).
+    tail_lines : int, optional
+        Number of output lines to keep. Default is 200.
+    prefix : str, optional
+        Prefix for each printed output line, to tell apart the output of
+        concurrent commands. Default is "".
+
+    Returns
+    -------
+    result : RunResult
+        The command's return code, last output lines and resource usage.
+    """
+    merged_env = dict(os.environ)
     if env:
         merged_env.update(env)
+
+    start = time.time()
     process = subprocess.Popen(command, stdout=subprocess.PIPE,
                                stderr=subprocess.STDOUT, shell=True,
-                               env=merged_env)
-    while True:
-        line = process.stdout.readline()
-        line = str(line, 'utf-8')[:-1]
-        print(line)
-        if line == '' and process.poll() is not None:
-            break
+                               env=merged_env, start_new_session=True)
+    tail = deque(maxlen=tail_lines)
+
+    def _handle(line):
+        line = line.decode('utf-8', errors='replace')
+        print(prefix + line, flush=True)
+        tail.append(line)
+
+    fd = process.stdout.fileno()
+    selector = selectors.DefaultSelector()
+    selector.register(fd, selectors.EVENT_READ)
+    buffer = b''
+    timed_out = False
+    try:
+        while True:
+            wait = None
+            if timeout is not None:
+                wait = start + timeout - time.time()
+                if wait <= 0:
+                    timed_out = True
+                    os.killpg(process.pid, signal.SIGKILL)
+                    break
+            if not selector.select(wait):
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            lines = (buffer + chunk).split(b'\n')
+            buffer = lines.pop()
+            for line in lines:
+                _handle(line)
+    except BaseException:
+        # The command runs in its own session, so it must be stopped
+        # explicitly (e.g., on KeyboardInterrupt)
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        raise
+    if buffer:
+        _handle(buffer)
+    selector.close()
+    process.stdout.close()
+
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    result = RunResult(command=command,
+                       returncode=process.returncode,
+                       output='\n'.join(tail),
+                       wall_time=time.time() - start,
+                       cpu_time=rusage.ru_utime + rusage.ru_stime,
+                       max_rss=rusage.ru_maxrss * 1024)
 
-    if process.returncode != 0:
-        raise Exception("Non zero return code: {0}\n"
-                        "{1}\n\n{2}".format(process.returncode, command,
-                                            process.stdout.read()))
+    if timed_out or process.returncode != 0:
+        raise CommandError(result, timed_out=timed_out)
+    return result
+
+
+async def run_async(command, **kwargs):
+    """Run a command with run() without blocking the event loop.
+
+    Several commands can be run concurrently with asyncio.gather. Accepts
+    the same keyword arguments as run().
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None, functools.partial(run, command, **kwargs))
+
+
+def get_archive_options(config_options):
+    """Get raw archive settings from a project config.
+
+    Parameters
+    ----------
+    config_options : dict
+        Project configuration. The optional "archive" field may contain
+        "format" ("tar" or "tar.zst"), "threads" and "level".
+
+    Returns
+    -------
+    archive_options : dict
+        Archive settings with defaults filled in.
+    """
+    archive_options = {'format': 'tar', 'threads': 1, 'level': 3}
+    archive_options.update(config_options.get('archive', {}))
+    if '.' + archive_options['format'] not in ARCHIVE_EXTENSIONS:
+        raise ValueError('Archive format must be one of {0}, not '
+                         '"{1}".'.format(ARCHIVE_EXTENSIONS,
+                                         archive_options['format']))
+    return archive_options
+
+
+def write_archive(in_dir, out_base, archive_options, arcname=None):
+    """Archive a directory, optionally with multi-threaded zstd compression.
+
+    The tar stream is piped straight into zstd, so no uncompressed copy is
+    ever written. The archive is written to a temporary file and renamed
+    once complete, so an interrupted run never leaves a truncated archive.
+
+    Parameters
+    ----------
+    in_dir : str
+        Directory to archive.
+    out_base : str
+        Output path without extension.
+    archive_options : dict
+        Output of get_archive_options.
+    arcname : str or None, optional
+        Path to store the directory under in the archive. Default is None
+        (its basename).
+
+    Returns
+    -------
+    out_file : str
+        Path to the written archive.
+    """
+    out_file = '{0}.{1}'.format(out_base, archive_options['format'])
+    tmp_file = out_file + '.part'
+    if arcname is None:
+        arcname = op.basename(in_dir.rstrip('/'))
+    try:
+        if archive_options['format'] == 'tar':
+            with tarfile.open(tmp_file, 'w') as tar:
+                tar.add(in_dir, arcname=arcname)
+        else:
+            process = subprocess.Popen(
+                ['zstd', '-q', '-f',
+                 '-T{0}'.format(int(archive_options['threads'])),
+                 '-{0}'.format(int(archive_options['level'])),
+                 '-o', tmp_file],
+                stdin=subprocess.PIPE)
+            try:
+                with tarfile.open(fileobj=process.stdin, mode='w|') as tar:
+                    tar.add(in_dir, arcname=arcname)
+            finally:
+                process.stdin.close()
+                process.wait()
+            if process.returncode != 0:
+                raise Exception('zstd failed with return code {0} while '
+                                'writing {1}'.format(process.returncode,
+                                                     out_file))
+    except BaseException:
+        # Leave no partial archive behind in raw/
+        if op.isfile(tmp_file):
+            os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, out_file)
+    return out_file
+
+
+def _extract_tar(tar, out_dir):
+    """Extract a tar stream, refusing members that would land outside out_dir.
+
+    Uses tarfile's "data" filter where available (Python 3.12, and 3.8+
+    security releases). Otherwise member names and link targets are checked
+    before extracting each member.
+    """
+    if hasattr(tarfile, 'data_filter'):
+        tar.extractall(out_dir, filter='data')
+        return
+    out_dir = op.abspath(out_dir)
+    for member in tar:
+        paths = [member.name]
+        if member.issym():
+            paths.append(op.join(op.dirname(member.name), member.linkname))
+        elif member.islnk():
+            paths.append(member.linkname)
+        for path in paths:
+            path = op.normpath(op.join(out_dir, path))
+            if not path.startswith(out_dir + os.sep):
+                raise ValueError('Archive member {0} would be extracted '
+                                 'outside of {1}.'.format(member.name,
+                                                          out_dir))
+        if not (member.isfile() or member.isdir() or member.issym()
+                or member.islnk()):
+            raise ValueError('Archive member {0} is not a regular file, '
+                             'directory or link.'.format(member.name))
+        tar.extract(member, out_dir)
+
+
+def extract_archive(in_file, out_tar, threads=1):
+    """Write an archive to an uncompressed tar file.
+
+    Compressed archives are decompressed while being read from the source
+    filesystem, so only the compressed bytes cross the network. Plain tar
+    files are copied.
+
+    Parameters
+    ----------
+    in_file : str
+        Path to a ".tar" or ".tar.zst" archive.
+    out_tar : str
+        Path to the output tar file.
+    threads : int, optional
+        Number of zstd threads. Default is 1.
+    """
+    if in_file.endswith('.tar.zst'):
+        run('zstd -q -d -f -T{threads} -o {out_tar} {in_file}'.format(
+            threads=int(threads), out_tar=out_tar, in_file=in_file))
+    else:
+        shutil.copyfile(in_file, out_tar)
+
+
+def stage_archive(in_file, out_tar, strategy='auto', threads=1):
+    """Make a raw data archive available to the BIDSifier in scratch.
+
+    Strategies, from cheapest to most expensive:
+
+    - "bind": read the archive in place, bind-mounted read-only into the
+      container.
+    - "hardlink": hard link the archive into scratch (same filesystem only).
+    - "reflink": copy-on-write clone of the archive (filesystem support
+      needed).
+    - "decompress": stream-decompress a ".tar.zst" archive into a tar file
+      in scratch.
+    - "extract": stream-extract the archive into a directory in scratch.
+    - "copy": copy the archive into scratch.
+
+    "auto" uses "decompress" for compressed archives. For tar files it tries
+    "hardlink", then "reflink", then "bind", and only copies the archive if
+    its directory cannot be read to be bind-mounted.
+
+    Parameters
+    ----------
+    in_file : str
+        Path to a ".tar" or ".tar.zst" archive.
+    out_tar : str
+        Path to the staged tar file in scratch. With "extract", the archive
+        is extracted to this path without the ".tar" suffix.
+    strategy : str, optional
+        One of STAGING_STRATEGIES. Default is "auto".
+    threads : int, optional
+        Number of zstd threads. Default is 1.
+
+    Returns
+    -------
+    staged : str
+        Path to give the BIDSifier.
+    strategy : str
+        The strategy used.
+    env : dict
+        Environment variables needed to run the BIDSifier on the staged
+        archive.
+    """
+    if strategy not in STAGING_STRATEGIES:
+        raise ValueError('Staging strategy must be one of {0}, not '
+                         '"{1}".'.format(STAGING_STRATEGIES, strategy))
+
+    compressed = in_file.endswith('.tar.zst')
+    if compressed and strategy in ('hardlink', 'reflink', 'bind', 'copy'):
+        raise ValueError('Compressed archives can only be staged with the '
+                         '"decompress" or "extract" strategies.')
+
+    if op.isfile(out_tar):
+        os.remove(out_tar)
+
+    env = {}
+    if strategy == 'auto':
+        candidates = ['decompress'] if compressed else [
+            'hardlink', 'reflink', 'bind', 'copy']
+    else:
+        candidates = [strategy]
+
+    for strategy in candidates:
+        staged = out_tar
+        if strategy == 'bind':
+            staged = op.abspath(in_file)
+            in_dir = op.dirname(staged)
+            if not os.access(in_dir, os.R_OK | os.X_OK):
+                continue
+            # Keep the binds already set by the user or site
+            env['SINGULARITY_BIND'] = ','.join(
+                [bind for bind in [os.environ.get('SINGULARITY_BIND')]
+                 if bind] + ['{0}:{0}:ro'.format(in_dir)])
+        elif strategy == 'hardlink':
+            if (os.stat(in_file).st_dev
+                    != os.stat(op.dirname(op.abspath(out_tar))).st_dev):
+                continue
+            os.link(in_file, out_tar)
+        elif strategy == 'reflink':
+            returncode = subprocess.call(
+                ['cp', '--reflink=always', in_file, out_tar],
+                stderr=subprocess.DEVNULL)
+            if returncode != 0:
+                if op.isfile(out_tar):
+                    os.remove(out_tar)
+                continue
+        elif strategy == 'decompress':
+            if not compressed:
+                raise ValueError('Only ".tar.zst" archives can be '
+                                 'decompressed.')
+            extract_archive(in_file, out_tar, threads=threads)
+        elif strategy == 'extract':
+            staged = out_tar[:-len('.tar')]
+            if not op.isdir(staged):
+                os.makedirs(staged)
+            if compressed:
+                process = subprocess.Popen(
+                    ['zstd', '-q', '-d', '-c', '-T{0}'.format(int(threads)),
+                     in_file], stdout=subprocess.PIPE)
+                with tarfile.open(fileobj=process.stdout, mode='r|') as tar:
+                    _extract_tar(tar, staged)
+                process.stdout.close()
+                if process.wait() != 0:
+                    raise Exception('zstd failed with return code {0} while '
+                                    'reading {1}'.format(process.returncode,
+                                                         in_file))
+            else:
+                with tarfile.open(in_file, mode='r|') as tar:
+                    _extract_tar(tar, staged)
+        else:
+            shutil.copyfile(in_file, out_tar)
+        break
+
+    print('Staged {0} for the BIDSifier using the "{1}" strategy.'.format(
+        in_file, strategy))
+    return staged, strategy, env
 
 
 def clean_csv(in_file):
@@ -37,6 +408,9 @@ def clean_csv(in_file):
 
     Writes out a file with the same name as the input file, but with the suffix
     "_cleaned".
+
+    For IQMs across many projects, prefer iqm_store, which applies the same
+    rule when exporting.
     """
     fname = op.basename(in_file)
     d = op.dirname(in_file)
@@ -44,6 +418,8 @@ def clean_csv(in_file):
     out_fname = fname + '_cleaned'
     out_file = op.join(d, out_fname + ext)
 
+    import pandas as pd
+
     df = pd.read_csv(in_file)
     df = df.fillna(0)
     df.to_csv(out_file, line_terminator='\n', index=False)
@@ -0,0 +1,398 @@
+"""List XNAT experiments and download them in parallel shards.
+
+Instead of one downloader call fetching every pending session in turn, the
+project's experiments are listed through XNAT's REST API, and experiments
+not yet downloaded are handed out to several downloader instances running
+at once, each in its own working subdirectory. The number of instances
+downloading at a time adapts to the link: it drops when downloads slow
+each other down, and grows back while they do not, up to what fills the
+configured bandwidth (see BandwidthLimiter). Each downloaded session is
+passed on to post-processing as soon as it arrives.
+
+Individual scans can also be listed and downloaded, to re-fetch only the new
+or changed series of an amended session (see session_index.py).
+"""
+import os
+import os.path as op
+import json
+import math
+import time
+import netrc
+import base64
+import shutil
+import zipfile
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _auth_headers(xnat_url):
+    """Basic authentication headers from ~/.netrc, if it has the host."""
+    host = urllib.parse.urlparse(xnat_url).hostname
+    try:
+        credentials = netrc.netrc().authenticators(host)
+    except (IOError, netrc.NetrcParseError):
+        credentials = None
+    if credentials is None:
+        return {}
+    token = base64.b64encode('{0}:{1}'.format(
+        credentials[0], credentials[2]).encode()).decode()
+    return {'Authorization': 'Basic {0}'.format(token)}
+
+
+def list_experiments(xnat_url, project, timeout=60):
+    """List a project's experiments through the XNAT REST API.
+
+    Credentials are read from ~/.netrc.
+
+    Returns
+    -------
+    experiments : list of dict
+        "ID", "label", "subject_label", "date" and "last_modified" of each
+        experiment.
+    """
+    result = _get_json(
+        xnat_url, '/data/projects/{0}/experiments?{1}'.format(
+            urllib.parse.quote(project), urllib.parse.urlencode({
+                'format': 'json',
+                'columns': 'ID,label,subject_label,date,last_modified'})),
+        timeout=timeout)
+    return result['ResultSet']['Result']
+
+
+def _get_json(xnat_url, path, timeout=60):
+    request = urllib.request.Request(xnat_url.rstrip('/') + path,
+                                     headers=_auth_headers(xnat_url))
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read().decode())
+
+
+def list_scans(xnat_url, experiment, timeout=60):
+    """Count the files and bytes of each scan of an experiment.
+
+    Returns
+    -------
+    scans : dict
+        [n_files, n_bytes] keyed by scan ID.
+    """
+    result = _get_json(
+        xnat_url, '/data/experiments/{0}/scans/ALL/files?format=json'.format(
+            urllib.parse.quote(experiment)), timeout=timeout)
+    scans = {}
+    for row in result['ResultSet']['Result']:
+        scan = row['URI'].split('/scans/', 1)[1].split('/', 1)[0]
+        stat = scans.setdefault(scan, [0, 0])
+        stat[0] += 1
+        stat[1] += int(row.get('Size') or 0)
+    return scans
+
+
+def download_scans(xnat_url, experiment, scans, ses_dir, timeout=600):
+    """Download some of an experiment's scans into a session folder.
+
+    Scans are written as <ses_dir>/<scan folder>/..., like the downloader
+    does. Scan folders are named <scan ID>-<description>, so any folder of
+    a downloaded scan ID (the folder named after the ID, or starting with
+    the ID and a dash) is replaced.
+
+    Returns
+    -------
+    n_bytes : int
+        Number of bytes downloaded.
+    """
+    url = '{0}/data/experiments/{1}/scans/{2}/files?format=zip'.format(
+        xnat_url.rstrip('/'), urllib.parse.quote(experiment),
+        ','.join(urllib.parse.quote(scan) for scan in scans))
+    request = urllib.request.Request(url, headers=_auth_headers(xnat_url))
+    os.makedirs(ses_dir, exist_ok=True)
+    ses_dir = op.abspath(ses_dir)
+
+    def _scan_id(folder):
+        for scan in scans:
+            if folder == scan or folder.startswith(scan + '-'):
+                return scan
+        return None
+
+    with tempfile.TemporaryFile(dir=ses_dir) as zip_fo:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            shutil.copyfileobj(response, zip_fo)
+        n_bytes = zip_fo.tell()
+        with zipfile.ZipFile(zip_fo) as zip_file:
+            out_files = {}
+            for member in zip_file.infolist():
+                if '/scans/' not in member.filename or member.is_dir():
+                    continue
+                rel_path = member.filename.split('/scans/', 1)[1]
+                out_file = op.normpath(op.join(ses_dir, rel_path))
+                if not out_file.startswith(ses_dir + os.sep):
+                    raise ValueError('Archive member {0} of {1} is outside '
+                                     'of the session folder.'.format(
+                                         member.filename, experiment))
+                out_files[member.filename] = out_file
+            # Remove the previous version of each downloaded scan
+            downloaded = set(_scan_id(op.relpath(out_file, ses_dir).split(
+                os.sep, 1)[0]) for out_file in out_files.values())
+            for old_dir in os.listdir(ses_dir):
+                if (op.isdir(op.join(ses_dir, old_dir))
+                        and _scan_id(old_dir) in downloaded - {None}):
+                    shutil.rmtree(op.join(ses_dir, old_dir))
+            for name, out_file in out_files.items():
+                os.makedirs(op.dirname(out_file), exist_ok=True)
+                with zip_file.open(name) as in_fo, \
+                        open(out_file, 'wb') as out_fo:
+                    shutil.copyfileobj(in_fo, out_fo)
+    return n_bytes
+
+
+class BandwidthLimiter(object):
+    """Limit the number of concurrent downloads to what the link carries.
+
+    The limit follows the downloads' measured throughput. The best
+    throughput seen so far estimates what one download gets on an unloaded
+    link. When concurrent downloads each get less than that, they are
+    slowing each other down, and the limit drops to the number of unloaded
+    downloads their combined throughput amounts to. Otherwise, it grows by
+    one download at a time, up to the number of unloaded downloads that
+    fill bandwidth_mbps.
+
+    Parameters
+    ----------
+    max_streams : int
+        Maximum number of concurrent downloads.
+    bandwidth_mbps : float or None, optional
+        Bandwidth available to the downloads, in Mbit/s. If None, up to
+        max_streams downloads run at once. Default is None.
+    stream_mbps : float or None, optional
+        Expected throughput of one download on an unloaded link, in Mbit/s,
+        to set the initial limit. If None, downloads start one at a time
+        until their throughput has been measured. Default is None.
+    """
+
+    # Fraction of the unloaded throughput below which a download is slowed
+    THRESHOLD = 0.9
+    # Fraction of bandwidth_mbps from which the link counts as loaded.
+    # Downloads are measured on the files they write and include their
+    # setup, so they fall short of the throughput on the wire.
+    LOADED = 0.5
+
+    def __init__(self, max_streams, bandwidth_mbps=None, stream_mbps=None):
+        self.max_streams = max(1, int(max_streams))
+        self.bandwidth_mbps = bandwidth_mbps
+        self.stream_mbps = stream_mbps
+        self.active = 0
+        if not bandwidth_mbps:
+            self.limit = self.max_streams
+        elif stream_mbps:
+            self.limit = self._link_streams()
+        else:
+            self.limit = 1
+        # Best throughput measured, and fewest concurrent downloads measured
+        self._unloaded_mbps = None
+        self._fewest = self.max_streams + 1
+        self._last_cut = 0
+        self._next_slot = 0
+        self._slots = {}
+        self._condition = threading.Condition()
+
+    def _link_streams(self):
+        """Number of unloaded downloads that fill the link."""
+        return max(1, min(self.max_streams, int(math.ceil(
+            self.bandwidth_mbps / self.stream_mbps - 1e-9))))
+
+    def allowed(self):
+        """Number of downloads allowed to run at once."""
+        return self.limit
+
+    def acquire(self):
+        """Wait for a download slot.
+
+        Returns
+        -------
+        slot : int
+            Slot token, to pass on to release.
+        """
+        with self._condition:
+            while self.active >= self.allowed():
+                self._condition.wait()
+            self.active += 1
+            self._next_slot += 1
+            slot = self._next_slot
+            # Most downloads each running download has shared the link with
+            self._slots[slot] = [time.time(), self.active]
+            for info in self._slots.values():
+                info[1] = max(info[1], self.active)
+            return slot
+
+    def release(self, nbytes=0, seconds=0, slot=None):
+        """End a download, adjusting the limit to its throughput.
+
+        The limit is adjusted once for downloads that ran at the same time:
+        only downloads started after the last cut count. If the link is
+        loaded but the throughput was never measured with fewer concurrent
+        downloads, the limit is halved to find out.
+
+        Parameters
+        ----------
+        nbytes : int, optional
+            Bytes downloaded. Default is 0 (no measurement).
+        seconds : float, optional
+            Duration of the download. Default is 0.
+        slot : int or None, optional
+            Token returned by acquire.
+        """
+        with self._condition:
+            start, concurrent = self._slots.pop(slot, [None, self.active])
+            self.active -= 1
+            if nbytes > 0 and seconds > 0 and self.bandwidth_mbps:
+                mbps = nbytes * 8 / 1e6 / seconds
+                self._unloaded_mbps = max(mbps, self._unloaded_mbps or 0)
+                self.stream_mbps = self._unloaded_mbps
+                fewest = self._fewest
+                self._fewest = min(self._fewest, concurrent)
+                slowed = (concurrent > 1 and mbps
+                          < self.THRESHOLD * self._unloaded_mbps)
+                loaded = (mbps * concurrent
+                          >= self.LOADED * self.bandwidth_mbps)
+                if start is None or start >= self._last_cut:
+                    if slowed:
+                        self.limit = max(1, min(self.limit, int(round(
+                            mbps * concurrent / self._unloaded_mbps))))
+                        self._last_cut = time.time()
+                    elif loaded and 1 < concurrent <= fewest:
+                        self.limit = max(1, min(self.limit, concurrent) // 2)
+                        self._last_cut = time.time()
+                    else:
+                        self.limit = max(self.limit, min(
+                            self.limit + 1, self._link_streams()))
+            self._condition.notify_all()
+
+
+def find_sessions(raw_dir):
+    """List the (sub, ses) folders written by a downloader."""
+    sessions = []
+    if not op.isdir(raw_dir):
+        return sessions
+    for sub in sorted(os.listdir(raw_dir)):
+        try:
+            sessions += [(sub, ses) for ses in sorted(os.listdir(
+                op.join(raw_dir, sub)))]
+        except FileNotFoundError:
+            # archived and removed meanwhile
+            continue
+    return sessions
+
+
+def watch_download(download, raw_dir, on_session, poll_interval=5):
+    """Run a multi-session download, passing on sessions as they complete.
+
+    The downloader writes one session at a time, so while it runs, every
+    session but the most recently modified one is complete. The rest are
+    passed on once the download ends. If the download fails, the session it
+    was writing is left out and the error is raised.
+
+    Parameters
+    ----------
+    download : callable
+        Runs the downloader, which writes <raw_dir>/<sub>/<ses>.
+    raw_dir : str
+        Folder the downloader writes sessions to.
+    on_session : callable
+        on_session(raw_dir, sub, ses) is called once per complete session.
+        Sessions may be removed from raw_dir once passed on.
+    poll_interval : float, optional
+        Seconds between checks for new sessions. Default is 5.
+    """
+    outcome = {}
+
+    def _run():
+        try:
+            download()
+        except Exception as exc:
+            outcome['error'] = exc
+
+    thread = threading.Thread(target=_run)
+    thread.start()
+    emitted = set()
+    while True:
+        thread.join(poll_interval)
+        finished = not thread.is_alive()
+        pending = []
+        for sub, ses in find_sessions(raw_dir):
+            if (sub, ses) in emitted:
+                continue
+            try:
+                mtime = os.stat(op.join(raw_dir, sub, ses)).st_mtime
+            except FileNotFoundError:
+                continue
+            pending.append((mtime, sub, ses))
+        pending.sort()
+        if not finished or 'error' in outcome:
+            # still being written
+            pending = pending[:-1]
+        for _, sub, ses in pending:
+            emitted.add((sub, ses))
+            on_session(raw_dir, sub, ses)
+        if finished:
+            break
+    if 'error' in outcome:
+        raise outcome['error']
+
+
+def download_sharded(experiments, download, work_dir, limiter, on_session):
+    """Download experiments concurrently, passing on sessions on arrival.
+
+    Parameters
+    ----------
+    experiments : list of str
+        Experiment IDs to download.
+    download : callable
+        download(experiment, shard_dir) runs one downloader instance, which
+        writes <shard_dir>/raw/<sub>/<ses>. It returns the bytes transferred
+        and the time the transfer took, in seconds, to adjust the limiter
+        with, or None if nothing was transferred.
+    work_dir : str
+        Each experiment is downloaded to its own subdirectory of work_dir.
+    limiter : BandwidthLimiter
+        Limits the number of downloads running at once.
+    on_session : callable
+        on_session(experiment, raw_dir, sub, ses) is called, from the
+        downloading thread, for each downloaded session, or with sub and ses
+        set to None if the experiment had nothing to download. It may block
+        (e.g., to put the session on a bounded queue) without holding up
+        other downloads' bandwidth slots.
+
+    Returns
+    -------
+    failures : dict
+        Exceptions raised while downloading, keyed by experiment ID.
+    """
+    failures = {}
+    lock = threading.Lock()
+
+    def _download(experiment):
+        shard_dir = op.join(work_dir, 'shard-{0}'.format(experiment))
+        raw_dir = op.join(shard_dir, 'raw')
+        slot = limiter.acquire()
+        transfer = None
+        try:
+            transfer = download(experiment, shard_dir)
+        except Exception as exc:
+            with lock:
+                failures[experiment] = exc
+            return
+        finally:
+            limiter.release(*(transfer or (0, 0)), slot=slot)
+
+        sessions = find_sessions(raw_dir)
+        for sub, ses in sessions:
+            on_session(experiment, raw_dir, sub, ses)
+        if not sessions:
+            # Already processed sessions are skipped by the downloader, so
+            # there is nothing to post-process
+            on_session(experiment, raw_dir, None, None)
+
+    with ThreadPoolExecutor(max_workers=limiter.max_streams) as executor:
+        list(executor.map(_download, experiments))
+    return failures